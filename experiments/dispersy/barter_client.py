@@ -80,12 +80,12 @@ class BarterClient(AllChannelClient):
             self._logger.error("barter community not loaded")
         if candidate_id == 0:
             # Send a message to all candidate.
-            for c in self.all_vars.itervalues():
+            for c in self.peers.records():
                 candidate = Candidate((str(c['host']), c['port']), False)
                 self._bccommunity.create_stats_request(candidate, BartercastStatisticTypes.TORRENTS_RECEIVED)
         else:
             # Send a message to a specific candidate.
-            target = self.all_vars[candidate_id]
+            target = self.peers.get(candidate_id)
             candidate = Candidate((str(target['host']), target['port']), False)
             self._bccommunity.create_stats_request(candidate, BartercastStatisticTypes.TORRENTS_RECEIVED)
 
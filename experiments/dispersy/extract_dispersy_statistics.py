@@ -705,6 +705,63 @@ class AnnotateMessages(AbstractHandler):
                 print >> h_annotations, node_dict.get(node, '?'),
             print >> h_annotations, ''
 
+class ScenarioActionTimes(AbstractHandler):
+
+    def __init__(self):
+        AbstractHandler.__init__(self)
+
+        self.drifts = defaultdict(list)
+        self.durations = defaultdict(list)
+        self.deferred_durations = defaultdict(list)
+        self.never_fired = defaultdict(int)
+
+    def new_file(self, node_nr, filename, outputdir):
+        # Written by ScenarioRunner.set_action_log() if SCENARIO_ACTION_STATS is enabled
+        actions_filename = os.path.join(outputdir, "scenario-actions.log")
+        if not os.path.exists(actions_filename):
+            return
+
+        for line in open(actions_filename):
+            if line[0] == "#":
+                continue
+
+            parts = line.split(' ', 4)
+            if len(parts) != 5:
+                continue
+
+            _, drift, duration, deferred, clb = parts
+            clb = clb.strip()
+            self.drifts[clb].append(float(drift))
+            self.durations[clb].append(float(duration))
+            if deferred == "?":
+                self.never_fired[clb] += 1
+            elif deferred != "-":
+                self.deferred_durations[clb].append(float(deferred))
+
+    def filter_line(self, node_nr, line_nr, timestamp, timeoffset, key):
+        return False
+
+    def percentiles(self, values):
+        if not values:
+            return ["?"] * 4
+
+        values.sort()
+        return ["%f" % values[min(len(values) - 1, int(len(values) * percentile))] for percentile in (0.5, 0.9, 0.99)] + ["%f" % values[-1]]
+
+    def all_files_done(self, extract_statistics):
+        if not self.drifts:
+            return
+
+        h_action_times = open(os.path.join(extract_statistics.node_directory, "scenario-action-times.txt"), "w+")
+        print >> h_action_times, "action count drift_p50 drift_p90 drift_p99 drift_max duration_p50 duration_p90 duration_p99 duration_max deferred_p50 deferred_p90 deferred_p99 deferred_max never_fired"
+        for clb in sorted(self.drifts.iterkeys()):
+            print >> h_action_times, clb, len(self.drifts[clb]),
+            print >> h_action_times, " ".join(self.percentiles(self.drifts[clb])),
+            print >> h_action_times, " ".join(self.percentiles(self.durations[clb])),
+            print >> h_action_times, " ".join(self.percentiles(self.deferred_durations[clb])),
+            print >> h_action_times, self.never_fired[clb]
+        h_action_times.close()
+
 def get_parser(argv):
     e = ExtractStatistics(argv[1])
     e.add_handler(BasicExtractor())
@@ -714,6 +771,7 @@ def get_parser(argv):
     e.add_handler(BootstrapMessages())
     e.add_handler(DebugMessages())
     e.add_handler(AnnotateMessages())
+    e.add_handler(ScenarioActionTimes())
     return e
 
 if __name__ == "__main__":
@@ -6,7 +6,7 @@ from collections import defaultdict
 
 class ChurnAnalyzer(ScenarioRunner):
 
-    def __init__(self, filename, outputfile=sys.stdout, max_tstmp=sys.maxint):
+    def __init__(self, filename, outputfile=sys.stdout, max_tstmp=sys.maxint, sample_interval=None):
         ScenarioRunner.__init__(self, filename)
 
         self._callables = {}
@@ -17,6 +17,13 @@ class ChurnAnalyzer(ScenarioRunner):
         self._peer_state = defaultdict(lambda: "offline")
         self._peer_friends = defaultdict(list)
 
+        # Connectivity is kept up to date incrementally: for every peer the amount of its friends that are online and
+        # which peers have it as a friend, so a peer changing state only touches the peers that befriended it.
+        self._online_friends = defaultdict(int)
+        self._befriended_by = defaultdict(list)
+        self._can_connect_to = {}
+        self._sum_can_connect_to = 0.0
+
         self._time_online = defaultdict(lambda :[0, 0, 0, 0])
         self._prev_online = defaultdict(int)
         self._prev_offline = defaultdict(int)
@@ -25,35 +32,48 @@ class ChurnAnalyzer(ScenarioRunner):
 
         sorted_scenario = defaultdict(list)
 
-        prev_tstmp = -1
-        for (tstmp, lineno, clb, args) in self._parse_scenario(filename):
-            if clb in self._callables and tstmp < max_tstmp:
-                sorted_scenario[tstmp].append((self.yes_peers, clb, args))
+        for (tstmp, lineno, clb, args, repeat) in self._parse_scenario(filename):
+            if clb in self._callables:
+                interval, end = repeat or (1, tstmp)
+                for tstmp in xrange(tstmp, min(end + 1, max_tstmp), interval):
+                    sorted_scenario[tstmp].append((self.peerspec, clb, args))
 
         tstmps = sorted_scenario.keys()
         tstmps.sort()
 
+        next_sample = 0
         for tstmp in tstmps:
-            for yes_peers, clb, args in sorted_scenario[tstmp]:
-                for peer in yes_peers:
+            if sample_interval:
+                # Output the state as it was at all sampling points before this timestamp
+                while next_sample < tstmp:
+                    self.print_connections(next_sample, outputfile)
+                    next_sample += sample_interval
+
+            for peerspec, clb, args in sorted_scenario[tstmp]:
+                # lines without a (positive) peerspec don't apply to any peer in particular
+                for peer in (peerspec if not peerspec.negated else ()):
                     self._callables[clb](tstmp, peer, *args)
 
-                if prev_tstmp != tstmp:
-                    self.print_connections(tstmp, outputfile)
-                    prev_tstmp = tstmp
+            if not sample_interval:
+                self.print_connections(tstmp, outputfile)
+
+        if sample_interval and tstmps:
+            while next_sample <= tstmps[-1]:
+                self.print_connections(next_sample, outputfile)
+                next_sample += sample_interval
 
         self.print_averages(outputfile, tstmps[-1])
 
     def _parse_for_this_peer(self, peerspec):
-        if peerspec:
-            self.yes_peers, self.no_peers = self._parse_peerspec(peerspec)
-        else:
-            self.yes_peers = set()
-            self.no_peers = set()
+        self.peerspec = self._parse_peerspec(peerspec)
         return True
 
     def online(self, tstmp, peer):
-        self._peer_state[peer] = "online"
+        if self._peer_state[peer] != "online":
+            self._peer_state[peer] = "online"
+            self._update_befriended_by(peer, 1)
+            self._update_can_connect_to(peer)
+
         self._prev_online[peer] = tstmp
 
         been_offline = tstmp - self._prev_offline[peer]
@@ -63,7 +83,11 @@ class ChurnAnalyzer(ScenarioRunner):
         self.max_offline = max(self.max_offline, been_offline)
 
     def offline(self, tstmp, peer):
-        self._peer_state[peer] = "offline"
+        if self._peer_state[peer] != "offline":
+            self._peer_state[peer] = "offline"
+            self._update_befriended_by(peer, -1)
+            self._update_can_connect_to(peer)
+
         self._prev_offline[peer] = tstmp
 
         been_online = tstmp - self._prev_online[peer]
@@ -73,27 +97,33 @@ class ChurnAnalyzer(ScenarioRunner):
         self.max_online = max(self.max_online, been_online)
 
     def add_friend(self, tstmp, peer, friend):
-        self._peer_friends[peer].append(int(friend))
+        friend = int(friend)
+        self._peer_friends[peer].append(friend)
+        self._befriended_by[friend].append(peer)
+        if self._peer_state[friend] == "online":
+            self._online_friends[peer] += 1
+        self._update_can_connect_to(peer)
 
-    def print_connections(self, tstmp, outputfile):
-        if len(self._peer_friends):
-            print >> outputfile, tstmp,
+    def _update_befriended_by(self, friend, delta):
+        for peer in self._befriended_by.get(friend, ()):
+            self._online_friends[peer] += delta
+            self._update_can_connect_to(peer)
 
-            sum_can_connect_to = 0
-            for peer, friends in self._peer_friends.iteritems():
-                can_connect_to = 0
-                if self._peer_state[peer] == "online":
-                    for friend in friends:
-                        if self._peer_state[friend] == "online":
-                            can_connect_to += 1
+    def _update_can_connect_to(self, peer):
+        if peer not in self._peer_friends:
+            return
 
-                    if len(friends):
-                        can_connect_to /= float(len(friends))
+        can_connect_to = 0
+        if self._peer_state[peer] == "online":
+            can_connect_to = self._online_friends[peer] / float(len(self._peer_friends[peer]))
 
-                # print >> outputfile, peer, can_connect_to,
-                sum_can_connect_to += can_connect_to
+        self._sum_can_connect_to += can_connect_to - self._can_connect_to.get(peer, 0)
+        self._can_connect_to[peer] = can_connect_to
 
-            print >> outputfile, "average", sum_can_connect_to / float(len(self._peer_friends))
+    def print_connections(self, tstmp, outputfile):
+        if len(self._peer_friends):
+            print >> outputfile, tstmp,
+            print >> outputfile, "average", self._sum_can_connect_to / float(len(self._peer_friends))
 
     def print_averages(self, outputfile, max_tstmp):
         online_time = offline_time = 0
@@ -113,12 +143,12 @@ class ChurnAnalyzer(ScenarioRunner):
         print >> outputfile, "average online", ave_on_sessions / float(nr_peers), "offline", ave_off_sessions / float(nr_peers), nr_peers
         print >> outputfile, "max online", self.max_online, "offline", self.max_offline
 
-def main(inputfile, outputfile, max_tstmp=sys.maxint):
+def main(inputfile, outputfile, max_tstmp=sys.maxint, sample_interval=None):
     inputfile = os.path.abspath(inputfile)
     if os.path.exists(inputfile):
         f = open(outputfile, 'w')
 
-        ChurnAnalyzer(inputfile, f, int(max_tstmp))
+        ChurnAnalyzer(inputfile, f, int(max_tstmp), int(sample_interval) if sample_interval else None)
 
         f.close()
     else:
@@ -126,12 +156,14 @@ def main(inputfile, outputfile, max_tstmp=sys.maxint):
 
 if __name__ == '__main__':
     if len(sys.argv) < 3:
-        print "Usage: %s <input-file> <output-file> (<max_tstmp>)" % (sys.argv[0])
+        print "Usage: %s <input-file> <output-file> (<max_tstmp>) (<sample-interval>)" % (sys.argv[0])
         print >> sys.stderr, sys.argv
 
         exit(1)
 
     if len(sys.argv) == 3:
         main(sys.argv[1], sys.argv[2])
-    else:
+    elif len(sys.argv) == 4:
         main(sys.argv[1], sys.argv[2], sys.argv[3])
+    else:
+        main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
@@ -1,96 +1,134 @@
 import os
 import sys
-from random import expovariate, random, randint
+from itertools import izip
+
+import numpy
+
 from gumby.scenario import ScenarioRunner
+from gumby.workerpool import WorkerPool
+
+
+def get_peer_seed(seed, lineno, peer):
+    """
+    Derives the seed used to expand the churn line at lineno for a peer, so the output only depends on the base seed
+    and not on how the peers were distributed over the worker processes.
+    """
+    return ((seed * 1000003 + lineno) * 1000003 + peer) % 2 ** 32
+
+
+def churn(rng, tstmp, max_tstmp, churn_type, desired_mean=300, min_online=5.0):
+    """
+    Returns the timestamps at which a peer switches between online and offline and whether it goes online at each of
+    them.
+    """
+    desired_mean = float(desired_mean)
+    min_online = float(min_online)
+
+    go_online = rng.random_sample() < 0.5
+    if churn_type == 'expon':
+        # Draw the session lengths in batches big enough to (most likely) reach max_tstmp at once
+        switch_times = [numpy.array([float(tstmp)])]
+        last_switch = float(tstmp)
+        while last_switch < max_tstmp:
+            batch_size = int((max_tstmp - last_switch) / desired_mean) + 16
+            delays = min_online + rng.exponential(desired_mean - min_online, batch_size)
+            switch_times.append(last_switch + numpy.cumsum(delays))
+            last_switch = switch_times[-1][-1]
+        switch_times = numpy.concatenate(switch_times)
+
+    elif churn_type == 'fixed':
+        first_delay = rng.randint(int(min_online), int(desired_mean) + 1)
+        nr_switches = max(0, int(numpy.ceil((max_tstmp - tstmp - first_delay) / desired_mean)))
+        switch_times = numpy.concatenate(([float(tstmp)],
+                                          tstmp + first_delay + desired_mean * numpy.arange(nr_switches)))
+    else:
+        raise NotImplementedError('only expon churn is implemented, got %s' % churn_type)
+
+    switch_times = switch_times[switch_times < max_tstmp]
+    online = numpy.arange(len(switch_times)) % 2 == (0 if go_online else 1)
+    return switch_times, online
+
+
+def churn_pattern(rng, tstmp, max_tstmp, pattern, min_online=5.0):
+    """
+    Returns the timestamps at which a peer switches between online and offline following the given pattern of online
+    probabilities (in %), sampled every min_online seconds, and whether it goes online at each of them.
+    """
+    pattern = numpy.array([online / 100.0 for online in map(float, pattern.split(','))])
+    min_online = float(min_online)
+
+    nr_steps = max(0, int(numpy.ceil((max_tstmp - tstmp) / min_online)))
+    step_times = tstmp + min_online * numpy.arange(nr_steps)
+    online = rng.random_sample(nr_steps) < numpy.resize(pattern, nr_steps)
+
+    # Only output the steps in which the state changes
+    changes = numpy.ones(nr_steps, dtype=bool)
+    changes[1:] = online[1:] != online[:-1]
+    return step_times[changes], online[changes]
+
+
+CHURN_EXPANDERS = {'churn': churn,
+                   'churn_pattern': churn_pattern}
+
+
+def expand_churn(job):
+    """
+    Expands a churn line for a chunk of peers, returns the resulting scenario lines as a single string.
+    """
+    clb, tstmp, max_tstmp, args, lineno, peers, seed = job
+
+    lines = []
+    for peer in peers:
+        rng = numpy.random.RandomState(get_peer_seed(seed, lineno, peer))
+        switch_times, online = CHURN_EXPANDERS[clb](rng, tstmp, max_tstmp, *args)
+        lines.extend("@0:%d %s {%d}\n" % (switch_time, "online" if go_online else "offline", peer)
+                     for switch_time, go_online in izip(switch_times, online))
+    return "".join(lines)
+
 
 class ScenarioPreProcessor(ScenarioRunner):
 
-    def __init__(self, filename, outputfile=sys.stdout, max_tstmp=0):
+    def __init__(self, filename, outputfile=sys.stdout, max_tstmp=0, seed=0, processes=None):
         ScenarioRunner.__init__(self, filename)
 
-        self._callables = {}
-        self._callables['churn'] = self.churn
-        self._callables['churn_pattern'] = self.churn_pattern
+        self._callables = CHURN_EXPANDERS.copy()
 
         print >> sys.stderr, "Looking for max_timestamp, max_peer... in %s" % filename,
 
         self.max_peer = 0
-        for (tstmp, lineno, clb, args) in self._parse_scenario(filename):
+        for (tstmp, lineno, clb, args, _) in self._parse_scenario(filename):
             max_tstmp = max(tstmp, max_tstmp)
 
         print >> sys.stderr, "\tfound %d and %d" % (max_tstmp, self.max_peer)
 
-        _max_peer = self.max_peer
+        # Peers are expanded in parallel, but the results are written in order as soon as they are available
+        pool = WorkerPool(processes)
+
         print >> sys.stderr, "Preprocessing file...",
-        for (tstmp, lineno, clb, args) in self._parse_scenario(filename):
+        for (tstmp, lineno, clb, args, _) in self._parse_scenario(filename):
 
             print >> outputfile, self.file_buffer[1][lineno - 1][1]
             if clb in self._callables:
-                for peer in self.yes_peers:
-                    for line in self._callables[clb](tstmp, max_tstmp, *args):
-                        print >> outputfile, line, '{%s}' % peer
+                peers = list(self.peerspec.peers(self.max_peer))
+                jobs = ((clb, tstmp, max_tstmp, args, lineno, chunk, seed) for chunk in pool.chunks(peers))
+                for lines in pool.imap(expand_churn, jobs):
+                    outputfile.write(lines)
+
+        pool.close()
         print >> sys.stderr, "\tdone"
 
     def _parse_for_this_peer(self, peerspec):
-        if peerspec:
-            self.yes_peers, self.no_peers = self._parse_peerspec(peerspec)
-            self.max_peer = max(self.max_peer, max(self.yes_peers))
-        else:
-            self.yes_peers = set()
-            self.no_peers = set()
-
-        if not self.yes_peers:
-            self.yes_peers = set(range(1, self.max_peer + 1))
-        for peer in self.no_peers:
-            self.yes_peers.discard(peer)
-
+        self.peerspec = self._parse_peerspec(peerspec)
+        self.max_peer = max(self.max_peer, self.peerspec.max_peer)
         return True
 
-    def churn(self, tstmp, max_tstmp, churn_type, desired_mean=300, min_online=5.0):
-        desired_mean = float(desired_mean)
-        min_online = float(min_online)
-
-        def get_delay(step):
-            if churn_type == 'expon':
-                return min_online + expovariate(1.0 / (desired_mean - min_online))
-            elif churn_type == 'fixed':
-                if step == 1:
-                    return randint(min_online, desired_mean)
-                return desired_mean
-            else:
-                raise NotImplementedError('only expon churn is implemented, got %s' % churn_type)
-
-        go_online = random() < 0.5
-        step = 1
-        while tstmp < max_tstmp:
-            yield "@0:%d %s" % (tstmp, "online" if go_online else "offline")
-            tstmp += get_delay(step)
-            go_online = not go_online
-            step += 1
-
-    def churn_pattern(self, tstmp, max_tstmp, pattern, min_online=5.0):
-        pattern = [online / 100.0 for online in map(float, pattern.split(','))]
-        min_online = float(min_online)
-
-        i = 0
-        prev_state = None
-        while tstmp < max_tstmp:
-            go_online = random() < pattern[i]
-            i = (i + 1) % len(pattern)
-
-            if go_online != prev_state:
-                yield "@0:%d %s" % (tstmp, "online" if go_online else "offline")
-                prev_state = go_online
-
-            tstmp += min_online
-
-
-def main(inputfile, outputfile, maxtime=0):
+
+def main(inputfile, outputfile, maxtime=0, seed=0, processes=None):
     inputfile = os.path.abspath(inputfile)
     if os.path.exists(inputfile):
         f = open(outputfile, 'w')
 
-        ScenarioPreProcessor(inputfile, f, maxtime)
+        ScenarioPreProcessor(inputfile, f, maxtime, seed, processes)
 
         f.close()
     else:
@@ -98,12 +136,16 @@ def main(inputfile, outputfile, maxtime=0):
 
 if __name__ == '__main__':
     if len(sys.argv) < 3:
-        print "Usage: %s <input-file> <output-file> (<max-time>)" % (sys.argv[0])
+        print "Usage: %s <input-file> <output-file> (<max-time>) (<seed>) (<processes>)" % (sys.argv[0])
         print >> sys.stderr, sys.argv
 
         exit(1)
 
-    if len(sys.argv) == 4:
+    if len(sys.argv) == 6:
+        main(sys.argv[1], sys.argv[2], float(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]))
+    elif len(sys.argv) == 5:
+        main(sys.argv[1], sys.argv[2], float(sys.argv[3]), int(sys.argv[4]))
+    elif len(sys.argv) == 4:
         main(sys.argv[1], sys.argv[2], float(sys.argv[3]))
     else:
         main(sys.argv[1], sys.argv[2])
@@ -42,26 +42,55 @@ import json
 import logging
 from collections import Iterable, defaultdict
 from os import chdir, environ, getpid, makedirs, path, symlink
-from random import random
 from sys import exit, stderr, stdout
 from time import time
 from traceback import print_exc
 
+from gumby.experiments.keypool import KeyPool
+from gumby.experiments.memberkeys import derive_member_key
 from gumby.log import setupLogging
-from gumby.scenario import ScenarioRunner
+from gumby.scenario import ScenarioCompiler, ScenarioRunner
 from gumby.sync import ExperimentClient, ExperimentClientFactory
 
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks
-from twisted.internet.task import deferLater
+from twisted.internet.task import Clock, deferLater
 from twisted.internet.threads import deferToThread
 
 
+# @CONF_OPTION SCENARIO_SINGLE_TIMER: Schedule the scenario actions with a single reactor timer instead of one per action, recommended for peers running thousands of actions. Dry runs always use it. (default is FALSE)
+SCENARIO_SINGLE_TIMER = environ.get("SCENARIO_SINGLE_TIMER", "FALSE").upper() == "TRUE"
+# @CONF_OPTION SCENARIO_ACTION_STATS: Record when each scenario action was scheduled, how late it started and how long it took into scenario-actions.log, next to statistics.log. (default is FALSE)
+SCENARIO_ACTION_STATS = environ.get("SCENARIO_ACTION_STATS", "FALSE").upper() == "TRUE"
+# @CONF_OPTION SCENARIO_DRY_RUN: Instead of running the experiment, run the scenario for this many peers in virtual time with stubbed actions and report how many actions each peer ran and when, to check a scenario before reserving nodes. (default is 0, disabled)
+SCENARIO_DRY_RUN = int(environ.get("SCENARIO_DRY_RUN", "0"))
+# @CONF_OPTION PEERS_PER_PROCESS: Amount of peers to run in every client process, each one with its own connection to the sync server and output directory. Running several peers per process saves the memory of the interpreter and the imports, but doesn't work for clients using a Tribler session. (default is 1)
+PEERS_PER_PROCESS = int(environ.get("PEERS_PER_PROCESS", "1"))
+# @CONF_OPTION MEMBER_KEY_SEED: Derive the member key of every peer from this seed and its peer id instead of publishing every peer's private key through the sync server. Makes the experiment's keys reproducible and the sync document a lot smaller. Only works with prime field member key curves. (default is disabled)
+MEMBER_KEY_SEED = environ.get("MEMBER_KEY_SEED", None)
+# @CONF_OPTION MEMBER_KEY_POOL: Key pool file (relative to the experiment dir) generated by generate_key_pool.py, every peer takes the key of its peer id from it instead of generating one and publishing it through the sync server. Takes precedence over MEMBER_KEY_SEED. (default is disabled)
+MEMBER_KEY_POOL = environ.get("MEMBER_KEY_POOL", None)
+
+# Amount of peers running in this process that haven't stopped yet, see main()
+_running_peers = 1
+
+
+def peer_stopped():
+    """
+    Stops the reactor once all the peers running in this process have stopped.
+    """
+    global _running_peers
+    _running_peers -= 1
+    if _running_peers <= 0:
+        reactor.stop()
+
+
 def buffer_online(func):
     def helper(*args, **kargs):
         args[0].buffer_call(func, args, kargs)
 
     helper.__name__ = func.__name__
+    helper.buffer_online = True
     return helper
 
 class DispersyExperimentScriptClient(ExperimentClient):
@@ -79,14 +108,31 @@ class DispersyExperimentScriptClient(ExperimentClient):
         self.community_kwargs = {}
         self._stats_file = None
         self._online_buffer = []
+        self.my_dir = None
+
+        # If the sync server distributes the scenario (see experiment_server.py) we get our actions from it.
+        self.expect_scenario = bool(environ.get('SYNC_SCENARIO_FILE'))
 
         self._crypto = self.initializeCrypto()
-        self.generateMyMember()
-        self.vars['private_keypair'] = base64.encodestring(self.my_member_private_key)
+        self._member_keys = {}
+        self._key_pool = None
+        # With a key seed or pool every peer can get our key once we have an id, so it doesn't need to be published
+        if not self.shares_member_keys:
+            self.generateMyMember()
+            self.vars['private_keypair'] = base64.encodestring(self.my_member_private_key)
 
     def onVarsSend(self):
         scenario_file_path = path.join(environ['EXPERIMENT_DIR'], self.scenario_file)
-        self.scenario_runner = ScenarioRunner(scenario_file_path)
+        self.scenario_runner = ScenarioRunner(scenario_file_path, single_timer=SCENARIO_SINGLE_TIMER)
+
+        # The sync server will send us our actions, no need to touch the scenario file.
+        if self.expect_scenario:
+            return
+
+        # A compiled scenario only needs our own block to be read once we know our ID
+        if self.scenario_runner.has_compiled_scenario():
+            self._logger.debug('Using compiled scenario file')
+            return
 
         t1 = time()
         self.scenario_runner._read_scenario(scenario_file_path)
@@ -94,6 +140,8 @@ class DispersyExperimentScriptClient(ExperimentClient):
 
     def onIdReceived(self):
         self._logger.debug('Got ID %s assigned', self.my_id)
+        if self.shares_member_keys:
+            self.generateMyMember()
         self.scenario_runner.set_peernumber(int(self.my_id))
         # TODO(emilon): Auto-register this stuff
         self.scenario_runner.register(self.echo)
@@ -112,29 +160,47 @@ class DispersyExperimentScriptClient(ExperimentClient):
         self.scenario_runner.register(self.reset_dispersy_statistics, 'reset_dispersy_statistics')
         self.scenario_runner.register(self.annotate)
         self.scenario_runner.register(self.peertype)
+        self.scenario_runner.register_barrier(self.barrier)
 
         self.registerCallbacks()
 
         t1 = time()
-        self.scenario_runner.parse_file()
+        if self.scenario_actions is not None:
+            self.scenario_runner.load_actions(self.scenario_actions)
+            self.scenario_actions = None
+        else:
+            self.scenario_runner.parse_file()
         self._logger.debug('Took %.2f to parse scenario file' , time() - t1)
 
+        # Barriers need the connection with the sync server after the experiment starts
+        self.keep_connected = self.scenario_runner.has_barriers()
+
     def startExperiment(self):
         self._logger.debug("Starting dispersy scenario experiment")
 
         # TODO(emilon): Move this to the right place
         # TODO(emilon): Do we want to have the .dbs in the output dirs or should they be dumped to /tmp?
-        my_dir = path.join(environ['OUTPUT_DIR'], self.my_id)
-        makedirs(my_dir)
-        chdir(my_dir)
-        self._stats_file = open("statistics.log", 'w')
+        self.my_dir = path.join(environ['OUTPUT_DIR'], self.my_id)
+        makedirs(self.my_dir)
+        # The working directory is shared by all the peers of this process
+        if PEERS_PER_PROCESS == 1:
+            chdir(self.my_dir)
+        self._stats_file = open(path.join(self.my_dir, "statistics.log"), 'w')
+        # How well our clock is synchronized with the others, the offset the start time was corrected with
+        self._stats_file.write('%.1f %s %s %s\n' % (time(), self.my_id, "clock_offset",
+                                                   json.dumps({"offset": self.time_offset,
+                                                               "uncertainty": self.clock_uncertainty,
+                                                               "rtt": self.clock_rtt})))
+        if SCENARIO_ACTION_STATS:
+            self.scenario_runner.set_action_log(open(path.join(self.my_dir, "scenario-actions.log"), 'w'))
+            reactor.addSystemEventTrigger('before', 'shutdown', self.scenario_runner.flush_action_log)
 
         # TODO(emilon): Fix me or kill me
         try:
             bootstrap_fn = path.join(environ['PROJECT_DIR'], 'tribler', 'bootstraptribler.txt')
             if not path.exists(bootstrap_fn):
                 bootstrap_fn = path.join(environ['PROJECT_DIR'], '..', 'bootstraptribler.txt')
-            symlink(bootstrap_fn, 'bootstraptribler.txt')
+            symlink(bootstrap_fn, path.join(self.my_dir, 'bootstraptribler.txt'))
         except OSError:
             pass
 
@@ -164,8 +230,16 @@ class DispersyExperimentScriptClient(ExperimentClient):
         # NID_secp160k1 signing took 0.04 verify took 0.04 totals 0.08
         return u"NID_secp160k1"
 
+    @property
+    def shares_member_keys(self):
+        # True if every peer can get the key of any other peer by its id (see get_private_keypair_by_id)
+        return bool(MEMBER_KEY_SEED or MEMBER_KEY_POOL)
+
     def generateMyMember(self):
-        ec = self._crypto.generate_key(self.my_member_key_curve)
+        if self.shares_member_keys:
+            ec = self.get_private_keypair_by_id(self.my_id)
+        else:
+            ec = self._crypto.generate_key(self.my_member_key_curve)
         self.my_member_key = self._crypto.key_to_bin(ec.pub())
         self.my_member_private_key = self._crypto.key_to_bin(ec)
     #
@@ -214,7 +288,7 @@ class DispersyExperimentScriptClient(ExperimentClient):
             from dispersy.endpoint import StandaloneEndpoint
             from dispersy.util import unhandled_error_observer
 
-        self._dispersy = Dispersy(StandaloneEndpoint(int(self.my_id) + 12000, '0.0.0.0'), u'.', self._database_file, self._crypto)
+        self._dispersy = Dispersy(StandaloneEndpoint(int(self.my_id) + 12000, '0.0.0.0'), unicode(self.my_dir), self._database_file, self._crypto)
         self._dispersy.statistics.enable_debug_statistics(True)
 
         self.original_on_incoming_packets = self._dispersy.on_incoming_packets
@@ -252,7 +326,7 @@ class DispersyExperimentScriptClient(ExperimentClient):
             reactor.callLater(1, self.stop, retry - 1)
         else:
             self._logger.debug("Dispersy exit status was: %s", self._dispersy_exit_status)
-            reactor.callLater(0, reactor.stop)
+            reactor.callLater(0, peer_stopped)
 
     def set_master_member(self, pub_key, priv_key=''):
         self.master_key = pub_key.decode("HEX")
@@ -329,28 +403,48 @@ class DispersyExperimentScriptClient(ExperimentClient):
     def peertype(self, peertype):
         self._stats_file.write('%.1f %s %s %s\n' % (time(), self.my_id, "peertype", peertype))
 
+    def barrier(self, name, quorum=None):
+        self._stats_file.write('%.1f %s %s %s\n' % (time(), self.my_id, "barrier", name))
+        return self.waitForBarrier(name, quorum)
+
     #
     # Aux. functions
     #
 
 
+    def _decode_keypair(self, key):
+        return self._crypto.key_from_private_bin(base64.decodestring(key))
+
+    def _open_key_pool(self):
+        key_pool = KeyPool(path.join(environ['EXPERIMENT_DIR'], MEMBER_KEY_POOL))
+        # Keys of the wrong kind would only make the crypto code fail later on
+        key_pool.check_keys(self._crypto, self.my_member_key_curve)
+        return key_pool
+
     def get_private_keypair_by_id(self, peer_id):
-        if str(peer_id) in self.all_vars:
-            key = self.all_vars[str(peer_id)]['private_keypair']
-            if isinstance(key, basestring):
-                key = self.all_vars[str(peer_id)]['private_keypair'] = self._crypto.key_from_private_bin(base64.decodestring(key))
-            return key
+        if not self.shares_member_keys:
+            return self.peers.get_decoded(peer_id, 'private_keypair', self._decode_keypair)
+
+        # Our own key is needed before we know who the other peers are
+        peer_id = str(peer_id)
+        if peer_id != self.my_id and peer_id not in self.peers:
+            return None
+        if peer_id not in self._member_keys:
+            if MEMBER_KEY_POOL:
+                if self._key_pool is None:
+                    self._key_pool = self._open_key_pool()
+                key = self._key_pool.get_key_bin(peer_id)
+            else:
+                key = derive_member_key(MEMBER_KEY_SEED, peer_id, self.my_member_key_curve)
+            self._member_keys[peer_id] = self._crypto.key_from_private_bin(key)
+        return self._member_keys[peer_id]
 
     def get_private_keypair(self, ip, port):
-        port = int(port)
-        for peer_dict in self.all_vars.itervalues():
-            if peer_dict['host'] == ip and int(peer_dict['port']) == port:
-                key = peer_dict['private_keypair']
-                if isinstance(key, basestring):
-                    key = peer_dict['private_keypair'] = self._crypto.key_from_private_bin(base64.decodestring(key))
-                return key
-
-        err("Could not get_private_keypair for", ip, port)
+        peer_id = self.peers.get_id(ip, port)
+        if peer_id is None:
+            self._logger.error("Could not get_private_keypair for %s:%s", ip, port)
+            return None
+        return self.get_private_keypair_by_id(peer_id)
 
     def str2bool(self, v):
         return v.lower() in ("yes", "true", "t", "1")
@@ -502,16 +596,150 @@ class DispersyExperimentScriptClient(ExperimentClient):
             yield deferLater(reactor, 5.0, lambda : None)
 
 
+class DryRunClientMixin():
+
+    """
+    Replaces everything of a DispersyExperimentScriptClient that needs Dispersy, the sync server or the file system
+    for a dry run. Going online and offline only toggles a fake community, so the online buffer behaves as usual.
+    """
+
+    def initializeCrypto(self):
+        return None
+
+    def generateMyMember(self):
+        self.my_member_key = self.my_member_private_key = "dry-run"
+
+    def start_dispersy(self, *args, **kargs):
+        pass
+
+    def stop_dispersy(self):
+        self._dispersy_exit_status = True
+
+    def online(self, dont_empty=False):
+        if self._community is None:
+            self._community = True
+            if not dont_empty:
+                self.empty_buffer()
+
+    def offline(self):
+        self._community = None
+
+    def stop(self, retry=3):
+        self.scenario_runner.stopped = True
+
+    def buffer_call(self, func, args, kargs):
+        DispersyExperimentScriptClient.buffer_call(self, self.scenario_runner.stub(func.__name__), args, kargs)
+
+
+class DryRunScenarioRunner(ScenarioRunner):
+
+    """
+    Scenario runner for dry runs, counts every action run by its virtual time and only really runs the ones
+    DryRunClientMixin emulates, the rest are stubbed. Actions decorated with buffer_online go through the online
+    buffer and are counted again as "ACTION (online)" when they would really run.
+    """
+    EMULATED_CALLABLES = ('online', 'offline', 'stop')
+
+    def __init__(self, filename, clock, counts, bucket_size):
+        # A Clock sorts all its calls every time one is added, so with a call per action the dry run of a big
+        # scenario would take hours
+        ScenarioRunner.__init__(self, filename, expstartstamp=0, single_timer=True, clock=clock)
+        self.counts = counts
+        self.bucket_size = bucket_size
+        self.stopped = False
+        self.ignored = 0
+
+    def register(self, clb, name=None):
+        if name is None:
+            name = clb.__name__
+        if not (name in self.EMULATED_CALLABLES or getattr(clb, 'buffer_online', False)):
+            clb = lambda *args, **kargs: None
+
+        def count(*args, **kargs):
+            if self.stopped:
+                self.ignored += 1
+                return
+            self.counts[(int(self._clock.seconds() // self.bucket_size), name)] += 1
+            return clb(*args, **kargs)
+
+        ScenarioRunner.register(self, count, name)
+
+    def stub(self, name):
+        """
+        Returns a callable that only records that the buffered action called name was run.
+        """
+        def stub(*args, **kargs):
+            self.counts[(int(self._clock.seconds() // self.bucket_size), name + ' (online)')] += 1
+        return stub
+
+
+def dry_run(client_class, peer_count, bucket_size=60, outputfile=stdout):
+    """
+    Runs the scenario of client_class for peer_count peers against a virtual clock and writes how many actions
+    each peer ran, how many actions were run in every bucket_size seconds and the actions that were still buffered
+    waiting for the peer to go online or scheduled after it stopped.
+    """
+    scenario_file_path = path.join(environ['EXPERIMENT_DIR'], client_class.scenario_file)
+
+    class DryRunClient(DryRunClientMixin, client_class):
+        pass
+
+    clock = Clock()
+
+    t1 = time()
+    compiler = ScenarioCompiler(scenario_file_path, peer_count)
+    compiler.parse()
+
+    clients = []
+    for peer in xrange(1, peer_count + 1):
+        client = DryRunClient({})
+        client.my_id = str(peer)
+        client.scenario_runner = DryRunScenarioRunner(scenario_file_path, clock, defaultdict(int), bucket_size)
+        client.scenario_actions = compiler.get_actions(peer)
+        client.onIdReceived()
+        client.scenario_runner.run()
+        clients.append(client)
+    t2 = time()
+
+    while clock.calls:
+        clock.advance(max(0, clock.calls[0].getTime() - clock.seconds()))
+
+    print >> outputfile, "# Dry run of %s for %d peers: %.2f seconds to set up, %.2f to run %d virtual seconds" % (
+        scenario_file_path, peer_count, t2 - t1, time() - t2, clock.seconds())
+
+    totals = defaultdict(int)
+    print >> outputfile, "# peer actions buffered ignored_after_stop"
+    for client in clients:
+        runner = client.scenario_runner
+        for key, count in runner.counts.iteritems():
+            totals[key] += count
+        print >> outputfile, client.my_id, sum(count for (_, name), count in runner.counts.iteritems()
+                                               if not name.endswith(' (online)')), \
+            len(client._online_buffer), runner.ignored
+
+    print >> outputfile, "# time action count"
+    for (bucket, name), count in sorted(totals.iteritems()):
+        print >> outputfile, bucket * bucket_size, name, count
+
+
 def main(client_class):
     from gumby.instrumentation import init_instrumentation
     init_instrumentation()
     setupLogging()
-    factory = ExperimentClientFactory({}, client_class)
+
+    if SCENARIO_DRY_RUN:
+        dry_run(client_class, SCENARIO_DRY_RUN)
+        exit(0)
+
+    global _running_peers
+    _running_peers = PEERS_PER_PROCESS
+
     logger = logging.getLogger()
-    logger.debug("Connecting to: %s:%s", environ['SYNC_HOST'], int(environ['SYNC_PORT']))
-    # Wait for a random amount of time before connecting to try to not overload the server when we have a lot of connections
-    reactor.callLater(random() * 10,
-                      lambda: reactor.connectTCP(environ['SYNC_HOST'], int(environ['SYNC_PORT']), factory))
+    logger.debug("Connecting %d peer(s) to: %s:%s", PEERS_PER_PROCESS, environ['SYNC_HOST'], int(environ['SYNC_PORT']))
+    for _ in xrange(PEERS_PER_PROCESS):
+        factory = ExperimentClientFactory({}, client_class)
+        # The server tells us when to come back if too many of us connect at once (see SYNC_CONNECT_RATE)
+        reactor.connectTCP(environ['SYNC_HOST'], int(environ['SYNC_PORT']), factory)
     reactor.exitCode = 0
     reactor.run()
     exit(reactor.exitCode)
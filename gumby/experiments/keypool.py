@@ -0,0 +1,185 @@
+# keypool.py ---
+#
+# Filename: keypool.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 12:27:05 2026 (+0200)
+
+# Commentary:
+#
+# Pre-generated Dispersy member key pools.
+#
+# Generating a member key at the start of every client is slow for some crypto classes (Elgamal) and makes every
+# node spike its CPU at the same time. A key pool file holds N private keys (as returned by key_to_bin()) generated
+# beforehand by scripts/generate_key_pool.py, and peer N takes key N, so the keys of an experiment are also the same
+# from one run to the next.
+#
+# Pools are cached in KEY_POOL_DIR (default ~/.cache/gumby/keys) by crypto class and curve, and only extended when
+# an experiment needs more keys than the cached pool has.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import logging
+from os import environ, makedirs, path
+
+from gumby.indexedfile import IndexedFile, write_indexed_file
+from gumby.workerpool import WorkerPool
+
+DEFAULT_CRYPTO = "dispersy.crypto.ECCrypto"
+DEFAULT_CURVE = u"NID_secp160k1"
+
+# Key pools are indexed files (see gumby/indexedfile.py) with a header holding the crypto class and the curve of the
+# keys, and a block with the private key (as returned by key_to_bin()) of every peer, block 0 holding the key of
+# peer 1.
+_POOL_MAGIC = 'GKEY'
+_POOL_VERSION = 2
+
+
+def get_key_pool_dir():
+    return environ.get('KEY_POOL_DIR', path.join(path.expanduser('~'), '.cache', 'gumby', 'keys'))
+
+
+def get_key_pool_path(crypto=DEFAULT_CRYPTO, curve=DEFAULT_CURVE):
+    return path.join(get_key_pool_dir(), "%s-%s.keys" % (crypto.rsplit('.', 1)[-1], curve))
+
+
+def load_crypto(crypto):
+    """
+    Returns an instance of the crypto class with the given dotted name. Dispersy classes are looked up in the Tribler
+    tree first, like the clients do.
+    """
+    module_name, class_name = crypto.rsplit('.', 1)
+    candidates = [module_name]
+    if module_name.startswith('dispersy.'):
+        candidates.insert(0, 'Tribler.' + module_name)
+
+    for candidate in candidates:
+        try:
+            module = __import__(candidate, fromlist=[class_name])
+        except ImportError:
+            if candidate == candidates[-1]:
+                raise
+        else:
+            return getattr(module, class_name)()
+
+
+def _generate_keys(job):
+    crypto, curve, count = job
+    crypto = load_crypto(crypto)
+    return [crypto.key_to_bin(crypto.generate_key(curve)) for _ in xrange(count)]
+
+
+class KeyPool(object):
+
+    """
+    Read access to a key pool file, only reading the index and the keys that are asked for.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            self._file = IndexedFile(filename, _POOL_MAGIC, _POOL_VERSION)
+        except ValueError:
+            raise ValueError("%s is not a key pool this version can read" % filename)
+
+        self.crypto = self._file.header['crypto']
+        self.curve = self._file.header['curve']
+
+    def __len__(self):
+        return len(self._file)
+
+    def check_keys(self, crypto, curve):
+        """
+        Raises ValueError if the pool doesn't hold curve keys that crypto can load. crypto is either a crypto object
+        or the dotted name of a crypto class.
+        """
+        if isinstance(crypto, basestring):
+            crypto_names = [crypto.rsplit('.', 1)[-1]]
+        else:
+            # Subclasses (such as NoCrypto) load the keys of their base classes just fine
+            crypto_names = [cls.__name__ for cls in type(crypto).__mro__]
+
+        if self.crypto.rsplit('.', 1)[-1] not in crypto_names or self.curve != curve:
+            raise ValueError("%s holds %s %s keys, not %s %s ones" % (self.filename, self.crypto, self.curve,
+                                                                      crypto_names[0], curve))
+
+    def get_key_bin(self, peer_id):
+        """
+        Returns the private key of peer_id (counting from 1), as returned by key_to_bin().
+        """
+        peer_id = int(peer_id)
+        if not 0 < peer_id <= len(self):
+            raise IndexError("%s only has keys for %d peers, not for peer %d" % (self.filename, len(self), peer_id))
+        return self._file.read_blocks([peer_id - 1])[0]
+
+    def get_key_bins(self):
+        return self._file.read_all_blocks()
+
+
+def write_key_pool(filename, crypto, curve, keys):
+    write_indexed_file(filename, _POOL_MAGIC, _POOL_VERSION, {'crypto': crypto, 'curve': curve}, keys)
+
+
+def generate_key_pool(count, crypto=DEFAULT_CRYPTO, curve=DEFAULT_CURVE, filename=None, processes=None):
+    """
+    Makes sure filename (by default the cached pool of crypto and curve) holds at least count keys, generating the
+    missing ones over processes worker processes. Returns the name of the pool file.
+    """
+    logger = logging.getLogger("KeyPool")
+    if filename is None:
+        filename = get_key_pool_path(crypto, curve)
+        if not path.isdir(path.dirname(filename)):
+            makedirs(path.dirname(filename))
+
+    keys = []
+    if path.exists(filename):
+        try:
+            pool = KeyPool(filename)
+        except ValueError as e:
+            # Written by an older version, start over
+            logger.warning("%s, generating it again", e)
+        else:
+            pool.check_keys(crypto, curve)
+            if len(pool) >= count:
+                logger.info("%s already has %d keys", filename, len(pool))
+                return filename
+            keys = pool.get_key_bins()
+
+    missing = count - len(keys)
+    logger.info("Generating %d %s %s keys for %s", missing, crypto, curve, filename)
+
+    pool = WorkerPool(processes)
+    jobs = ((crypto, curve, len(chunk)) for chunk in pool.chunks(range(missing)))
+    for chunk in pool.imap(_generate_keys, jobs):
+        keys.extend(chunk)
+    pool.close()
+
+    write_key_pool(filename, crypto, curve, keys)
+    return filename
+
+#
+# keypool.py ends here
@@ -0,0 +1,143 @@
+# memberkeys.py ---
+#
+# Filename: memberkeys.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 11:02:41 2026 (+0200)
+
+# Commentary:
+#
+# Deterministic Dispersy member keys.
+#
+# Instead of every peer generating a random key and publishing its private part through the sync server
+# (so every peer downloads every other peer's private key), all the peers of an experiment can derive the
+# key of any of them from an experiment seed and its peer id:
+#
+#   private number = SHA256(seed || ":" || peer id) mod (curve order - 1) + 1
+#
+# The key is returned in the DER format key_from_private_bin() expects, the same one key_to_bin() writes
+# for an EC private key (RFC 5915, with the named curve and the public point), so it can be loaded by any
+# crypto class that loads M2Crypto EC keys. Only prime field curves are supported.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from hashlib import sha256
+
+# Curve name: (DER encoded OID, p, a, b, Gx, Gy, order)
+CURVES = {
+    u"NID_secp160k1": ("\x06\x05\x2b\x81\x04\x00\x09",
+                       0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFAC73,
+                       0,
+                       7,
+                       0x3B4C382CE37AA192A4019E763036F4F5DD4D7EBB,
+                       0x938CF935318FDCED6BC28286531733C3F03C4FEE,
+                       0x0100000000000000000001B8FA16DFAB9ACA16B6B3),
+    u"NID_secp256k1": ("\x06\x05\x2b\x81\x04\x00\x0a",
+                       0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F,
+                       0,
+                       7,
+                       0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+                       0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8,
+                       0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141),
+}
+
+
+def _point_add(curve, P, Q):
+    _, p, a, _, _, _, _ = curve
+    if P is None:
+        return Q
+    if Q is None:
+        return P
+    if P[0] == Q[0]:
+        if (P[1] + Q[1]) % p == 0:
+            return None
+        l = (3 * P[0] * P[0] + a) * pow(2 * P[1], p - 2, p) % p
+    else:
+        l = (Q[1] - P[1]) * pow(Q[0] - P[0], p - 2, p) % p
+    x = (l * l - P[0] - Q[0]) % p
+    return x, (l * (P[0] - x) - P[1]) % p
+
+
+def _point_mul(curve, k):
+    result = None
+    addend = (curve[4], curve[5])
+    while k:
+        if k & 1:
+            result = _point_add(curve, result, addend)
+        addend = _point_add(curve, addend, addend)
+        k >>= 1
+    return result
+
+
+def _int_to_bytes(value, length):
+    return ("%0*x" % (length * 2, value)).decode("HEX")
+
+
+def _der(tag, content):
+    length = len(content)
+    if length < 0x80:
+        return chr(tag) + chr(length) + content
+    encoded_length = _int_to_bytes(length, (length.bit_length() + 7) // 8)
+    return chr(tag) + chr(0x80 | len(encoded_length)) + encoded_length + content
+
+
+def get_curve(curve_name):
+    """
+    Returns the parameters of curve_name from CURVES, raises ValueError if it isn't supported.
+    """
+    try:
+        return CURVES[curve_name]
+    except KeyError:
+        raise ValueError("Can't derive %s member keys, only %s are supported" %
+                         (curve_name, ", ".join(sorted(CURVES))))
+
+
+def derive_private_number(seed, peer_id, curve_name=u"NID_secp160k1"):
+    order = get_curve(curve_name)[6]
+    digest = sha256("%s:%s" % (seed, peer_id)).hexdigest()
+    return long(digest, 16) % (order - 1) + 1
+
+
+def derive_member_key(seed, peer_id, curve_name=u"NID_secp160k1"):
+    """
+    Returns the private key of peer_id for the experiment seed, as the DER string key_to_bin() would return.
+    Raises ValueError if the curve is not supported.
+    """
+    curve = get_curve(curve_name)
+    oid, p, _, _, _, _, order = curve
+    private_number = derive_private_number(seed, peer_id, curve_name)
+    x, y = _point_mul(curve, private_number)
+
+    field_length = (p.bit_length() + 7) // 8
+    public_point = "\x04" + _int_to_bytes(x, field_length) + _int_to_bytes(y, field_length)
+    return _der(0x30, _der(0x02, "\x01") +
+                _der(0x04, _int_to_bytes(private_number, (order.bit_length() + 7) // 8)) +
+                _der(0xa0, oid) +
+                _der(0xa1, _der(0x03, "\x00" + public_point)))
+
+#
+# memberkeys.py ends here
@@ -0,0 +1,125 @@
+# indexedfile.py ---
+#
+# Filename: indexedfile.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Mon Oct 19 12:08:44 2026 (+0200)
+
+# Commentary:
+#
+# Binary container for data that is written once and of which readers only need a few pieces, such as the compiled
+# scenarios (one block of actions per peer, see gumby/scenario.py) and the member key pools (one key per peer, see
+# gumby/experiments/keypool.py):
+#
+#   preamble: magic, format version, header length, amount of blocks
+#   header:   marshalled header, describing the contents
+#   index:    (offset, length) of every block, offsets counting from the end of the index
+#   blocks:   the data of every block
+#
+# Every kind of file has its own magic and format version.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import marshal
+from os import rename
+from struct import Struct
+
+_PREAMBLE = Struct('<4sBII')
+_INDEX_ENTRY = Struct('<QQ')
+
+
+def write_indexed_file(filename, magic, version, header, blocks):
+    """
+    Writes header (anything marshal can dump) and blocks (a list of strings) to filename. It's written to a
+    temporary file first, so readers never see a half written one.
+    """
+    header = marshal.dumps(header)
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(_PREAMBLE.pack(magic, version, len(header), len(blocks)))
+        f.write(header)
+
+        offset = 0
+        for block in blocks:
+            f.write(_INDEX_ENTRY.pack(offset, len(block)))
+            offset += len(block)
+        for block in blocks:
+            f.write(block)
+    rename(tmp_filename, filename)
+
+
+class IndexedFile(object):
+
+    """
+    Read access to a file written by write_indexed_file(), only reading the index entries and blocks that are asked
+    for. Raises ValueError if the file doesn't have the given magic and format version.
+    """
+
+    def __init__(self, filename, magic, version):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            preamble = f.read(_PREAMBLE.size)
+            if len(preamble) < _PREAMBLE.size:
+                raise ValueError("%s is truncated" % filename)
+
+            file_magic, file_version, header_length, self.block_count = _PREAMBLE.unpack(preamble)
+            if file_magic != magic or file_version != version:
+                raise ValueError("%s is not a version %d %s file" % (filename, version, magic))
+
+            self.header = marshal.loads(f.read(header_length))
+            self._index_start = f.tell()
+        self._data_start = self._index_start + _INDEX_ENTRY.size * self.block_count
+
+    def __len__(self):
+        return self.block_count
+
+    def read_blocks(self, blocks):
+        """
+        Returns the data of the given blocks (numbered from 0), in the order they were asked for.
+        """
+        data = []
+        with open(self.filename, 'rb') as f:
+            for block in blocks:
+                if not 0 <= block < self.block_count:
+                    raise IndexError("%s only has %d blocks, not block %d" % (self.filename, self.block_count, block))
+
+                f.seek(self._index_start + _INDEX_ENTRY.size * block)
+                offset, length = _INDEX_ENTRY.unpack(f.read(_INDEX_ENTRY.size))
+                f.seek(self._data_start + offset)
+                data.append(f.read(length))
+        return data
+
+    def read_all_blocks(self):
+        with open(self.filename, 'rb') as f:
+            f.seek(self._index_start)
+            index = [_INDEX_ENTRY.unpack(f.read(_INDEX_ENTRY.size)) for _ in xrange(self.block_count)]
+            # The blocks are written in index order
+            return [f.read(length) for _, length in index]
+
+#
+# indexedfile.py ends here
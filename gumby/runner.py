@@ -37,7 +37,7 @@
 
 # Code:
 
-from os import path, chdir, environ, makedirs
+from os import path, chdir, environ, makedirs, walk
 from shutil import rmtree
 import logging
 import sys
@@ -45,10 +45,13 @@ import sys
 from twisted.internet import reactor
 from twisted.internet.defer import Deferred, setDebugging, gatherResults, succeed
 from twisted.internet.protocol import ProcessProtocol
+from twisted.python.failure import Failure
 
 
 from .settings import configToEnv, loadConfig
 from .sshclient import runRemoteCMD
+from .stages import LineProbe, StageScheduler, waitForPort
+from .trace import LOCAL_HOST, TRACE_SUFFIX, tracer
 setDebugging(True)
 
 
@@ -69,7 +72,7 @@ class ExperimentRunner():
     def logPrefix(self):
         return "ExperimentRunner"
 
-    def copyWorkspaceToHeadNodes(self):
+    def copyWorkspaceToHeadNodes(self, hosts=None):
         self._logger.info("Syncing workspaces on remote head nodes...")
 
         def onCopySuccess(ignored):
@@ -86,7 +89,7 @@ class ExperimentRunner():
         copy_list = []
 
         # First, we need to copy the stuff to the das4 clusters we want to use to run the experiment
-        for host in self._cfg['head_nodes']:
+        for host in hosts or self._cfg['head_nodes']:
             pp = OneShotProcessProtocol("Rsync to remote %s" % host)
             workspace_dir = self._cfg['workspace_dir']
             args = ("/usr/bin/rsync", "-az", "--recursive", "--exclude=.git*",
@@ -197,40 +200,36 @@ class ExperimentRunner():
         else:
             return succeed(None)
 
-    def runRemoteSetup(self):
+    def runRemoteSetup(self, hosts=None):
         def onSetupSuccess(ignored):
             self._logger.info("Remote setup successful!")
 
         def onSetupFailure(failure):
             return failure
         if self._cfg['remote_setup_cmd']:
-            d = self.runCommandOnAllRemotes(self._cfg['remote_setup_cmd'])
+            d = self.runCommandOnAllRemotes(self._cfg['remote_setup_cmd'], hosts=hosts)
             d.addCallbacks(onSetupSuccess, onSetupFailure)
             return d
         else:
             return succeed(None)
 
-    def runSetupScripts(self):
-        self._logger.info("Running local and remote setup scripts")
-        return gatherResults((self.runRemoteSetup(), self.runLocalSetup()), consumeErrors=True)
-
-    def runCommand(self, command, remote=False):
+    def runCommand(self, command, remote=False, line_callback=None):
         if remote:
             self._logger.info("Remotely running command %s", command)
-            return self.runCommandOnAllRemotes(command)
+            return self.runCommandOnAllRemotes(command, line_callback)
         else:
             self._logger.info("Locally running command %s", command)
-            return self.runLocalCommand(command)
+            return self.runLocalCommand(command, line_callback)
 
-    def runLocalCommand(self, command):
+    def runLocalCommand(self, command, line_callback=None):
         # use the local _env_runner
         env_runner = path.abspath(path.join(path.dirname(__file__), "..", self._env_runner))
         args = [env_runner, self._cfg_path, command]
-        pp = OneShotProcessProtocol(command)
+        pp = OneShotProcessProtocol(command, line_callback=line_callback)
         reactor.spawnProcess(pp, env_runner, args, env=self.local_env)  # Inherit env from parent + conf vars
         return pp.getDeferred()
 
-    def runCommandOnAllRemotes(self, command):
+    def runCommandOnAllRemotes(self, command, line_callback=None, hosts=None):
         remote_instance_list = []
         # TODO: Allow for other venv dirs to be used by setting the path in the config file.
         # use remote _env_runner
@@ -239,11 +238,56 @@ class ExperimentRunner():
         else:
             python = "python"
         args = " ".join((python, path.join(self._remote_workspace_dir, 'gumby', self._env_runner), " ", self._cfg_path, " ", command))
-        for host in self._cfg['head_nodes']:
+        for host in hosts or self._cfg['head_nodes']:
             self._logger.info("Executing command in %s: %s", host, args)
-            remote_instance_list.append(runRemoteCMD(host, args))
+            remote_instance_list.append(runRemoteCMD(host, args, line_callback))
         return gatherResults(remote_instance_list, consumeErrors=True)
 
+    def startBackgroundCommand(self, name, command, remote, ready_line, ready_port):
+        """
+        Starts a command that keeps running during the experiment (the tracker, the experiment server) and returns a
+        Deferred that fires once it's ready to be used: when it prints ready_line, when ready_port accepts
+        connections (on the first head node if it runs remotely) or, if neither is given, after a second. Returns the
+        Deferred of the command and the readiness one.
+        """
+        if ready_line:
+            probe = LineProbe(ready_line)
+            ready_d = probe.ready
+        else:
+            probe = None
+            ready_d = Deferred()
+
+        command_d = self.runCommand(command, remote, probe)
+
+        def fireReady(result=None):
+            # Whatever happens first: ready, exited, timed out
+            if not ready_d.called:
+                ready_d.callback(result)
+
+        def onExitedBeforeReady(result):
+            fireReady(Failure(RuntimeError("%s exited before being ready" % name)))
+            return result
+        command_d.addBoth(onExitedBeforeReady)
+
+        ready_timeout = self._cfg.as_float('stage_ready_timeout')
+        if ready_port and not ready_line:
+            host = self._cfg['head_nodes'][0].split('@')[-1].split(':')[0] if remote else "127.0.0.1"
+            self._logger.info("Waiting for %s to listen on %s:%d", name, host, ready_port)
+            waitForPort(host, ready_port, ready_timeout).addBoth(fireReady)
+        elif not ready_line:
+            reactor.callLater(1, fireReady)
+
+        timeout = reactor.callLater(ready_timeout, fireReady,
+                                    Failure(RuntimeError("%s wasn't ready after %.1f secs" % (name, ready_timeout))))
+
+        def cancelTimeout(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+        ready_d.addBoth(cancelTimeout)
+
+        return command_d, ready_d
+
     def startTracker(self):
         def onTrackerFailure(failure):
             self._logger.error("Tracker has exited with status: %s", failure.getErrorMessage())
@@ -252,10 +296,10 @@ class ExperimentRunner():
             reactor.stop()
 
         if self._cfg['tracker_cmd']:
-            self._tracker_d = self.runCommand(self._cfg['tracker_cmd'], self._cfg.as_bool('tracker_run_remote'))
+            self._tracker_d, d = self.startBackgroundCommand("tracker", self._cfg['tracker_cmd'],
+                                                             self._cfg.as_bool('tracker_run_remote'),
+                                                             self._cfg['tracker_ready_line'], None)
             self._tracker_d.addErrback(onTrackerFailure)
-            d = Deferred()
-            reactor.callLater(1, d.callback, None)
             return d
         else:
             return succeed(None)
@@ -271,10 +315,14 @@ class ExperimentRunner():
             # TODO: This is not very flexible, refactor it to have a background_commands
             # list instead of experiment_server_cmd, tracker_cmd, etc...
             # Only run it on the DAS head node if we aren't using systemtap.
-            self._config_server_d = self.runCommand(self._cfg['experiment_server_cmd'], self._cfg.as_bool('experiment_server_run_remote'))
+            # The sync port is not probed unless asked for: whatever listens on it has to tell probes apart from
+            # its subscribers
+            self._config_server_d, d = self.startBackgroundCommand("experiment server",
+                                                                   self._cfg['experiment_server_cmd'],
+                                                                   self._cfg.as_bool('experiment_server_run_remote'),
+                                                                   self._cfg['experiment_server_ready_line'],
+                                                                   self._cfg['experiment_server_ready_port'])
             self._config_server_d.addErrback(onConfigServerDied)
-            d = Deferred()
-            reactor.callLater(1, d.callback, None)
             return d
         else:
             return succeed(None)
@@ -296,6 +344,18 @@ class ExperimentRunner():
             dl = succeed(None)
         return gatherResults([dr, dl], consumeErrors=True).addErrback(onStartInstancesFailed)
 
+    def mergeTraces(self):
+        """
+        Adds the traces written by the experiment processes (see gumby.trace), collected from the head nodes, to
+        the timeline of the run.
+        """
+        for dirpath, _, filenames in walk(self._output_dir):
+            for filename in filenames:
+                filename = path.join(dirpath, filename)
+                if filename.endswith(TRACE_SUFFIX) and filename != tracer.filename:
+                    self._logger.info("Merging trace %s", filename)
+                    tracer.merge(filename)
+
     def runPostProcess(self):
         if self._cfg['post_process_cmd']:
             self._logger.info("Post processing collected data")
@@ -328,36 +388,47 @@ class ExperimentRunner():
         if path.exists(self._output_dir):
             rmtree(self._output_dir)
 
-        # Step 3:
-        # Sync the working dir with the head nodes
-        d = Deferred()
-        d.addCallback(lambda _: self.copyWorkspaceToHeadNodes())
-
-        # Step 4:
-        # Run the set up script, both locally and in the head nodes
-        d.addCallback(lambda _: self.runSetupScripts())
-
-        # Step 5:
-        # Start the tracker, either locally or on the first head node of the list.
-        d.addCallback(lambda _: self.startTracker())
-
-        # Step 6:
-        # Start the config server, always locally if running instances locally as the head nodes are firewalled and
-        # can only be reached from the outside trough SSH.
-        d.addCallback(lambda _: self.startExperimentServer())
+        if self._cfg['trace_file']:
+            tracer.enable(path.abspath(path.join(self._workspace_dir, self._cfg['trace_file'])))
 
-        # Step 7:
-        # Spawn both local and remote instance runner scripts, which will connect to the config server and wait for all
-        # of them to be ready before starting the experiment.
-        d.addCallback(lambda _: self.startInstances())
-
-        # Step 8:
-        # Collect all the data from the remote head nodes.
-        d.addCallback(lambda _: self.collectOutputFromHeadNodes())
+        # Step 3:
+        # Run the rest of the stages as soon as the ones they depend on are done:
+        #  - Sync the working dir with every head node.
+        #  - Run the set up script, both locally and in every head node as soon as it's synced.
+        #  - Start the tracker, either locally or on the first head node of the list, once the set up script of
+        #    wherever it runs is done.
+        #  - Start the config server, always locally if running instances locally as the head nodes are firewalled
+        #    and can only be reached from the outside trough SSH. Same as the tracker.
+        #  - Spawn both local and remote instance runner scripts, which will connect to the config server and wait
+        #    for all of them to be ready before starting the experiment.
+        #  - Collect all the data from the remote head nodes.
+        #  - Extract the data and graph stuff.
+        setup_stage = lambda remote: 'remote_setup' if remote else 'local_setup'
+        self._scheduler = scheduler = StageScheduler()
+        scheduler.addStage('local_setup', self.runLocalSetup)
+        for host in self._cfg['head_nodes']:
+            scheduler.addStage('rsync ' + host, lambda host=host: self.copyWorkspaceToHeadNodes([host]))
+            scheduler.addStage('remote_setup ' + host, lambda host=host: self.runRemoteSetup([host]), ('rsync ' + host,))
+        scheduler.addStage('remote_setup', lambda: None,
+                           ['remote_setup ' + host for host in self._cfg['head_nodes']])
+        scheduler.addStage('tracker', self.startTracker,
+                           (setup_stage(self._cfg.as_bool('tracker_run_remote')),))
+        scheduler.addStage('experiment_server', self.startExperimentServer,
+                           (setup_stage(self._cfg.as_bool('experiment_server_run_remote')),))
+        scheduler.addStage('instances', self.startInstances,
+                           ('local_setup', 'remote_setup', 'tracker', 'experiment_server'))
+        scheduler.addStage('collect', self.collectOutputFromHeadNodes, ('instances',))
+        scheduler.addStage('post_process', self.runPostProcess, ('collect',))
+
+        def logStageSummary(result):
+            scheduler.logSummary()
+            if tracer.enabled:
+                self.mergeTraces()
+            return result
 
-        # Step 9:
-        # Extract the data and graph stuff
-        d.addCallback(lambda _: self.runPostProcess())
+        d = Deferred()
+        d.addCallback(lambda _: scheduler.run())
+        d.addBoth(logStageSummary)
 
         # TODO: From here onwards
         reactor.callLater(0, d.callback, None)
@@ -372,14 +443,22 @@ class OneShotProcessProtocol(ProcessProtocol):
         self._logger = logging.getLogger(self.__class__.__name__)
 
         self.command = command
+        # Called with every line of output of the process
+        self.line_callback = w.get('line_callback')
         self._stdout_bytes = ''
         self._stderr_bytes = ''
         self._d = Deferred()
+        self._span = None
+
+    def connectionMade(self):
+        self._span = tracer.span(LOCAL_HOST, self.command, self.command)
 
     def processExited(self, reason):
         # TODO(emilon): Process self._stdout_bytes, _sterr_bytes before exiting, to make sure no output is lost.
         # self._logger.info('CMD "%s" Process exited with reason: %s', self.command, reason)
         self._logger.info('[%s] exit code %s', self.command, reason.value.exitCode)
+        if self._span:
+            self._span.end(exit_code=reason.value.exitCode)
         if reason.value.exitCode:
             self._d.errback(reason)
         else:
@@ -393,6 +472,8 @@ class OneShotProcessProtocol(ProcessProtocol):
             if line.endswith('\n'):
                 self._logger.info('[%s] OUT: %s', self.command[:20].strip() + "..." if len(self.command) >20 else "",
                                   line.rstrip())
+                if self.line_callback:
+                    self.line_callback(line.rstrip())
             else:
                 # It's a partial line (part of the last one), save it to the buffer instead
                 remainder = line
@@ -405,6 +486,8 @@ class OneShotProcessProtocol(ProcessProtocol):
             if line.endswith('\n'):
                 self._logger.info('[%s] ERR: %s', self.command[:20].strip() + "..." if len(self.command) >20 else "",
                                   line.rstrip())
+                if self.line_callback:
+                    self.line_callback(line.rstrip())
             else:
                 # It's a partial line (part of the last one), save it to the buffer instead
                 remainder = line
@@ -18,6 +18,10 @@
 #     s = ScenarioRunner("./scenario", int(t.peerid))
 #     s.register(t.test_method)
 #     s.run()
+#
+# Big scenarios can be compiled beforehand with ScenarioCompiler (see
+# scripts/compile_scenario.py), ScenarioRunner will then load only the actions
+# of its own peer from the compiled file as long as it is up to date.
 
 # Change Log:
 #
@@ -46,15 +50,144 @@
 """Parses and runs scenarios."""
 
 import logging
+import marshal
+from bisect import bisect_left, bisect_right
 import shlex
 import sys
+from collections import defaultdict
 from itertools import ifilter
-from os import environ
+from operator import itemgetter
+from os import environ, path, stat
 from re import compile as re_compile
 from threading import RLock
 from time import time
 
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.task import LoopingCall
+
+from gumby.indexedfile import IndexedFile, write_indexed_file
+
+
+COMPILED_SCENARIO_SUFFIX = '.compiled'
+
+# Compiled scenarios are indexed files (see gumby/indexedfile.py):
+#   header:   dict describing the source file, the substituted $VARIABLES and the amount of peers
+#   blocks:   marshalled lists of (TIMESTAMP, LINENO, CALLABLE, ARGS, REPEAT) tuples sorted by LINENO, one per peer,
+#             block 0 holds the actions shared by all peers
+_COMPILED_MAGIC = 'GSCN'
+_COMPILED_VERSION = 3
+
+
+def get_compiled_scenario_path(filename):
+    return filename + COMPILED_SCENARIO_SUFFIX
+
+
+class PeerSpec(object):
+
+    """
+    Compiled peer specification.
+
+    Holds the peer numbers of a PEERSPEC as sorted, merged [low, high] intervals, so checking if a peer matches
+    costs O(log k) for k intervals instead of materializing every peer number in a set. Use parse_peerspec() to get
+    one, as they are cached by their string representation.
+    """
+
+    def __init__(self, peerspec):
+        self.negated = peerspec.startswith('!')
+        if self.negated:
+            peerspec = peerspec[1:]
+
+        intervals = []
+        for peer in peerspec.split(","):
+            peer = peer.strip()
+            if peer:
+                # parse the peer number (or peer number pair)
+                if "-" in peer:
+                    low, high = peer.split("-")
+                    low, high = int(low), int(high)
+                else:
+                    low = high = int(peer)
+                if low <= high:
+                    intervals.append((low, high))
+        intervals.sort()
+
+        self._lows = []
+        self._highs = []
+        for low, high in intervals:
+            if self._highs and low <= self._highs[-1] + 1:
+                self._highs[-1] = max(self._highs[-1], high)
+            else:
+                self._lows.append(low)
+                self._highs.append(high)
+
+    @property
+    def max_peer(self):
+        """
+        The highest peer number listed in this spec, 0 if none is.
+        """
+        return self._highs[-1] if self._highs else 0
+
+    def __nonzero__(self):
+        return bool(self._lows)
+
+    def __len__(self):
+        return sum(high - low + 1 for low, high in zip(self._lows, self._highs))
+
+    def __contains__(self, peer):
+        """
+        Returns True if peer is listed in this spec (regardless of it being negated or not).
+        """
+        i = bisect_right(self._lows, peer) - 1
+        return i >= 0 and peer <= self._highs[i]
+
+    def __iter__(self):
+        """
+        Iterates over the listed peer numbers in ascending order.
+        """
+        for low, high in zip(self._lows, self._highs):
+            for peer in xrange(low, high + 1):
+                yield peer
+
+    def matches(self, peer):
+        """
+        Checks if this spec applies to the given peer number. An empty spec matches everything.
+        """
+        if not self._lows:
+            return True
+        return (peer in self) != self.negated
+
+    def peers(self, peer_count):
+        """
+        Iterates over the peer numbers in [1, peer_count] this spec applies to.
+        """
+        if self._lows and not self.negated:
+            for peer in self:
+                if peer > peer_count:
+                    break
+                yield peer
+        else:
+            next_peer = 1
+            for low, high in zip(self._lows, self._highs):
+                for peer in xrange(next_peer, min(low, peer_count + 1)):
+                    yield peer
+                next_peer = max(next_peer, high + 1)
+            for peer in xrange(next_peer, peer_count + 1):
+                yield peer
+
+
+_peerspec_cache = {}
+
+
+def parse_peerspec(peerspec):
+    """
+    Returns the (cached) PeerSpec for a peer specification string.
+    """
+    try:
+        return _peerspec_cache[peerspec]
+    except KeyError:
+        compiled = _peerspec_cache[peerspec] = PeerSpec(peerspec)
+        return compiled
 
 
 class ScenarioParser():
@@ -62,9 +195,12 @@ class ScenarioParser():
     Scenario line format:
         TIMESPEC CALLABLE [ARGS] [PEERSPEC]
 
-        TIMESPEC = [@][H:]M:S[-[H:]M:S]
+        TIMESPEC = [@][H:]M:S[-[H:]M:S/[H:]M:S]
 
             Use @ to schedule events based on the synchronized experiment starting timestamp.
+            BEGIN-END/INTERVAL repeats the event every INTERVAL from BEGIN up to
+            (and including) END, e.g. "@0:10-1:0:0/30" runs it every 30 seconds
+            during the first hour starting at 0:10.
 
         CALLABLE = string
 
@@ -75,6 +211,12 @@ class ScenarioParser():
             Each arg of the callable as a string. The callable should handle
             conversions to the proper type.
 
+            An arg can contain %{EXPR} templates, which are expanded right
+            before the event runs by evaluating EXPR, a python expression that
+            can use "peer" (the peer number), "time" (the timestamp the event
+            was scheduled for) and "repetition" (how many times a repeated
+            event ran before, 0 otherwise). E.g. "%{peer * 10 + repetition}".
+
         PEERSPEC = {PEERNR1 [, PEERNR2, ...] [, PEERNR3-PEERNR6, ...]}
 
             Examples: "{1,2}" - apply event only for peer 1 and 2, "{3-6}" - apply
@@ -119,14 +261,16 @@ class ScenarioParser():
         """
         Returns a list of commands that will be executed.
 
-        A command is a (TIMESTAMP, LINENO, CALLABLE, ARGS, PEERSPEC) tuple. CALLABLE is
+        A command is a (TIMESTAMP, LINENO, CALLABLE, ARGS, REPEAT) tuple. CALLABLE is
         the name of a function, method, etc. registered with this scenario using
-        the register() method.
+        the register() method. REPEAT is None or an (INTERVAL, END) tuple for
+        events repeated until END.
         """
         try:
             for lineno, line in self._read_scenario(filename):
-                if line.endswith('}'):
-                    start = line.rfind('{') + 1
+                # a trailing %{...} is an argument template, not a PEERSPEC
+                start = line.rfind('{') + 1
+                if line.endswith('}') and line[start - 2:start] != '%{':
                     peerspec = line[start:-1]
                     line = line[:start - 1]
                 else:
@@ -162,14 +306,18 @@ class ScenarioParser():
 
                 if timespec[0] == '@':
                     timespec = timespec[1:]
-                timespec = timespec.split(':')
-                begin = int(timespec[-1])
-                if len(timespec) > 1:
-                    begin += int(timespec[-2]) * 60
-                if len(timespec) > 2:
-                    begin += int(timespec[-3]) * 3600
 
-                return (begin, lineno, callable, shlex.split(args))
+                repeat = None
+                if '/' in timespec:
+                    timespec, interval = timespec.split('/')
+                    timespec, end = timespec.split('-')
+                    repeat = (self._parse_timespec(interval), self._parse_timespec(end))
+                begin = self._parse_timespec(timespec)
+
+                if repeat and (repeat[0] <= 0 or repeat[1] < begin):
+                    raise ValueError("invalid repetition %s-%s/%s" % (begin, repeat[1], repeat[0]))
+
+                return (begin, lineno, callable, shlex.split(args), repeat)
 
             except Exception, e:
                 print >> sys.stderr, "Ignoring invalid scenario line", lineno, line, str(e)
@@ -177,37 +325,28 @@ class ScenarioParser():
         # line not for this peer or a parse error occurred
         return None
 
+    def _parse_timespec(self, timespec):
+        """
+        Returns the amount of seconds of a [H:]M:S time specification.
+        """
+        timespec = timespec.split(':')
+        seconds = int(timespec[-1])
+        if len(timespec) > 1:
+            seconds += int(timespec[-2]) * 60
+        if len(timespec) > 2:
+            seconds += int(timespec[-3]) * 3600
+        return seconds
+
     def _parse_peerspec(self, peerspec):
         """
-        Checks if current peernumber matches a peer specification.
+        Returns the PeerSpec for a peer specification.
 
         A peer specification if formatted as:
             [{PEERNR1 [, PEERNR2, ...] [, PEERNR3-PEERNR6, ...]}]
 
         Note: An empty peer specification matches everything.
         """
-        # get individual peers, if any, for a peer spec
-        yes_peers = set()
-        no_peers = set()
-
-        if peerspec:
-            if peerspec[0] == "!":
-                peers = no_peers
-                peerspec = peerspec[1:]
-            else:
-                peers = yes_peers
-
-            for peer in peerspec.split(","):
-                peer = peer.strip()
-                if peer:
-                    # parse the peer number (or peer number pair)
-                    if "-" in peer:
-                        low, high = peer.split("-")
-                        peers.update(xrange(int(low), int(high) + 1))
-                    else:
-                        peers.add(int(peer))
-
-        return yes_peers, no_peers
+        return parse_peerspec(peerspec)
 
     def _parse_for_this_peer(self):
         raise NotImplementedError('override this method please')
@@ -220,6 +359,105 @@ class ScenarioParser():
 
         return line
 
+
+class ScenarioCompiler(ScenarioParser):
+
+    """
+    Compiles a scenario file into a binary file holding the pre-parsed actions of every peer.
+
+    $VARIABLES are substituted at compile time, their values are stored in the compiled file so ScenarioRunner can
+    detect a stale file and fall back to parsing the text scenario. Lines with a negated (or no) PEERSPEC need to
+    know the amount of peers in the experiment, if peer_count is not given the highest peer number found in the
+    scenario is used.
+    """
+
+    def __init__(self, filename, peer_count=None):
+        ScenarioParser.__init__(self)
+        self.filename = filename
+        self.peer_count = peer_count
+
+        self.common_actions = None
+        self.peer_actions = None
+
+        self._substitutions = {}
+        self._peerspec = None
+        self._is_parsed = False
+
+    def parse(self):
+        """
+        Parses the scenario file, splitting its actions into the ones shared by all peers and the ones of every
+        individual peer.
+        """
+        common_actions = []
+        peer_actions = defaultdict(list)
+        negated_actions = []
+        max_peer = 0
+        for cmd in self._parse_scenario(self.filename):
+            peerspec = self._peerspec
+            if peerspec and not peerspec.negated:
+                for peer in peerspec:
+                    peer_actions[peer].append(cmd)
+                max_peer = max(max_peer, peerspec.max_peer)
+            elif peerspec:
+                negated_actions.append((cmd, peerspec))
+            else:
+                common_actions.append(cmd)
+
+        self.peer_count = self.peer_count or max_peer
+        for cmd, peerspec in negated_actions:
+            for peer in peerspec.peers(self.peer_count):
+                peer_actions[peer].append(cmd)
+
+        for actions in peer_actions.itervalues():
+            actions.sort(key=itemgetter(1))
+
+        self.common_actions = common_actions
+        self.peer_actions = dict(peer_actions)
+        self._is_parsed = True
+
+    def get_actions(self, peernumber):
+        """
+        Returns the list of (TIMESTAMP, LINENO, CALLABLE, ARGS, REPEAT) tuples the given peer should run, in scenario order.
+        """
+        if not self._is_parsed:
+            self.parse()
+
+        actions = self.common_actions + self.peer_actions.get(peernumber, [])
+        # Both lists are sorted by line number already, so this is just a merge.
+        actions.sort(key=itemgetter(1))
+        return actions
+
+    def compile(self, output_filename=None):
+        if output_filename is None:
+            output_filename = get_compiled_scenario_path(self.filename)
+
+        if not self._is_parsed:
+            self.parse()
+        peer_count = self.peer_count
+
+        source_stat = stat(self.filename)
+        header = {'source_mtime': source_stat.st_mtime,
+                  'source_size': source_stat.st_size,
+                  'substitutions': self._substitutions,
+                  'peer_count': peer_count}
+
+        blocks = [self.common_actions] + [self.peer_actions.get(peer, []) for peer in xrange(1, peer_count + 1)]
+        write_indexed_file(output_filename, _COMPILED_MAGIC, _COMPILED_VERSION, header,
+                           [marshal.dumps(block) if block else '' for block in blocks])
+
+        self._logger.info("Compiled %s for %d peers into %s", self.filename, peer_count, output_filename)
+        return output_filename
+
+    def _parse_for_this_peer(self, peerspec):
+        self._peerspec = self._parse_peerspec(peerspec)
+        return True
+
+    def _preprocess_line(self, line):
+        for substitution in self._re_substitution.findall(line):
+            self._substitutions[substitution[1:]] = environ.get(substitution[1:])
+        return ScenarioParser._preprocess_line(self, line)
+
+
 class ScenarioRunner(ScenarioParser):
 
     """
@@ -232,19 +470,64 @@ class ScenarioRunner(ScenarioParser):
     Users should register callables using register() before calling run(). All
     scenario events (lines) using unregistered callable names will be silently
     ignored. The callables will be executed on the main Twisted thread.
+
+    By default every action gets its own reactor.callLater(). With single_timer
+    enabled the actions are kept in a time sorted list instead and only one
+    timer is armed at a time, for the next batch of actions sharing the same
+    timestamp, so peers with thousands of actions don't flood the reactor.
+
+    If an action log is set with set_action_log(), every action run gets a
+    record with its scheduled time, how late it started, how long it ran and,
+    if it returned a Deferred, how long it took to fire.
+
+    Repeated actions are run by a single LoopingCall each, started at their
+    first timestamp, and %{EXPR} argument templates are only expanded when
+    the action is about to run.
+
+    The actions are scheduled on the Twisted reactor unless another clock is
+    given, e.g. a twisted.internet.task.Clock to run a scenario in virtual
+    time.
+
+    Callables registered with register_barrier() split the scenario: the
+    actions at or after the timestamp of a barrier are only scheduled once it
+    has been passed, that is, once the Deferred returned by the barrier fires
+    with the (absolute) time at which to continue. The rest of the scenario
+    is shifted so the barrier's timestamp falls at that time. Repeated actions
+    started before a barrier keep running at their own pace.
     """
+    _re_template = re_compile("%\\{([^}]*)\\}")
+    _template_builtins = {'__builtins__': None, 'abs': abs, 'int': int, 'len': len, 'max': max, 'min': min,
+                          'str': str}
 
-    def __init__(self, filename, expstartstamp=None):
+    def __init__(self, filename, expstartstamp=None, single_timer=False, clock=None):
         ScenarioParser.__init__(self)
         self.filename = filename
+        self._clock = clock or reactor
 
         self._callables = {}
+        self._barriers = set()
         self._expstartstamp = expstartstamp
         self._origin = None  # will be set just before run()-ing
         self._my_actions = []
 
         self._is_parsed = False
 
+        self._single_timer = single_timer
+        self._scheduled_actions = []
+        self._next_action = 0
+        self._delayed_calls = []
+        self._next_batch_call = None
+        self._looping_calls = []
+        self._compiled_templates = {}
+
+        self._segments = []
+        self._segment = 0
+        self._pending_barriers = 0
+        self._continue_time = None
+
+        self._action_log = None
+        self._pending_deferred_actions = {}
+
     def set_peernumber(self, peernumber):
         self._peernumber = peernumber
 
@@ -257,16 +540,118 @@ class ScenarioRunner(ScenarioParser):
             name = clb.__name__
         self._callables[name] = clb
 
+    def register_barrier(self, clb, name=None):
+        """
+        Registers a callable that blocks the rest of the scenario until the Deferred it returns fires with the
+        time to continue at. If it doesn't return a Deferred the scenario continues right away.
+        """
+        if name is None:
+            name = clb.__name__
+        self.register(clb, name)
+        self._barriers.add(name)
+
+    def has_barriers(self):
+        """
+        Returns True if any of the actions of this peer is a barrier.
+        """
+        return any(clb in self._barriers for _, clb, _, _ in self._my_actions)
+
+    def set_action_log(self, action_log):
+        """
+        Records the timing of every action run from now on into the given file object, one line per action:
+            SCHEDULED DRIFT DURATION DEFERRED CALLABLE
+
+        SCHEDULED is the scenario timestamp, DRIFT how many seconds late the action started, DURATION how many
+        seconds it ran for and DEFERRED the seconds it took for the Deferred it returned to fire ("-" if it didn't
+        return one, "?" if it never fired).
+
+        The caller has to call flush_action_log() once it is done, e.g. right before the reactor shuts down.
+        """
+        self._action_log = action_log
+        self._action_log.write("# scheduled drift duration deferred callable\n")
+
     def parse_file(self):
-        for (tstmp, _, clb, args) in self._parse_scenario(self.filename):
+        actions = self._load_compiled_scenario()
+        if actions is None:
+            actions = self._parse_scenario(self.filename)
+
+        self.load_actions(actions)
+
+    def load_actions(self, actions):
+        """
+        Uses the given (TIMESTAMP, LINENO, CALLABLE, ARGS, REPEAT) tuples as this peer's actions instead of parsing
+        the scenario file (for instance the ones received from the sync server).
+        """
+        for (tstmp, _, clb, args, repeat) in actions:
             if clb not in self._callables:
                 self._logger.error("'%s' is not registered as an action!", clb)
                 continue
 
-            self._my_actions.append((tstmp, clb, args))
+            if repeat:
+                interval, end = repeat
+                repeat = (interval, (end - tstmp) // interval + 1)
+            self._my_actions.append((tstmp, clb, args, repeat))
 
         self._is_parsed = True
 
+    def has_compiled_scenario(self):
+        """
+        Returns True if there is an up to date compiled version of the scenario file that can be used instead of
+        parsing the text file.
+        """
+        return self._open_compiled_scenario() is not None
+
+    def _open_compiled_scenario(self):
+        """
+        Returns the compiled scenario file as an IndexedFile, or None if there is none or it is out of date.
+        """
+        compiled_filename = get_compiled_scenario_path(self.filename)
+        if not path.exists(compiled_filename):
+            return None
+
+        try:
+            compiled = IndexedFile(compiled_filename, _COMPILED_MAGIC, _COMPILED_VERSION)
+        except ValueError:
+            self._logger.warning("%s is not a compiled scenario this version can read, ignoring it", compiled_filename)
+            return None
+
+        header = compiled.header
+        source_stat = stat(self.filename)
+        if header['source_mtime'] != source_stat.st_mtime or header['source_size'] != source_stat.st_size:
+            self._logger.warning("%s is older than its scenario file, ignoring it", compiled_filename)
+            return None
+
+        for name, value in header['substitutions'].iteritems():
+            if environ.get(name) != value:
+                self._logger.warning("$%s has changed since %s was compiled, ignoring it", name, compiled_filename)
+                return None
+
+        return compiled
+
+    def _load_compiled_scenario(self):
+        """
+        Loads the actions for this peer from the compiled scenario file, only reading the shared block and the one
+        of this peer. Returns None if there is no usable compiled file.
+        """
+        compiled = self._open_compiled_scenario()
+        if compiled is None:
+            return None
+
+        peer_count = compiled.header['peer_count']
+        if not 0 < self._peernumber <= peer_count:
+            self._logger.warning("%s was compiled for %d peers, ignoring it for peer %d",
+                                 compiled.filename, peer_count, self._peernumber)
+            return None
+
+        actions = []
+        for data in compiled.read_blocks([0, self._peernumber]):
+            if data:
+                actions.extend(marshal.loads(data))
+
+        # Both blocks are sorted by line number already, so this is just a merge.
+        actions.sort(key=itemgetter(1))
+        return actions
+
     def run(self):
         """
         Schedules calls for each scenario line.
@@ -277,25 +662,216 @@ class ScenarioRunner(ScenarioParser):
             self.parse_file()
 
         if self._expstartstamp == None:
-            self._expstartstamp = time()
+            self._expstartstamp = self._clock.seconds()
+
+        self._segments = self._split_at_barriers(self._my_actions)
+        self._run_segment(0)
 
-        for tstmp, clb, args in self._my_actions:
-            tstmp = tstmp + self._expstartstamp
-            delay = tstmp - time()
-            reactor.callLater(
-                delay if delay > 0.0 else 0,
-                self._callables[clb],
-                *args
-            )
+    def _split_at_barriers(self, actions):
+        """
+        Splits the actions in the ones before the first barrier (the barrier included), the ones between it and the
+        next one, and so on.
+        """
+        barrier_times = sorted(set(tstmp for tstmp, clb, _, _ in actions if clb in self._barriers))
+        segments = [[] for _ in xrange(len(barrier_times) + 1)]
+        for action in actions:
+            tstmp, clb = action[:2]
+            if clb in self._barriers:
+                segments[bisect_left(barrier_times, tstmp)].append(action)
+            else:
+                segments[bisect_right(barrier_times, tstmp)].append(action)
+        return segments
+
+    def _run_segment(self, segment):
+        self._segment = segment
+        actions = self._segments[segment]
+        self._pending_barriers = sum(1 for _, clb, _, _ in actions if clb in self._barriers)
+        self._continue_time = None
+
+        if self._single_timer:
+            # sort is stable, so actions sharing a timestamp keep their scenario order
+            self._scheduled_actions = sorted(actions, key=itemgetter(0))
+            self._next_action = 0
+            self._schedule_next_batch()
+            return
+
+        for tstmp, clb, args, repeat in actions:
+            delay = tstmp + self._expstartstamp - self._clock.seconds()
+            if clb in self._barriers:
+                self._delayed_calls.append(self._clock.callLater(
+                    delay if delay > 0.0 else 0,
+                    self._run_barrier, tstmp, clb, args
+                ))
+            elif repeat:
+                self._delayed_calls.append(self._clock.callLater(
+                    delay if delay > 0.0 else 0,
+                    self._start_repeated_action, tstmp, clb, args, *repeat
+                ))
+            elif self._action_log or self._is_template(args):
+                self._delayed_calls.append(self._clock.callLater(
+                    delay if delay > 0.0 else 0,
+                    self._run_action, tstmp, clb, args
+                ))
+            else:
+                self._delayed_calls.append(self._clock.callLater(
+                    delay if delay > 0.0 else 0,
+                    self._callables[clb],
+                    *args
+                ))
+
+    def get_pending_actions_count(self):
+        """
+        Returns the amount of scheduled actions that haven't been run yet.
+        """
+        self._looping_calls = [looping_call for looping_call in self._looping_calls if looping_call.running]
+        # The running repeated actions and the ones waiting for a barrier
+        pending = len(self._looping_calls) + sum(len(actions) for actions in self._segments[self._segment + 1:])
+        if self._single_timer:
+            return len(self._scheduled_actions) - self._next_action + pending
+
+        self._delayed_calls = [call for call in self._delayed_calls if call.active()]
+        return len(self._delayed_calls) + pending
+
+    def _schedule_next_batch(self):
+        if self._next_action < len(self._scheduled_actions):
+            tstmp = self._scheduled_actions[self._next_action][0] + self._expstartstamp
+            delay = tstmp - self._clock.seconds()
+            self._next_batch_call = self._clock.callLater(delay if delay > 0.0 else 0, self._run_next_batch)
+        else:
+            self._next_batch_call = None
+
+    def _run_next_batch(self):
+        """
+        Runs all the actions sharing the timestamp of the next pending one and arms the timer for the following batch.
+        """
+        actions = self._scheduled_actions
+        batch_tstmp = actions[self._next_action][0]
+        while self._next_action < len(actions) and actions[self._next_action][0] == batch_tstmp:
+            _, clb, args, repeat = actions[self._next_action]
+            self._next_action += 1
+            try:
+                if clb in self._barriers:
+                    self._run_barrier(batch_tstmp, clb, args)
+                elif repeat:
+                    self._start_repeated_action(batch_tstmp, clb, args, *repeat)
+                else:
+                    self._run_action(batch_tstmp, clb, args)
+            except:
+                self._logger.exception("Scenario action %s%s failed", clb, tuple(args))
+
+        self._schedule_next_batch()
+
+    def _start_repeated_action(self, tstmp, clb, args, interval, repetitions):
+        """
+        Runs the action now and then every interval seconds until it ran the given amount of repetitions.
+        """
+        state = {'repetition': 0}
+        # Passing a barrier moves the start of the experiment, the repetitions still belong to this segment
+        expstartstamp = self._expstartstamp
+
+        def run_repetition():
+            repetition = state['repetition']
+            state['repetition'] += 1
+            if state['repetition'] >= repetitions:
+                looping_call.stop()
+            try:
+                self._run_action(tstmp + repetition * interval, clb, args, repetition, expstartstamp)
+            except:
+                self._logger.exception("Scenario action %s%s failed", clb, tuple(args))
+
+        looping_call = LoopingCall(run_repetition)
+        looping_call.clock = self._clock
+        self._looping_calls.append(looping_call)
+        looping_call.start(interval, now=True)
+
+    def _run_barrier(self, tstmp, clb, args):
+        result = self._run_action(tstmp, clb, args)
+        if isinstance(result, Deferred):
+            def on_failure(failure):
+                self._logger.error("Barrier %s%s failed, continuing: %s", clb, tuple(args), failure.getErrorMessage())
+
+            result.addErrback(on_failure)
+            result.addCallback(self._barrier_passed, tstmp)
+        else:
+            self._barrier_passed(None, tstmp)
+
+    def _barrier_passed(self, continue_time, tstmp):
+        if continue_time is None:
+            continue_time = self._clock.seconds()
+        self._continue_time = max(self._continue_time, continue_time)
+
+        self._pending_barriers -= 1
+        if self._pending_barriers == 0 and self._segment + 1 < len(self._segments):
+            self._logger.info("Passed the barrier at %d, continuing in %.3f secs", tstmp,
+                              self._continue_time - self._clock.seconds())
+            self._expstartstamp = self._continue_time - tstmp
+            self._run_segment(self._segment + 1)
+
+    def _run_action(self, tstmp, clb, args, repetition=0, expstartstamp=None):
+        if self._is_template(args):
+            args = self._expand_templates(args, tstmp, repetition)
+
+        if self._action_log:
+            return self._run_logged_action(tstmp, clb, args, expstartstamp)
+        return self._callables[clb](*args)
+
+    def _is_template(self, args):
+        for arg in args:
+            if '%{' in arg:
+                return True
+        return False
+
+    def _expand_templates(self, args, tstmp, repetition):
+        namespace = {'peer': self._peernumber, 'time': tstmp, 'repetition': repetition}
+
+        def expand(match):
+            expression = match.group(1)
+            code = self._compiled_templates.get(expression)
+            if code is None:
+                code = self._compiled_templates[expression] = compile(expression, '<scenario template>', 'eval')
+            return str(eval(code, self._template_builtins, namespace))
+
+        return [self._re_template.sub(expand, arg) if '%{' in arg else arg for arg in args]
+
+    def _run_logged_action(self, tstmp, clb, args, expstartstamp=None):
+        start = self._clock.seconds()
+        result = self._callables[clb](*args)
+        end = self._clock.seconds()
+        if expstartstamp is None:
+            expstartstamp = self._expstartstamp
+        drift = start - (tstmp + expstartstamp)
+
+        if isinstance(result, Deferred) and not result.called:
+            key = object()
+            self._pending_deferred_actions[key] = (tstmp, drift, end - start, clb)
+
+            def on_fired(value):
+                if key in self._pending_deferred_actions:
+                    del self._pending_deferred_actions[key]
+                    self._write_action_record(tstmp, drift, end - start, "%.6f" % (self._clock.seconds() - start), clb)
+                return value
+            result.addBoth(on_fired)
+        else:
+            deferred = "%.6f" % (end - start) if isinstance(result, Deferred) else "-"
+            self._write_action_record(tstmp, drift, end - start, deferred, clb)
+
+        return result
+
+    def _write_action_record(self, tstmp, drift, duration, deferred, clb):
+        self._action_log.write("%d %.6f %.6f %s %s\n" % (tstmp, drift, duration, deferred, clb))
+
+    def flush_action_log(self):
+        """
+        Writes the records of the actions whose Deferred hasn't fired yet and flushes the action log.
+        """
+        for tstmp, drift, duration, clb in self._pending_deferred_actions.itervalues():
+            self._write_action_record(tstmp, drift, duration, "?", clb)
+        self._pending_deferred_actions.clear()
+        self._action_log.flush()
 
     def _parse_for_this_peer(self, peerspec):
         if peerspec:
-            yes_peers, no_peers = self._parse_peerspec(peerspec)
-            return (
-                not (yes_peers or no_peers) or
-                (yes_peers and self._peernumber in yes_peers) or
-                (no_peers and not self._peernumber in no_peers)
-            )
+            return self._parse_peerspec(peerspec).matches(self._peernumber)
         return True
 
 #
@@ -319,5 +895,5 @@ if __name__ == '__main__':
     sr.parse_file()
 
     print >> sys.stderr, "Took %.2f to parse %s" % (time() - t1, sys.argv[1])
-    for tstmp, clb, args in sr._my_actions:
-        print >> sys.stderr, tstmp, clb, args
+    for tstmp, clb, args, repeat in sr._my_actions:
+        print >> sys.stderr, tstmp, clb, args, repeat or ''
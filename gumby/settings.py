@@ -54,8 +54,16 @@ tracker_cmd = string(default="")
 tracker_run_remote = boolean(default=False)
 tracker_port = integer(min=1025, max=65535, default=7788)
 
+tracker_ready_line = string(default="")
+
 experiment_server_run_remote = boolean(default=False)
 experiment_server_cmd = string(default="")
+experiment_server_ready_line = string(default="")
+experiment_server_ready_port = integer(min=0, max=65535, default=0)
+
+stage_ready_timeout = float(default=120)
+
+trace_file = string(default="")
 
 local_setup_cmd = string(default="")
 remote_setup_cmd = string(default="das4_setup.sh")
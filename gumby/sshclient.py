@@ -38,6 +38,7 @@
 
 import os
 import logging
+from collections import defaultdict
 
 from twisted.python.log import err, msg
 from twisted.python.failure import Failure
@@ -45,6 +46,7 @@ from twisted.internet import reactor
 from twisted.internet.error import ConnectionDone, ProcessTerminated, ConnectionLost
 from twisted.internet.defer import Deferred, DeferredList, succeed, setDebugging
 from twisted.internet.protocol import ClientFactory
+from twisted.internet.task import LoopingCall
 
 from twisted.conch.ssh.common import NS
 from twisted.conch.ssh.channel import SSHChannel
@@ -56,6 +58,8 @@ from twisted.conch.ssh.session import packRequest_pty_req
 
 from struct import unpack, pack
 
+from .trace import tracer
+
 # setDebugging(True)
 
 _ERROR_REASONS = (
@@ -64,8 +68,7 @@ _ERROR_REASONS = (
 )
 
 
-class _CommandTransport(SSHClientTransport):
-    _secured = False
+class _PooledTransport(SSHClientTransport):
 
     def __init__(self):
         self._logger = logging.getLogger(self.__class__.__name__)
@@ -75,54 +78,97 @@ class _CommandTransport(SSHClientTransport):
         return succeed(True)
 
     def connectionSecure(self):
-        self._secured = True
-        connection = _CommandConnection(self.factory.command)
-        self.connection = connection
+        self.connection = _PooledConnection(self.factory)
         userauth = SSHUserAuthClient(
             self.factory.user,
             ConchOptions(),
-            connection)
+            self.connection)
         self.requestService(userauth)
 
-    def connectionLost(self, reason):
-        nreason = None
-        if self._secured and reason.type is ConnectionDone:
-            if isinstance(self.connection.reason, _ERROR_REASONS):
-                nreason = Failure(self.connection.reason)
-        if nreason is not None:
-            err("Connection lost with reason: %s" % self.connection.reason)
-        else:
-            self._logger.info("Connection lost with reason: %s", reason)
-
-        self.factory.finished.callback(nreason)
-
     def receiveError(self, reason, desc):
         err_msg = "Received error: %s (reasonCode=%d)" % (desc, reason)
         err(err_msg)
-        self.connection.reason = ConnectionLost(err_msg)
+        if getattr(self, 'connection', None):
+            self.connection.failChannels(ConnectionLost(err_msg))
+
 
+class _PooledConnection(SSHConnection):
 
-class _CommandConnection(SSHConnection):
+    """
+    Authenticated connection to a host that runs every command it is given in a channel of its own. Sends keepalives
+    to notice when the host has gone away while idle.
+    """
 
-    def __init__(self, command):
+    def __init__(self, factory):
         SSHConnection.__init__(self)
-        self.command_str = command
-        self.reason = None
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self.factory = factory
+        self.reserved = 0
+        self.lost = False
+        # Fires once the connection is closed
+        self.stopped = Deferred()
+        self._keepalive_lc = None
+        self._keepalive_misses = 0
 
     def serviceStarted(self):
-        channel = _CommandChannel(self.command_str, conn=self)
+        SSHConnection.serviceStarted(self)
+        pool = self.factory.pool
+        if pool.keepalive_interval:
+            self._keepalive_lc = LoopingCall(self._sendKeepalive)
+            self._keepalive_lc.start(pool.keepalive_interval, now=False)
+        self.factory.ready.callback(self)
+
+    def serviceStopped(self):
+        self.lost = True
+        if self._keepalive_lc and self._keepalive_lc.running:
+            self._keepalive_lc.stop()
+        # The channels still open didn't get to finish their commands
+        self.failChannels(ConnectionLost("SSH connection lost"))
+        SSHConnection.serviceStopped(self)
+        self.factory.pool._connectionLost(self.factory.key, self)
+        self.stopped.callback(None)
+
+    def failChannels(self, reason):
+        for channel in self.channels.values():
+            if not channel.reason:
+                channel.reason = reason
+
+    def hasCapacity(self):
+        return not self.lost and self.reserved < self.factory.pool.max_channels
+
+    def reserve(self):
+        self.reserved += 1
+
+    def runCommand(self, command, line_callback=None):
+        def release(result):
+            self.reserved -= 1
+            return result
+
+        channel = _PooledCommandChannel(command, line_callback, conn=self)
+        channel.finished.addBoth(release)
         self.openChannel(channel)
+        return channel.finished
+
+    def _sendKeepalive(self):
+        if self._keepalive_misses >= self.factory.pool.keepalive_max:
+            self._logger.error("%s didn't answer %d keepalives, dropping the connection",
+                               self.factory.key[1], self._keepalive_misses)
+            self.transport.transport.loseConnection()
+            return
+
+        def answered(_):
+            # Even a refused request means the other side is still there
+            self._keepalive_misses = 0
 
-    def channelClosed(self, channel):
-        SSHConnection.channelClosed(self, channel)
-        self.reason = channel.reason
-        self.transport.loseConnection()
+        self._keepalive_misses += 1
+        self.sendGlobalRequest('keepalive@openssh.com', '', wantReply=True).addBoth(answered)
 
 
 class _CommandChannel(SSHChannel):
     name = 'session'
 
-    def __init__(self, command, **k):
+    def __init__(self, command, line_callback=None, **k):
         SSHChannel.__init__(self, **k)
 
         self._logger = logging.getLogger(self.__class__.__name__)
@@ -130,6 +176,8 @@ class _CommandChannel(SSHChannel):
         self._databytes = ''
         self._extbytes = ''
         self.command = command
+        # Called with every line of output of the command
+        self.line_callback = line_callback
         self.reason = None
 
     # def openFailed(self, reason):
@@ -166,6 +214,8 @@ class _CommandChannel(SSHChannel):
         for line in self._databytes.splitlines(True):
             if line.endswith('\n'):
                 self._logger.info('SSH "%s" STDOUT: %s', self.command, line.rstrip())
+                if self.line_callback:
+                    self.line_callback(line.rstrip())
             else:
                 # It's a partial line (part of the last one), save it to the buffer instead
                 remainder = line
@@ -178,6 +228,8 @@ class _CommandChannel(SSHChannel):
         for line in self._extbytes.splitlines(True):
             if line.endswith('\n'):
                 self._logger.info('SSH "%s" STDERR: %s', self.command, line.rstrip())
+                if self.line_callback:
+                    self.line_callback(line.rstrip())
             else:
                 # It's a partial line (part of the last one), save it to the buffer instead
                 remainder = line
@@ -215,26 +267,159 @@ class _CommandChannel(SSHChannel):
         self.reason = ProcessTerminated(None, signal, None)
 
 
-class CommandFactory(ClientFactory):
+class _PooledCommandChannel(_CommandChannel):
 
-    def __init__(self, command, user):
-        self._logger = logging.getLogger(self.__class__.__name__)
-
-        self.command = command
-        self.user = user
-        self.protocol = _CommandTransport
+    def __init__(self, command, line_callback=None, **k):
+        _CommandChannel.__init__(self, command, line_callback, **k)
         self.finished = Deferred()
 
+    def openFailed(self, reason):
+        err("SSH channel for \"%s\" could not be opened: %s" % (self.command, reason))
+        self.finished.errback(reason)
+
+    def closed(self):
+        _CommandChannel.closed(self)
+        if isinstance(self.reason, _ERROR_REASONS):
+            err("Command \"%s\" failed with reason: %s" % (self.command, self.reason))
+            self.finished.errback(Failure(self.reason))
+        else:
+            self.finished.callback(None)
+
+
+class _PoolConnectionFactory(ClientFactory):
+    protocol = _PooledTransport
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.user = key[0]
+        self.ready = Deferred()
+
+    def clientConnectionFailed(self, connector, reason):
+        if not self.ready.called:
+            self.ready.errback(reason)
+
     def clientConnectionLost(self, connector, reason):
-        self._logger.info("Client connection lost: %s, %s, %s", connector, reason, reason.type)
-        if not self.finished.called:  # TODO: This could be prettier
-            if reason.type is ConnectionDone:
-                self.finished.callback(None)
-            else:
-                self.finished.errback(reason)
+        # Lost before the user was authenticated
+        if not self.ready.called:
+            self.ready.errback(reason)
+
+
+class SSHConnectionPool(object):
+
+    """
+    Keeps authenticated SSH connections to every host alive and runs each command in a new channel of one of them,
+    so running a command only costs a channel open round trip instead of a connection, key exchange and
+    authentication.
+
+    As SSH servers limit the amount of sessions per connection (MaxSessions, 10 by default on OpenSSH) a connection
+    runs at most max_channels commands at once, more connections to the same host are made when needed. A
+    connection that is lost (or doesn't answer keepalive_max keepalives in a row) is dropped and a new one is made
+    for the next command, the commands that were running on it fail with ConnectionLost.
+    """
+
+    def __init__(self, max_channels=10, keepalive_interval=30, keepalive_max=3):
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self.max_channels = max_channels
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_max = keepalive_max
+
+        # (user, host, port) -> connections ready to run commands
+        self._connections = defaultdict(list)
+        # (user, host, port) -> Deferreds waiting for a connection with a free channel
+        self._waiters = defaultdict(list)
+        # (user, host, port) -> amount of connections being made
+        self._connecting = defaultdict(int)
 
+    def runCommand(self, user, host, port, command, line_callback=None):
+        """
+        Runs command on host and returns a Deferred that fires once it has finished, or fails if the command
+        returned an error or the connection was lost. line_callback is called with every line of its output.
+        """
+        d = self._getConnection((user, host, port))
+        d.addCallback(lambda connection: connection.runCommand(command, line_callback))
+        return d
+
+    def _getConnection(self, key):
+        for connection in self._connections[key]:
+            if connection.hasCapacity():
+                connection.reserve()
+                return succeed(connection)
+
+        d = Deferred()
+        self._waiters[key].append(d)
+        self._connectIfNeeded(key)
+        return d
+
+    def _connectIfNeeded(self, key):
+        if len(self._waiters[key]) > self._connecting[key] * self.max_channels:
+            user, host, port = key
+            self._logger.info("Opening SSH connection to %s@%s:%d", user, host, port)
+            self._connecting[key] += 1
+            factory = _PoolConnectionFactory(self, key)
+            tracer.traceDeferred(factory.ready, host, "ssh connections", "connect")
+            factory.ready.addCallbacks(self._connected, self._connectionFailed, callbackArgs=(key,),
+                                       errbackArgs=(key,))
+            reactor.connectTCP(host, port, factory)
+
+    def _connected(self, connection, key):
+        self._connecting[key] -= 1
+        self._connections[key].append(connection)
+
+        waiters = self._waiters[key]
+        while waiters and connection.hasCapacity():
+            connection.reserve()
+            waiters.pop(0).callback(connection)
+        self._connectIfNeeded(key)
+
+    def _connectionFailed(self, failure, key):
+        self._connecting[key] -= 1
+        self._logger.error("Could not open an SSH connection to %s@%s:%d: %s", key[0], key[1], key[2],
+                           failure.getErrorMessage())
+
+        # The waiters that the connections still being made can't take
+        waiters = self._waiters[key]
+        failed = waiters[self._connecting[key] * self.max_channels:]
+        del waiters[self._connecting[key] * self.max_channels:]
+        for d in failed:
+            d.errback(failure)
+
+    def _connectionLost(self, key, connection):
+        if connection in self._connections[key]:
+            self._logger.info("SSH connection to %s@%s:%d lost", *key)
+            self._connections[key].remove(connection)
+
+    def close(self, timeout=5):
+        """
+        Closes all the connections, returns a Deferred that fires once they are closed or, if some host doesn't get
+        back to us, after timeout seconds.
+        """
+        connections = [connection for key_connections in self._connections.itervalues()
+                       for connection in key_connections]
+        if not connections:
+            return succeed(None)
+
+        self._logger.info("Closing %d SSH connections", len(connections))
+        d = Deferred()
 
-def runRemoteCMD(host, command):
+        def closed(_):
+            if not d.called:
+                d.callback(None)
+        DeferredList([connection.stopped for connection in connections]).addCallback(closed)
+        timeout_call = reactor.callLater(timeout, closed, None)
+        d.addCallback(lambda _: timeout_call.active() and timeout_call.cancel())
+
+        for connection in connections:
+            connection.transport.loseConnection()
+        return d
+
+_connection_pool = SSHConnectionPool()
+# Don't leave the connections to the hosts open until the process exits
+reactor.addSystemEventTrigger('before', 'shutdown', _connection_pool.close)
+
+
+def runRemoteCMD(host, command, line_callback=None):
     if '@' in host:
         user, host = host.split('@')
     else:
@@ -245,10 +430,8 @@ def runRemoteCMD(host, command):
     else:
         port = 22
 
-    factory = CommandFactory(command, user)
-    reactor.connectTCP(host, port, factory)
-
-    return factory.finished
+    d = _connection_pool.runCommand(user, host, port, command, line_callback)
+    return tracer.traceDeferred(d, host, command, command)
 
 #
 # sshrunner.py ends here
@@ -0,0 +1,203 @@
+# stages.py ---
+#
+# Filename: stages.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 15:04:12 2026 (+0200)
+
+# Commentary:
+#
+# Runs the stages of an experiment as a dependency graph instead of one after the other, starting every stage as
+# soon as all the stages it depends on are done, and reports how long each stage took and which chain of stages
+# (the critical path) determined the total run time.
+#
+# Also has the readiness probes used to know when a background command (tracker, experiment server) can be used.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import logging
+from time import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.protocol import Factory, Protocol
+
+from .trace import LOCAL_HOST, tracer
+
+
+class StageScheduler(object):
+
+    """
+    Runs stages (callables returning a Deferred that fires once the stage is done) as soon as the stages they depend
+    on are done. The first failing stage fails the whole run, the stages that haven't started by then are skipped.
+    """
+
+    def __init__(self):
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self._stages = []
+        self._callables = {}
+        self._dependencies = {}
+        self.start_times = {}
+        self.end_times = {}
+        self._done = set()
+        self._origin = None
+        self._failed = False
+        self._d = None
+
+    def addStage(self, name, func, after=()):
+        for dependency in after:
+            if dependency not in self._callables:
+                raise ValueError("Stage %s depends on unknown stage %s" % (name, dependency))
+        self._stages.append(name)
+        self._callables[name] = func
+        self._dependencies[name] = tuple(after)
+
+    def run(self):
+        """
+        Returns a Deferred that fires once all the stages are done, or fails with the failure of the first stage that
+        fails.
+        """
+        self._origin = time()
+        self._d = Deferred()
+        self._startReadyStages()
+        return self._d
+
+    def _startReadyStages(self):
+        for name in self._stages:
+            # Stages can finish (or fail) right away
+            if self._failed:
+                return
+            if name in self.start_times:
+                continue
+            if all(dependency in self._done for dependency in self._dependencies[name]):
+                self._startStage(name)
+
+    def _startStage(self, name):
+        self._logger.info("Starting stage %s", name)
+        self.start_times[name] = time() - self._origin
+        d = tracer.traceDeferred(maybeDeferred(self._callables[name]), LOCAL_HOST, "stages", name)
+        d.addCallbacks(self._stageDone, self._stageFailed, callbackArgs=(name,), errbackArgs=(name,))
+
+    def _stageDone(self, _, name):
+        self.end_times[name] = time() - self._origin
+        self._done.add(name)
+        self._logger.info("Stage %s done after %.2f secs", name, self.end_times[name] - self.start_times[name])
+        if self._failed:
+            return
+
+        if len(self._done) == len(self._stages):
+            self._d.callback(None)
+        else:
+            self._startReadyStages()
+
+    def _stageFailed(self, failure, name):
+        self.end_times[name] = time() - self._origin
+        self._logger.error("Stage %s failed after %.2f secs", name, self.end_times[name] - self.start_times[name])
+        if not self._failed:
+            self._failed = True
+            self._d.errback(failure)
+
+    def getCriticalPath(self):
+        """
+        Returns the chain of stages, ending with the one that finished last, in which every stage was the last of the
+        stages it depends on to finish.
+        """
+        if not self.end_times:
+            return []
+
+        path = [max(self.end_times, key=self.end_times.get)]
+        while True:
+            dependencies = [dependency for dependency in self._dependencies[path[-1]] if dependency in self.end_times]
+            if not dependencies:
+                break
+            path.append(max(dependencies, key=self.end_times.get))
+        path.reverse()
+        return path
+
+    def logSummary(self):
+        self._logger.info("Stage timings (secs since the start of the experiment):")
+        for name in self._stages:
+            if name in self.end_times:
+                self._logger.info("  %-20s %8.2f -> %8.2f  (%.2f)", name, self.start_times[name], self.end_times[name],
+                                  self.end_times[name] - self.start_times[name])
+            elif name in self.start_times:
+                self._logger.info("  %-20s %8.2f -> unfinished", name, self.start_times[name])
+            else:
+                self._logger.info("  %-20s not started", name)
+
+        path = self.getCriticalPath()
+        if path:
+            self._logger.info("Critical path (%.2f secs): %s", self.end_times[path[-1]],
+                              " -> ".join("%s (%.2f)" % (name, self.end_times[name] - self.start_times[name])
+                                          for name in path))
+
+
+def waitForPort(host, port, timeout, interval=0.5):
+    """
+    Returns a Deferred that fires once host accepts TCP connections on port, or fails after timeout seconds.
+    """
+    d = Deferred()
+    deadline = time() + timeout
+    factory = Factory()
+    factory.protocol = Protocol
+
+    def connected(protocol):
+        protocol.transport.loseConnection()
+        d.callback(None)
+
+    def retry(failure):
+        if time() + interval > deadline:
+            d.errback(failure)
+        else:
+            reactor.callLater(interval, attempt)
+
+    def attempt():
+        endpoint = TCP4ClientEndpoint(reactor, host, port, timeout=max(1, int(interval * 4)))
+        endpoint.connect(factory).addCallbacks(connected, retry)
+
+    attempt()
+    return d
+
+
+class LineProbe(object):
+
+    """
+    Fires ready once a line containing text is seen, feed it the output lines of the command to watch.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.ready = Deferred()
+
+    def __call__(self, line):
+        if not self.ready.called and self.text in line:
+            self.ready.callback(None)
+
+#
+# stages.py ends here
@@ -18,17 +18,99 @@
 #                    startup between nodes just before starting the experiment.
 # * ready         -> Indicates that this specific instance has ending sending its info
 #                    and its ready to start.
+# * capabilities:<cap1>[,<cap2>...] -> Optional, tells the service which protocol extensions the
+#                    client understands. Currently only "zlib" is defined.
 #
 # When the all of the instances we are waiting for are all ready, all the information will
 # be sent back to them in the form of a JSON document. After this, a "go" command will
 # be sent to indicate that they should start running the experiment with the absolute time at which the experiment should start.
 #
+# Clients that announced the "zlib" capability get the JSON document compressed instead, as an
+# "all_vars:zlib:<length>" line followed by <length> bytes of raw zlib data. It is compressed once and
+# the same buffer is written to every subscriber, and as it isn't sent as a line its size isn't
+# limited by MAX_LENGTH.
+#
+# Framed protocol:
+#
+# A client can start the connection with a "protocol:framed:<version>" line. If the server speaks
+# that version it answers with the same line, otherwise with "protocol:text" and both sides keep
+# using the text protocol described above. Once agreed, every message in both directions is a frame:
+#
+#   [length: 4 bytes, big endian][type: 1 byte][payload: <length> bytes]
+#
+# The types are the MSG_* constants below, and carry the same information as their text protocol
+# counterparts with the fields separated by \0 (e.g. MSG_SET is "key\0value"). The all vars document
+# is always sent zlib compressed in a MSG_ALL_VARS frame.
+#
+# Relays:
+#
+# To avoid having a connection per subscriber on the server, a relay (see scripts/sync_relay.py) can
+# run on every node, acting as the server for the subscribers of that node and connecting to the real
+# server on their behalf with the framed protocol. It announces how many subscribers it relays for with
+# a MSG_RELAY frame before its MSG_TIME, gets all their ids in a single MSG_RELAY_IDS frame and sends
+# all their vars (with their time offsets relative to the relay) in a single MSG_RELAY_READY JSON
+# document once all of them are ready. The all vars document and the go signal are then sent to the
+# relay, which passes them on to its subscribers. If the server distributes a scenario, it sends the
+# relay the actions of all its subscribers (a JSON object by id) in a MSG_SCENARIO frame right before
+# their ids, so relays never read the scenario file themselves.
+#
+# Sessions:
+#
+# Right before its id, the server sends every subscriber that supports it (framed protocol version 2 or
+# the "resume" capability) a session token in a "session:<token>" line. If the connection is lost
+# before the go signal, the client reconnects and starts the new connection with a
+# "resume:<id>:<token>:<received>" line, where <received> is the comma separated list of what it got
+# already ("scenario" and/or "vars"), followed by its time and vars and, if it had sent them already,
+# its ready and vars_received commands. The subscriber keeps its id and the server only sends it what
+# it missed: its scenario actions, the all vars document and the go signal.
+# The id of a subscriber that lost its connection without a session to resume is handed to the next
+# connection that registers (most likely the same subscriber reconnecting), so the ids stay 1..N.
+# The id of one with a session is kept for it for SESSION_RESUME_TIMEOUT seconds, or until a
+# subscriber from the same host registers without a session once all the ids 1..N are taken (it
+# restarted from scratch), whichever comes first.
+#
+# Clock synchronization:
+#
+# With the text protocol the server estimates the clock offset of a subscriber from its single time
+# command. Framed protocol version 3 clients measure it themselves instead, NTP style: they send
+# CLOCK_SYNC_SAMPLES MSG_PING frames with their time, one after the other, which the server answers
+# right away with a MSG_PONG frame carrying the client time and its own. The sample with the lowest round
+# trip time is the one least affected by queueing, its offset is sent to the server in a MSG_CLOCK frame
+# together with its uncertainty (half the round trip time) before the client says it's ready.
+#
+# Barriers:
+#
+# Framed protocol version 4 clients that want to use barriers send a MSG_KEEP_CONNECTED frame before their
+# MSG_READY and keep the connection open after the go signal (the server only disconnects the others). A
+# client reaching a barrier sends a MSG_BARRIER frame with its name and an optional quorum. Once all the
+# subscribers still keeping their connection (or the quorum: a fraction of them if it's up to 1, an amount
+# otherwise) reached it, the server sends every one of them a MSG_CONTINUE frame with the barrier name and the
+# time to continue at (in the subscriber's clock). Subscribers reaching a barrier after that get it right away.
+# The server stops once all of them have disconnected. Relays forward the barriers of their subscribers and
+# pass on the MSG_CONTINUE. A subscriber that disconnects while waiting no longer counts as having reached
+# the barrier, relays tell the server with a MSG_BARRIER_LEFT frame with the barrier name.
+#
+# Admission control:
+#
+# The server can be given a connection budget (a rate and a burst, token bucket style). A connection that
+# comes in when the budget is exhausted gets a "retry:<seconds>" line, in either protocol and before anything
+# else, and is closed without getting an id. Every rejected connection is handed the next free slot of the
+# budget, so the clients come back one after the other at the pace the server can take them and not all at
+# once.
+#
+# If the server has been given a scenario file, it will parse it once and send every subscriber the list of
+# actions it should run (as a JSON list) in a "scenario:" line right after its id, so the clients don't need to
+# read and parse the scenario file themselves.
+#
 # Example of an expected exchange:
 # [connection is opened by the client]
 # <- id:0
+# <- scenario:[[0, 1, "start_dispersy", []], [60, 2, "online", []]]   (only if a scenario file is being distributed)
 # -> time:1378479678.11
 # -> set:asdf:ooooo
+# -> capabilities:zlib
 # -> ready
+# <- all_vars:zlib:1234   (followed by the compressed JSON document, only if the client announced zlib)
 # <- {"0": {"host": "127.0.0.1", "time_offset": -0.94, "port": 12000, "asdf": "ooooo"}, "1": {"host": "127.0.0.1", "time_offset": "-1378479680.61", "port": 12001, "asdf": "ooooo"}, "2": {"host": "127.0.0.1", "time_offset": "-1378479682.26", "port": 12002, "asdf": "ooooo"}}
 # -> vars_received
 # <- go:1388665322.478153
@@ -60,41 +142,176 @@
 # Code:
 import json
 import logging
+import zlib
+from heapq import heappop, heappush
+from math import ceil
+from os import urandom
+from struct import Struct
 from time import time
 
 from twisted.internet import reactor, task
-from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.internet.defer import Deferred, DeferredSemaphore, succeed
 from twisted.internet.protocol import (Factory, ReconnectingClientFactory, connectionDone)
 from twisted.internet.threads import deferToThread
 from twisted.protocols.basic import LineReceiver
 
+from gumby.scenario import ScenarioCompiler
+from gumby.trace import LOCAL_HOST, tracer
+
 
 EXPERIMENT_SYNC_TIMEOUT = 30
+# Seconds the id of a subscriber that lost its connection is kept for it to resume its session
+SESSION_RESUME_TIMEOUT = 20
+
+# Version 2 added the session messages, version 3 the clock synchronization ones and version 4 the barriers.
+# Older clients are still accepted.
+FRAMED_PROTOCOL_VERSION = 4
+
+# Amount of round trips clients use to estimate their clock offset
+CLOCK_SYNC_SAMPLES = 8
+FRAME_HEADER = Struct('!IB')
+
+MSG_TIME, MSG_SET, MSG_READY, MSG_ID, MSG_SCENARIO, MSG_ALL_VARS, MSG_VARS_RECEIVED, MSG_GO = range(1, 9)
+# Only used between relays and the server, and only with the framed protocol
+MSG_RELAY, MSG_RELAY_IDS, MSG_RELAY_READY = range(9, 12)
+MSG_SESSION, MSG_RESUME = range(12, 14)
+MSG_PING, MSG_PONG, MSG_CLOCK = range(14, 17)
+MSG_KEEP_CONNECTED, MSG_BARRIER, MSG_CONTINUE = range(17, 20)
+# Only used between relays and the server
+MSG_BARRIER_LEFT = 20
+
+# The text protocol line of every message type, the fields are put in with %
+TEXT_MESSAGES = {MSG_TIME: "time:%s",
+                 MSG_SET: "set:%s:%s",
+                 MSG_READY: "ready",
+                 MSG_ID: "id:%s",
+                 MSG_SCENARIO: "scenario:%s",
+                 MSG_VARS_RECEIVED: "vars_received",
+                 MSG_GO: "go:%s",
+                 MSG_SESSION: "session:%s",
+                 MSG_RESUME: "resume:%s:%s:%s"}
 
 logger = logging.getLogger()
 
+
+class FramedLineReceiver(LineReceiver):
+
+    """
+    LineReceiver that switches to length prefixed, typed frames once both ends agreed to use the framed protocol
+    (see startFraming()).
+
+    Subclasses fill frame_handlers with the function handling the payload of every message type they accept.
+    """
+    frame_handlers = {}
+
+    framed = False
+
+    def connectionMade(self):
+        # Client protocols are reused when reconnecting (see ExperimentClientFactory), start from scratch
+        self.framed = False
+        self.clearLineBuffer()
+        self.setLineMode()
+
+    def startFraming(self):
+        self.framed = True
+        self._frame_chunks = []
+        self._frame_buffered = 0
+        self._frame_needed = FRAME_HEADER.size
+        self.setRawMode()
+
+    def sendMessage(self, msg_type, *fields):
+        if self.framed:
+            self.transport.write(encodeFrame(msg_type, *fields))
+        else:
+            self.sendLine(TEXT_MESSAGES[msg_type] % fields)
+
+    def rawDataReceived(self, data):
+        # Only join the received chunks once the frame being waited for is complete
+        self._frame_chunks.append(data)
+        self._frame_buffered += len(data)
+        if self._frame_buffered < self._frame_needed:
+            return
+
+        buf = ''.join(self._frame_chunks)
+        offset = 0
+        while True:
+            if len(buf) - offset < FRAME_HEADER.size:
+                self._frame_needed = FRAME_HEADER.size
+                break
+
+            length, msg_type = FRAME_HEADER.unpack_from(buf, offset)
+            end = offset + FRAME_HEADER.size + length
+            if end > len(buf):
+                self._frame_needed = end - offset
+                break
+
+            handler = self.frame_handlers.get(msg_type)
+            if handler is None:
+                self._logger.error('Unexpected message type %d received, closing connection.', msg_type)
+                self.transport.loseConnection()
+                return
+            handler(self, buf[offset + FRAME_HEADER.size:end])
+            offset = end
+
+        rest = buf[offset:]
+        self._frame_chunks = [rest] if rest else []
+        self._frame_buffered = len(rest)
+
+
+def encodeFrame(msg_type, *fields):
+    payload = '\0'.join(fields)
+    return FRAME_HEADER.pack(len(payload), msg_type) + payload
+
 #
 # Server side
 #
 
 
-class ExperimentServiceProto(LineReceiver):
+class ExperimentServiceProto(FramedLineReceiver):
     # Allow for 4MB long lines (for the json stuff)
     MAX_LENGTH = 2 ** 22
 
-    def __init__(self, factory, id):
+    def __init__(self, factory):
         self._logger = logging.getLogger(self.__class__.__name__)
 
-        self.id = id
+        # Assigned once the connection registers (or resumes its session)
+        self.id = None
         self.factory = factory
         self.ready = False
         self.state = 'init'
         self.vars = {}
+        self.capabilities = set()
         self.ready_d = None
+        self.registered = False
+        self.protocol_version = None
+        self.clock_uncertainty = None
+
+        # Amount of subscribers behind this connection that keep it open to use barriers
+        self.keep_connected = 0
+
+        # Set if the subscriber resumed its session, with what it had received already
+        self.resumed = False
+        self.client_has = set()
+
+        # Amount of subscribers behind this connection, their ids and vars if it is a relay
+        self.subscribers = 1
+        self.relayed_ids = None
+        self.relayed_vars = None
 
     def connectionMade(self):
         self._logger.debug("New connection from: %s", str(self.transport.getPeer()))
-        self.factory.setConnectionMade(self)
+
+    def register(self):
+        # Wait for the first line before counting the connection, so we know which protocol to send its id with.
+        # Connections that never get this far (port probes, connections dropped right away) don't take an id.
+        if not self.registered:
+            self.registered = True
+            if not self.resumed:
+                ids = self.factory.allocateIds(self.subscribers, self.transport.getPeer().host)
+                self.id = ids[0]
+                if self.relayed_ids is not None:
+                    self.relayed_ids = ids
+            self.factory.setConnectionMade(self)
 
     def lineReceived(self, line):
         try:
@@ -110,38 +327,131 @@ class ExperimentServiceProto(LineReceiver):
 
     def sendAndWaitForReady(self):
         self.ready_d = Deferred()
-        self.sendLine("id:%s" % self.id)
+        if self.relayed_ids:
+            if self.factory.hasScenario():
+                self.sendMessage(MSG_SCENARIO, json.dumps(dict((id, self.factory.getScenarioActions(id))
+                                                               for id in self.relayed_ids)))
+            self.sendMessage(MSG_RELAY_IDS, ",".join(str(id) for id in self.relayed_ids))
+        else:
+            if not self.resumed:
+                if self.supportsSessions():
+                    self.sendMessage(MSG_SESSION, self.factory.createSession(self.id))
+                self.sendMessage(MSG_ID, str(self.id))
+            if self.factory.hasScenario() and 'scenario' not in self.client_has:
+                self.sendMessage(MSG_SCENARIO, json.dumps(self.factory.getScenarioActions(self.id)))
+
+        if self.ready:
+            # A resumed subscriber can be ready before we get here
+            self.ready_d.callback(self)
         return self.ready_d
 
+    def supportsSessions(self):
+        return self.protocol_version >= 2 or 'resume' in self.capabilities
+
+    def resume(self, id, token, received):
+        if self.factory.sessions.get(id) != token:
+            self._logger.error("Subscriber tried to resume an unknown session as %d, closing connection.", id)
+            return False
+
+        self._logger.debug("Subscriber %d resumed its session, it already received: %s", id, received or "nothing")
+        self.factory.claimSession(id)
+        self.id = id
+        self.resumed = True
+        self.client_has = set(received.split(',')) if received else set()
+        return True
+
     def connectionLost(self, reason=connectionDone):
         self._logger.debug("Lost connection with: %s with ID %s", str(self.transport.getPeer()), self.id)
+        if self.ready_d and not self.ready_d.called:
+            # Don't hold a slot of the parsing semaphore for a connection that will never be ready
+            self.ready_d.callback(self)
         self.factory.unregisterConnection(self)
         LineReceiver.connectionLost(self, reason)
 
+    def setTime(self, subscriber_time):
+        self.vars["time_offset"] = subscriber_time - time()
+        if abs(self.vars['time_offset']) < 0.5:  # ignore time_offset if smaller than +0.5/-0.5
+            self.vars['time_offset'] = 0
+
+        self._logger.debug("Time offset is %s", self.vars["time_offset"])
+
+    def setClock(self, offset, uncertainty):
+        # Measured by the subscriber itself (see ClockSyncClient), it replaces the estimate made by setTime
+        self.vars["time_offset"] = offset
+        self.clock_uncertainty = uncertainty
+
+        self._logger.debug("Measured time offset is %f +/- %f", offset, uncertainty)
+
+    def setVar(self, key, value):
+        self._logger.debug("This subscriber sets %s to %s", key, value)
+        self.vars[key] = value
+
+    def setReady(self):
+        self._logger.debug("This subscriber is ready now.")
+        self.ready = True
+        self.factory.setConnectionReady(self)
+        if self.ready_d:
+            self.ready_d.callback(self)
+
+    def getSubscriberVars(self):
+        """
+        Returns a dict with the vars of every subscriber behind this connection by id, as sent in the all vars document.
+        """
+        host = self.transport.getPeer().host
+        if self.relayed_vars is None:
+            relayed_vars = {self.id: self.vars}
+            time_offset = 0
+        else:
+            relayed_vars = self.relayed_vars
+            time_offset = self.vars['time_offset']
+
+        # The stored vars are left as they are, so they can be sent again
+        subscribers_vars = {}
+        for id, subscriber_vars in relayed_vars.iteritems():
+            id = int(id)
+            subscribers_vars[id] = dict(subscriber_vars, time_offset=subscriber_vars['time_offset'] + time_offset,
+                                        port=id + 12000, host=host)
+        return subscribers_vars
+
     #
     # Protocol state handlers
     #
 
     def proto_init(self, line):
-        if line.startswith("time"):
-            self.vars["time_offset"] = float(line.strip().split(':')[1]) - time()
-            if abs(self.vars['time_offset']) < 0.5:  # ignore time_offset if smaller than +0.5/-0.5
-                self.vars['time_offset'] = 0
+        if line.startswith("protocol:"):
+            fields = line.strip().split(':')
+            if len(fields) == 3 and fields[1] == "framed" and fields[2] in map(str, range(1, FRAMED_PROTOCOL_VERSION + 1)):
+                # The connection will be registered on its first frame, once we know if it is a relay
+                self.protocol_version = int(fields[2])
+                self.sendLine(line.strip())
+                self.startFraming()
+                return 'framed'
+
+            self.sendLine("protocol:text")
+            return 'init'
 
-            self._logger.debug("Time offset is %s", self.vars["time_offset"])
+        # These come before anything else, we need them before registering the connection
+        if line.startswith('capabilities:'):
+            self.capabilities.update(line.strip().split(':', 1)[1].split(','))
+            self._logger.debug("This subscriber supports %s", ", ".join(sorted(self.capabilities)))
+            return 'init'
+
+        elif line.startswith('resume:'):
+            _, id, token, received = line.strip().split(':', 3)
+            return 'init' if self.resume(int(id), token, received) else 'done'
+
+        self.register()
+        if line.startswith("time"):
+            self.setTime(float(line.strip().split(':')[1]))
             return 'init'
 
         elif line.startswith('set:'):
             _, key, value = line.strip().split(':', 2)
-            self._logger.debug("This subscriber sets %s to %s", key, value)
-            self.vars[key] = value
+            self.setVar(key, value)
             return 'init'
 
         elif line.strip() == 'ready':
-            self._logger.debug("This subscriber is ready now.")
-            self.ready = True
-            self.factory.setConnectionReady(self)
-            self.ready_d.callback(self)
+            self.setReady()
             return 'vars_received'
 
         else:
@@ -161,144 +471,547 @@ class ExperimentServiceProto(LineReceiver):
         self._logger.error('Unexpected command received "%s" while in ready state. Closing connection', line)
         return 'done'
 
+    #
+    # Framed protocol message handlers
+    #
+
+    def frame_time(self, payload):
+        self.register()
+        self.setTime(float(payload))
+
+    def frame_set(self, payload):
+        self.setVar(*payload.split('\0', 1))
+
+    def frame_ready(self, payload):
+        self.setReady()
+
+    def frame_vars_received(self, payload):
+        self.factory.setConnectionReceived(self)
+
+    def frame_ping(self, payload):
+        self.sendMessage(MSG_PONG, payload, "%f" % time())
+
+    def frame_clock(self, payload):
+        self.setClock(*map(float, payload.split('\0')))
+
+    def frame_keep_connected(self, payload):
+        self.factory.updateKeepConnected(self, int(payload))
+
+    def frame_barrier(self, payload):
+        self.factory.reachBarrier(self, *payload.split('\0'))
+
+    def frame_barrier_left(self, payload):
+        barrier = self.factory.barriers.get(payload)
+        if barrier and barrier.waiting.get(self.id) is self:
+            self.factory.leaveBarrier(self, barrier, 1)
+
+    def frame_resume(self, payload):
+        id, token, received = payload.split('\0')
+        if not self.resume(int(id), token, received):
+            self.transport.loseConnection()
+
+    def frame_relay(self, payload):
+        self.subscribers = int(payload)
+        # Filled in with the ids of all the subscribers once registered
+        self.relayed_ids = []
+        self._logger.debug("This subscriber is a relay for %d subscribers", self.subscribers)
+        self.register()
+
+    def frame_relay_ready(self, payload):
+        self.relayed_vars = json.loads(payload)
+        self.setReady()
+
+    frame_handlers = {MSG_TIME: frame_time,
+                      MSG_SET: frame_set,
+                      MSG_READY: frame_ready,
+                      MSG_VARS_RECEIVED: frame_vars_received,
+                      MSG_RELAY: frame_relay,
+                      MSG_RELAY_READY: frame_relay_ready,
+                      MSG_RESUME: frame_resume,
+                      MSG_PING: frame_ping,
+                      MSG_CLOCK: frame_clock,
+                      MSG_KEEP_CONNECTED: frame_keep_connected,
+                      MSG_BARRIER: frame_barrier,
+                      MSG_BARRIER_LEFT: frame_barrier_left}
+
+
+class ExperimentRetryProto(LineReceiver):
+
+    """
+    Tells a connection the server can't take yet when it should try again and closes it.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def connectionMade(self):
+        self.sendLine("retry:%f" % self.delay)
+        self.transport.loseConnection()
+
+    def dataReceived(self, data):
+        # Whatever the client sent before learning it has to come back later
+        pass
+
+
+class ConnectionBudget():
+
+    """
+    Token bucket admitting up to rate new connections per second, with bursts of up to burst connections. The time is
+    taken from the reactor unless another clock is given.
+    """
+
+    def __init__(self, rate, burst=None, clock=None):
+        self._clock = clock or reactor
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self.last_refill = self._clock.seconds()
+        # Time of the last retry slot handed out
+        self.next_slot = 0
+
+    def admit(self):
+        """
+        Returns 0 if a new connection can go in now, or the seconds it has to wait before trying again otherwise.
+        """
+        now = self._clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        # The bucket refills at the same pace the slots are handed out, so there is a token for every one of them
+        self.next_slot = max(self.next_slot, now) + 1 / self.rate
+        return self.next_slot - now
+
+
+class Barrier():
+
+    def __init__(self, name, quorum):
+        self.name = name
+        self.quorum = quorum
+        self.reached = 0
+        # The connections waiting for it by id, and how many of their subscribers reached it (more than one for relays)
+        self.waiting = {}
+        self.reached_by = {}
+        self.continue_time = None
+        self.span = tracer.span(LOCAL_HOST, "sync barriers", name)
+
 
 class ExperimentServiceFactory(Factory):
     protocol = ExperimentServiceProto
 
-    def __init__(self, expected_subscribers, experiment_start_delay):
+    def __init__(self, expected_subscribers, experiment_start_delay, scenario_file=None, barrier_release_delay=1.0,
+                 connect_rate=0, connect_burst=None):
         self._logger = logging.getLogger(self.__class__.__name__)
 
         self.expected_subscribers = expected_subscribers
         self.experiment_start_delay = experiment_start_delay
+        self.barrier_release_delay = barrier_release_delay
+        # New connections are only limited if there is a connect rate
+        self.connect_budget = ConnectionBudget(connect_rate, connect_burst) if connect_rate > 0 else None
+        self.connections_retried = 0
+        self.scenario = None
         self.parsing_semaphore = DeferredSemaphore(500)
-        self.connection_counter = -1
-        self.connections_made = []
-        self.connections_ready = []
-        self.vars_received = []
-
-        self._made_looping_call = None
-        self._subscriber_looping_call = None
-        self._subscriber_received_looping_call = None
+        # Next subscriber id to hand out and the ids lost connections left behind (a heap), ids are only allocated to
+        # connections that register
+        self.next_id = 1
+        self.free_ids = []
+        # Registered connections by id, and the ids of the ones that are ready and got the all vars document
+        self.connections_made = {}
+        self.connections_ready = set()
+        self.vars_received = set()
+        self.ids_pushed = False
+        self.vars_pushed = False
+        self.start_time = None
+
+        # Session token of every subscriber id, and the host and expiration call of the ones waiting to be resumed
+        self.sessions = {}
+        self.lost_sessions = {}
+
+        # Barriers by name and amount of subscribers keeping their connection open to use them
+        self.barriers = {}
+        self.barrier_subscribers = 0
+        self._kept_connections_closed_d = None
+
+        # The all vars document in every encoding it has been needed in so far, see sendAllVars
+        self._json_vars = None
+        self._compressed_vars = None
+        self._all_vars_frame = None
+
+        # Amount of subscribers in each of the phases above, a relay connection counts for all its subscribers
+        self.subscribers_made = 0
+        self.subscribers_ready = 0
+        self.subscribers_received = 0
+
+        self._progress_looping_call = None
         self._timeout_delayed_call = None
+        self._start_delayed_call = None
+        # Span of the current phase of the handshake (connect, ready, vars) in the trace, see gumby.trace
+        self._phase_span = None
+
+        if scenario_file:
+            self.loadScenario(scenario_file)
+
+    def loadScenario(self, scenario_file):
+        """
+        Parses the scenario once so every subscriber can be sent its own actions right after its id.
+        """
+        t1 = time()
+        span = tracer.span(LOCAL_HOST, "sync server", "parse scenario")
+        self.scenario = ScenarioCompiler(scenario_file, self.expected_subscribers)
+        self.scenario.parse()
+        span.end()
+        self._logger.info("Took %.2f to parse scenario file %s, it will be sent to the subscribers.",
+                          time() - t1, scenario_file)
+
+    def hasScenario(self):
+        return self.scenario is not None
+
+    def getScenarioActions(self, id):
+        return self.scenario.get_actions(id)
 
     def buildProtocol(self, addr):
-        self.connection_counter += 1
-        return ExperimentServiceProto(self, self.connection_counter + 1)
+        if self.connect_budget:
+            delay = self.connect_budget.admit()
+            if delay:
+                self.connections_retried += 1
+                return ExperimentRetryProto(delay)
+
+        return ExperimentServiceProto(self)
+
+    def allocateIds(self, amount, host=None):
+        """
+        Returns amount subscriber ids, for the subscribers behind a connection that registers from host. The ids of
+        lost connections are handed out first, lowest first, so the subscribers end up with the ids 1..N.
+        """
+        if self.next_id + amount - len(self.free_ids) > self.expected_subscribers + 1:
+            # All the ids are taken, so a subscriber that lost its session on this host must have restarted
+            for id in sorted(id for id, (lost_host, _) in self.lost_sessions.iteritems() if lost_host == host):
+                self.expireSession(id)
+
+        ids = [heappop(self.free_ids) for _ in xrange(min(amount, len(self.free_ids)))]
+        new_ids = range(self.next_id, self.next_id + amount - len(ids))
+        self.next_id += len(new_ids)
+        return sorted(ids + new_ids)
+
+    def releaseIds(self, ids):
+        for id in ids:
+            heappush(self.free_ids, id)
+
+    def createSession(self, id):
+        token = urandom(16).encode('hex')
+        self.sessions[id] = token
+        return token
+
+    def keepSession(self, proto):
+        """
+        Keeps the id of a subscriber that lost its connection for it to resume its session, for a while.
+        """
+        expire_call = reactor.callLater(SESSION_RESUME_TIMEOUT, self.expireSession, proto.id)
+        self.lost_sessions[proto.id] = (proto.transport.getPeer().host, expire_call)
+
+    def claimSession(self, id):
+        if id in self.lost_sessions:
+            _, expire_call = self.lost_sessions.pop(id)
+            if expire_call.active():
+                expire_call.cancel()
+
+    def expireSession(self, id):
+        """
+        Forgets the session of a subscriber that didn't resume it, so its id can be handed out again.
+        """
+        self._logger.warning("Subscriber %d did not resume its session, its id can be taken by somebody else.", id)
+        self.claimSession(id)
+        del self.sessions[id]
+        self.releaseIds([id])
+
+    def resetTimeout(self):
+        if self._timeout_delayed_call and self._timeout_delayed_call.active():
+            self._timeout_delayed_call.reset(EXPERIMENT_SYNC_TIMEOUT)
 
     def setConnectionMade(self, proto):
         if not self._timeout_delayed_call:
             self._timeout_delayed_call = reactor.callLater(EXPERIMENT_SYNC_TIMEOUT, self.onExperimentSetupTimeout)
+            self.startPhase("connect")
         else:
-            self._timeout_delayed_call.reset(EXPERIMENT_SYNC_TIMEOUT)
+            self.resetTimeout()
 
-        self.connections_made.append(proto)
-        if len(self.connections_made) >= self.expected_subscribers:
-            self._logger.info("All subscribers connected!")
-            if self._made_looping_call and self._made_looping_call.running:
-                self._made_looping_call.stop()
+        if proto.id in self.connections_made:
+            # Never count the same subscriber twice
+            self.unregisterConnection(self.connections_made[proto.id])
+        self.connections_made[proto.id] = proto
+        self.subscribers_made += proto.subscribers
 
+        if self.ids_pushed:
+            # It replaces a connection that was lost after the ids were sent, or resumes its session
+            self.parsing_semaphore.run(proto.sendAndWaitForReady)
+        elif self.subscribers_made >= self.expected_subscribers:
+            self._logger.info("All subscribers connected!")
             self.pushIdToSubscribers()
-        else:
-            if not self._made_looping_call:
-                self._made_looping_call = task.LoopingCall(self._print_subscribers_made)
-                self._made_looping_call.start(1.0)
 
-    def _print_subscribers_made(self):
-        if len(self.connections_made) < self.expected_subscribers:
-            self._logger.info("%d of %d expected subscribers connected.", len(self.connections_made), self.expected_subscribers)
+        if not self._progress_looping_call:
+            self._progress_looping_call = task.LoopingCall(self._print_progress)
+            self._progress_looping_call.start(1.0, now=False)
+
+    def _print_progress(self):
+        if self.subscribers_made < self.expected_subscribers:
+            self._logger.info("%d of %d expected subscribers connected, %d connections told to retry later.",
+                              self.subscribers_made, self.expected_subscribers, self.connections_retried)
+        elif self.subscribers_ready < self.expected_subscribers:
+            self._logger.info("%d of %d expected subscribers ready.", self.subscribers_ready,
+                              self.expected_subscribers)
+        elif self.subscribers_received < self.expected_subscribers:
+            self._logger.info("%d of %d expected subscribers received the data.", self.subscribers_received,
+                              self.expected_subscribers)
+
+    def getReadySubscribers(self):
+        """
+        Returns the connections of the subscribers that are ready, as a list so they can be disconnected while
+        iterating over it.
+        """
+        return [self.connections_made[id] for id in self.connections_ready]
+
+    def startPhase(self, name):
+        if self._phase_span:
+            self._phase_span.end(subscribers_made=self.subscribers_made, subscribers_ready=self.subscribers_ready,
+                                 subscribers_received=self.subscribers_received)
+        self._phase_span = tracer.span(LOCAL_HOST, "sync server", name) if name else None
 
     def pushIdToSubscribers(self):
-        for proto in self.connections_made:
+        self.ids_pushed = True
+        self.startPhase("ready")
+        for proto in self.connections_made.values():
             self.parsing_semaphore.run(proto.sendAndWaitForReady)
 
     def setConnectionReady(self, proto):
-        self._timeout_delayed_call.reset(EXPERIMENT_SYNC_TIMEOUT)
-        self.connections_ready.append(proto)
-
-        if len(self.connections_ready) >= self.expected_subscribers:
+        self.resetTimeout()
+        if proto.id in self.connections_ready:
+            return
+        self.connections_ready.add(proto.id)
+        self.subscribers_ready += proto.subscribers
+
+        if self.vars_pushed:
+            # It (re)connected after the all vars document was sent
+            if 'vars' not in proto.client_has:
+                self.sendAllVars(proto)
+        elif self.subscribers_ready >= self.expected_subscribers:
             self._logger.info("All subscribers are ready, pushing data!")
-            if self._subscriber_looping_call and self._subscriber_looping_call.running:
-                self._subscriber_looping_call.stop()
-
             self.pushInfoToSubscribers()
-        else:
-            if not self._subscriber_looping_call:
-                self._subscriber_looping_call = task.LoopingCall(self._print_subscribers_ready)
-                self._subscriber_looping_call.start(1.0)
-
-    def _print_subscribers_ready(self):
-        self._logger.info("%d of %d expected subscribers ready.", len(self.connections_ready),
-                          self.expected_subscribers)
 
     def pushInfoToSubscribers(self):
+        self.startPhase("vars")
         # Generate the json doc
         vars = {}
-        for subscriber in self.connections_ready:
-            subscriber_vars = subscriber.vars.copy()
-            subscriber_vars['port'] = subscriber.id + 12000
-            subscriber_vars['host'] = subscriber.transport.getPeer().host
-            vars[subscriber.id] = subscriber_vars
+        for subscriber in self.getReadySubscribers():
+            vars.update(subscriber.getSubscriberVars())
 
         json_vars = json.dumps(vars)
         del vars
-        self._logger.info("Pushing a %d bytes long json doc.", len(json_vars))
+
+        self.pushAllVars(json_vars)
+
+    def pushAllVars(self, json_vars=None, compressed_vars=None):
+        """
+        Sends the all vars document to the subscribers, given as JSON and/or zlib compressed JSON.
+        """
+        self.vars_pushed = True
+        subscribers = self.getReadySubscribers()
+
+        # Encode everything once, all the subscribers get the same buffers
+        if compressed_vars is None and any(subscriber.framed or 'zlib' in subscriber.capabilities
+                                           for subscriber in subscribers):
+            compressed_vars = zlib.compress(json_vars)
+        if json_vars is None and not all(subscriber.framed or 'zlib' in subscriber.capabilities
+                                         for subscriber in subscribers):
+            json_vars = zlib.decompress(compressed_vars)
+
+        if compressed_vars is not None:
+            self._logger.info("Pushing a json doc, %d bytes compressed.", len(compressed_vars))
+        else:
+            self._logger.info("Pushing a %d bytes long json doc.", len(json_vars))
+        self._json_vars = json_vars
+        self._compressed_vars = compressed_vars
 
         # Send the json doc to the subscribers
-        task.cooperate(self._sendLineToAllGenerator(json_vars))
+        task.cooperate(self._sendVarsToAllGenerator(subscribers))
 
-    def _sendLineToAllGenerator(self, line):
-        for subscriber in self.connections_ready:
-            yield subscriber.sendLine(line)
+    def _sendVarsToAllGenerator(self, subscribers):
+        for subscriber in subscribers:
+            yield self.sendAllVars(subscriber)
 
-    def setConnectionReceived(self, proto):
-        self._timeout_delayed_call.reset(EXPERIMENT_SYNC_TIMEOUT)
-        self.vars_received.append(proto)
+    def sendAllVars(self, subscriber):
+        # Subscribers resuming their session may need an encoding nobody needed before
+        if subscriber.framed or 'zlib' in subscriber.capabilities:
+            if self._compressed_vars is None:
+                self._compressed_vars = zlib.compress(self._json_vars)
+
+            if subscriber.framed:
+                if self._all_vars_frame is None:
+                    self._all_vars_frame = encodeFrame(MSG_ALL_VARS, self._compressed_vars)
+                return subscriber.transport.write(self._all_vars_frame)
+
+            subscriber.sendLine("all_vars:zlib:%d" % len(self._compressed_vars))
+            return subscriber.transport.write(self._compressed_vars)
 
-        if len(self.vars_received) >= self.expected_subscribers:
+        if self._json_vars is None:
+            self._json_vars = zlib.decompress(self._compressed_vars)
+        return subscriber.sendLine(self._json_vars)
+
+    def setConnectionReceived(self, proto):
+        self.resetTimeout()
+        if proto.id in self.vars_received:
+            return
+        self.vars_received.add(proto.id)
+        self.subscribers_received += proto.subscribers
+
+        if self.start_time is not None:
+            # It (re)connected after the go signal was given
+            self.sendGo(proto)
+        elif self.subscribers_received >= self.expected_subscribers and not self._start_delayed_call:
             self._logger.info("Data sent to all subscribers, giving the go signal in %f secs.",
                               self.experiment_start_delay)
-            reactor.callLater(0, self.startExperiment)
+            self._start_delayed_call = reactor.callLater(0, self.startExperiment)
             self._timeout_delayed_call.cancel()
-        else:
-            if not self._subscriber_received_looping_call:
-                self._subscriber_received_looping_call = task.LoopingCall(self._print_subscribers_received)
-                self._subscriber_received_looping_call.start(1.0)
-
-    def _print_subscribers_received(self):
-        self._logger.info("%d of %d expected subscribers received the data.", len(self.vars_received),
-                          self.expected_subscribers)
+            self.startPhase(None)
 
-    def startExperiment(self):
+    def startExperiment(self, start_time=None):
         # Give the go signal and disconnect
         self._logger.info("Starting the experiment!")
 
-        if self._subscriber_received_looping_call and self._subscriber_received_looping_call.running:
-            self._subscriber_received_looping_call.stop()
+        if self._progress_looping_call and self._progress_looping_call.running:
+            self._progress_looping_call.stop()
 
-        start_time = time() + self.experiment_start_delay
-        for subscriber in self.connections_ready:
-            # Sync the experiment start time among instances
-            subscriber.sendLine("go:%f" % (start_time + subscriber.vars['time_offset']))
+        if start_time is None:
+            start_time = time() + self.experiment_start_delay
+        self.start_time = start_time
+        tracer.complete(LOCAL_HOST, "sync server", "go", time(), start_time)
+        for id in self.vars_received:
+            self.sendGo(self.connections_made[id])
 
         d = task.deferLater(reactor, 5, lambda: self._logger.info("Done, disconnecting all clients."))
         d.addCallback(lambda _: self.disconnectAll())
+        d.addCallback(lambda _: self.whenKeptConnectionsClosed())
         d.addCallbacks(self.onExperimentStarted, self.onExperimentStartError)
 
+    def sendGo(self, subscriber):
+        # Sync the experiment start time among instances
+        subscriber.sendMessage(MSG_GO, "%f" % (self.start_time + subscriber.vars['time_offset']))
+
     def disconnectAll(self):
         reactor.runUntilCurrent()
 
         def _disconnectAll():
-            for subscriber in self.connections_ready:
-                yield subscriber.transport.loseConnection()
+            for subscriber in self.getReadySubscribers():
+                if not subscriber.keep_connected:
+                    yield subscriber.transport.loseConnection()
         task.cooperate(_disconnectAll())
 
+    def whenKeptConnectionsClosed(self):
+        """
+        Returns a Deferred that fires once all the subscribers using barriers have disconnected.
+        """
+        if self.barrier_subscribers <= 0:
+            return succeed(None)
+
+        self._logger.info("Keeping the connection with %d subscribers open for their barriers.",
+                          self.barrier_subscribers)
+        self._kept_connections_closed_d = Deferred()
+        return self._kept_connections_closed_d
+
+    def updateKeepConnected(self, proto, amount):
+        proto.keep_connected += amount
+        self.barrier_subscribers += amount
+        if amount >= 0:
+            return
+
+        # Somebody left, the barriers waiting for it can only be reached by the rest now
+        for barrier in self.barriers.values():
+            self.checkBarrier(barrier)
+        if self.barrier_subscribers <= 0 and self._kept_connections_closed_d:
+            d, self._kept_connections_closed_d = self._kept_connections_closed_d, None
+            d.callback(None)
+
+    def getBarrierQuorum(self, quorum):
+        """
+        Returns how many subscribers have to reach a barrier with the given quorum: all the ones using barriers if
+        there is none, that fraction of them if it's up to 1 and that amount of them otherwise.
+        """
+        if not quorum:
+            return self.barrier_subscribers
+        quorum = float(quorum)
+        if quorum <= 1:
+            return int(ceil(quorum * self.barrier_subscribers))
+        return int(quorum)
+
+    def reachBarrier(self, proto, name, quorum):
+        barrier = self.barriers.get(name)
+        if barrier is None:
+            barrier = self.barriers[name] = Barrier(name, quorum)
+
+        if barrier.continue_time is not None:
+            # Released already, it can continue right away
+            self.sendContinue(proto, barrier)
+            return
+
+        barrier.reached += 1
+        barrier.waiting[proto.id] = proto
+        barrier.reached_by[proto.id] = barrier.reached_by.get(proto.id, 0) + 1
+        self.checkBarrier(barrier)
+
+    def leaveBarrier(self, proto, barrier, amount):
+        """
+        Takes amount of the subscribers behind proto out of the ones that reached barrier, they won't be there to
+        continue.
+        """
+        barrier.reached -= amount
+        barrier.reached_by[proto.id] -= amount
+        if not barrier.reached_by[proto.id]:
+            del barrier.reached_by[proto.id]
+            del barrier.waiting[proto.id]
+
+    def checkBarrier(self, barrier):
+        if barrier.continue_time is None and barrier.reached >= self.getBarrierQuorum(barrier.quorum):
+            self.releaseBarrier(barrier, time() + self.barrier_release_delay)
+
+    def releaseBarrier(self, barrier, continue_time):
+        self._logger.info("%d subscribers reached barrier %s, continuing in %f secs.", barrier.reached, barrier.name,
+                          continue_time - time())
+        barrier.continue_time = continue_time
+        barrier.span.end(reached=barrier.reached)
+        for proto in barrier.waiting.itervalues():
+            self.sendContinue(proto, barrier)
+        barrier.waiting = {}
+        barrier.reached_by = {}
+
+    def sendContinue(self, proto, barrier):
+        proto.sendMessage(MSG_CONTINUE, barrier.name, "%f" % (barrier.continue_time + proto.vars['time_offset']))
+
     def unregisterConnection(self, proto):
-        if proto in self.connections_ready:
-            self.connections_ready.remove(proto)
-        if proto in self.vars_received:
-            self.vars_received.remove(proto)
+        # Connections that were never registered or got replaced by a newer one with the same id have nothing to undo
+        if self.connections_made.get(proto.id) is not proto:
+            return
+
+        del self.connections_made[proto.id]
+        self.subscribers_made -= proto.subscribers
+        if proto.id in self.connections_ready:
+            self.connections_ready.discard(proto.id)
+            self.subscribers_ready -= proto.subscribers
         if proto.id in self.vars_received:
-            self.vars_received.remove(proto.id)
+            self.vars_received.discard(proto.id)
+            self.subscribers_received -= proto.subscribers
+        for barrier in self.barriers.itervalues():
+            if barrier.waiting.get(proto.id) is proto:
+                # The barriers are checked against the subscribers still connected below
+                self.leaveBarrier(proto, barrier, barrier.reached_by[proto.id])
+        if proto.keep_connected:
+            self.updateKeepConnected(proto, -proto.keep_connected)
+        if proto.id not in self.sessions:
+            # It can't resume its session, so the next connection to register (it reconnecting, most likely) takes
+            # over its ids
+            self.releaseIds(proto.relayed_ids or [proto.id])
+        elif self.start_time is None:
+            self.keepSession(proto)
 
         self._logger.debug("Connection cleanly unregistered.")
 
@@ -324,29 +1037,247 @@ class ExperimentServiceFactory(Factory):
 #
 
 
-class ExperimentClient(LineReceiver):
+class ClockSyncClient(FramedLineReceiver):
+
+    """
+    Client side of the framed protocol that can measure its clock offset with the server (see startClockSync).
+    """
+
+    clock_offset = None
+    clock_uncertainty = None
+    clock_rtt = None
+    _clock_samples = None
+    _clock_waiters = None
+
+    def startClockSync(self):
+        if self.clock_offset is not None:
+            # Measured already, just tell the server (we are resuming our session)
+            self.sendMessage(MSG_CLOCK, "%f" % self.clock_offset, "%f" % self.clock_uncertainty)
+            return
+
+        self._clock_samples = []
+        self.sendMessage(MSG_PING, "%f" % time())
+
+    def setPong(self, sent, server_time):
+        received = time()
+        self._clock_samples.append((received - sent, (sent + received) / 2 - server_time))
+        if len(self._clock_samples) < CLOCK_SYNC_SAMPLES:
+            self.sendMessage(MSG_PING, "%f" % time())
+            return
+
+        self.clock_rtt, self.clock_offset = min(self._clock_samples)
+        self.clock_uncertainty = self.clock_rtt / 2
+        self._clock_samples = None
+        self._logger.info("Clock offset with the experiment server is %f +/- %f secs (min. round trip %f secs)",
+                          self.clock_offset, self.clock_uncertainty, self.clock_rtt)
+        self.sendMessage(MSG_CLOCK, "%f" % self.clock_offset, "%f" % self.clock_uncertainty)
+
+        waiters, self._clock_waiters = self._clock_waiters or [], None
+        for d in waiters:
+            d.callback(None)
+
+    def whenClockSynced(self):
+        """
+        Returns a Deferred that fires once the server knows our measured clock offset, right away if we aren't
+        measuring it.
+        """
+        if self._clock_samples is None:
+            return succeed(None)
+
+        d = Deferred()
+        if self._clock_waiters is None:
+            self._clock_waiters = []
+        self._clock_waiters.append(d)
+        return d
+
+    def frame_pong(self, payload):
+        self.setPong(*map(float, payload.split('\0')))
+
+
+class PeerDirectory():
+
+    """
+    The experiment variables of all the peers, as sent by the server, indexed by peer id and by (host, port).
+    Values that are expensive to decode (such as keys) are decoded the first time they are asked for and kept.
+    """
+
+    def __init__(self, all_vars):
+        self._records = all_vars
+        self._ids = dict(((peer_dict['host'], int(peer_dict['port'])), peer_id)
+                         for peer_id, peer_dict in all_vars.iteritems())
+        self._decoded = {}
+
+    def __contains__(self, peer_id):
+        return str(peer_id) in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    def ids(self):
+        return self._records.keys()
+
+    def records(self):
+        return self._records.itervalues()
+
+    def get(self, peer_id):
+        return self._records.get(str(peer_id))
+
+    def get_id(self, host, port):
+        return self._ids.get((host, int(port)))
+
+    def get_address(self, peer_id):
+        peer_dict = self._records.get(str(peer_id))
+        if peer_dict is not None:
+            return peer_dict['host'], peer_dict['port']
+
+    def get_decoded(self, peer_id, key, decode):
+        """
+        Returns decode(value) for the value of key in the variables of peer_id, only calling decode once per peer
+        and key. Returns None if there is no such peer. The records themselves are left as they are, other users of
+        the directory may still need the encoded value.
+        """
+        peer_id = str(peer_id)
+        if (peer_id, key) not in self._decoded:
+            if peer_id not in self._records:
+                return None
+            self._decoded[peer_id, key] = decode(self._records[peer_id][key])
+        return self._decoded[peer_id, key]
+
+
+class ExperimentClient(ClockSyncClient):
     # Allow for 4MB long lines (for the json stuff)
     MAX_LENGTH = 2 ** 22
 
+    # Set to True if the server sends us our scenario actions after our id (see ExperimentServiceFactory)
+    expect_scenario = False
+
+    # Set to True before getting ready to keep the connection open after the go signal and use barriers
+    keep_connected = False
+
+    # Protocol extensions announced to the server
+    capabilities = ('zlib', 'resume')
+
+    # Version of the framed protocol to ask the server for, None to only speak the text protocol
+    protocol_version = FRAMED_PROTOCOL_VERSION
+
     def __init__(self, vars):
         self._logger = logging.getLogger(self.__class__.__name__)
 
         self.state = "id"
         self.my_id = None
         self.vars = vars
-        self.all_vars = {}
+        self.peers = PeerDirectory({})
         self.time_offset = None
+        self.scenario_actions = None
+        self.session = None
+        self.vars_sent = False
+        self.ready_sent = False
+        self._barrier_waiters = {}
+        self._raw_length = None
+        self._raw_buffer = None
 
     def connectionMade(self):
+        FramedLineReceiver.connectionMade(self)
         self._logger.debug("Connected to the experiment server")
-        self.sendLine("time:%f" % time())
+        if self.protocol_version:
+            self.sendLine("protocol:framed:%d" % self.protocol_version)
+            self.state = "protocol"
+        else:
+            self.state = self.sendVars()
+
+    def sendVars(self):
+        """
+        Sends our vars to the server, resuming our session if we have one. Returns the state to continue in.
+        """
+        if self.capabilities and not self.framed:
+            self.sendLine("capabilities:%s" % ",".join(self.capabilities))
+        if self.session:
+            received = [name for name, value in (("scenario", self.scenario_actions), ("vars", self.time_offset))
+                        if value is not None]
+            self.sendMessage(MSG_RESUME, self.my_id, self.session, ",".join(received))
+
+        self.sendMessage(MSG_TIME, "%f" % time())
         for key, val in self.vars.iteritems():
-            self.sendLine("set:%s:%s" % (key, val))
+            self.sendMessage(MSG_SET, key, str(val))
+        if self.framed and self.protocol_version >= 3:
+            self.startClockSync()
+
+        if self.session:
+            return self.resumeSession()
+
+        if not self.vars_sent:
+            # Only once, even if we have to reconnect before getting our id
+            self.vars_sent = True
+            deferToThread(self.onVarsSend)
+        return "id"
+
+    def resumeSession(self):
+        self._logger.info("Resuming the session with the experiment server as %s", self.my_id)
+        # Being ready still waits for the clock offset, and we only got the vars after being ready
+        d = self.sendReady() if self.ready_sent else succeed(None)
+        if self.time_offset is not None:
+            d.addCallback(lambda _: self.sendMessage(MSG_VARS_RECEIVED))
+            return "go"
+        if self.expect_scenario and self.scenario_actions is None:
+            return "scenario"
+        return "all_vars"
+
+    def sendReady(self):
+        # The server needs our clock offset before we are ready
+        d = self.whenClockSynced()
+        d.addCallback(lambda _: self._sendReady())
+        return d
+
+    def _sendReady(self):
+        # If the connection is lost before it gets through, it will be sent again when resuming the session
+        self.ready_sent = True
+        self.sendKeepConnected()
+        self.sendMessage(MSG_READY)
+
+    def supportsBarriers(self):
+        return self.framed and self.protocol_version >= 4
+
+    def sendKeepConnected(self):
+        if self.keep_connected and self.supportsBarriers():
+            self.sendMessage(MSG_KEEP_CONNECTED, "1")
+
+    def waitForBarrier(self, name, quorum=None):
+        """
+        Tells the server we reached the barrier called name, returns a Deferred that fires with the time at which
+        all the subscribers (or the given quorum, see ExperimentServiceFactory.getBarrierQuorum) reached it and we
+        should continue. It fires with None right away if we can't use barriers.
+        """
+        if not (self.keep_connected and self.supportsBarriers() and self.transport.connected):
+            self._logger.warning("Not connected to the experiment server with barrier support, ignoring barrier %s",
+                                 name)
+            return succeed(None)
+
+        self._logger.debug("Reached barrier %s", name)
+        d = self._barrier_waiters[name] = Deferred()
+        self.sendMessage(MSG_BARRIER, name, "" if quorum is None else str(quorum))
+        return d
+
+    def setContinue(self, name, continue_time):
+        self._logger.debug("Passed barrier %s", name)
+        d = self._barrier_waiters.pop(name, None)
+        if d:
+            d.callback(continue_time)
 
-        d = deferToThread(self.onVarsSend)
-        self.state = "id"
+    def connectionLost(self, reason=connectionDone):
+        # Don't block the scenario forever if we can't hear from the server any more
+        waiters, self._barrier_waiters = self._barrier_waiters, {}
+        for name, d in waiters.iteritems():
+            self._logger.error("Lost the connection with the experiment server while waiting for barrier %s, "
+                               "continuing", name)
+            d.callback(None)
+        ClockSyncClient.connectionLost(self, reason)
 
     def lineReceived(self, line):
+        if line.startswith("retry:"):
+            # The server is busy, it closes the connection and tells us when to come back
+            self.factory.retryAfter(float(line.strip().split(':')[1]))
+            return
+
         try:
             pto = 'proto_' + self.state
             statehandler = getattr(self, pto)
@@ -358,12 +1289,31 @@ class ExperimentClient(LineReceiver):
             if self.state == 'done':
                 self.transport.loseConnection()
 
+    def rawDataReceived(self, data):
+        if self.framed:
+            return FramedLineReceiver.rawDataReceived(self, data)
+
+        # The text protocol only uses it to receive the compressed all_vars document, see proto_all_vars
+        self._raw_buffer.append(data)
+        self._raw_length -= len(data)
+        if self._raw_length <= 0:
+            data = ''.join(self._raw_buffer)
+            extra = data[len(data) + self._raw_length:]
+            data = data[:len(data) + self._raw_length]
+            self._raw_length = self._raw_buffer = None
+
+            self.state = self.setAllVars(json.loads(zlib.decompress(data)))
+            self.setLineMode(extra)
+
     def onVarsSend(self):
         self._logger.debug("onVarsSend: Call not implemented")
 
     def onIdReceived(self):
         self._logger.debug("onIdReceived: Call not implemented")
 
+    def onScenarioReceived(self):
+        self._logger.debug("onScenarioReceived: Call not implemented")
+
     def onAllVarsReceived(self):
         self._logger.debug("onAllVarsReceived: Call not implemented")
 
@@ -371,80 +1321,405 @@ class ExperimentClient(LineReceiver):
         self._logger.debug("startExperiment: Call not implemented")
 
     def get_peer_id(self, ip, port):
-        port = int(port)
-        for peer_id, peer_dict in self.all_vars.iteritems():
-            if peer_dict['host'] == ip and int(peer_dict['port']) == port:
-                return peer_id
-
-        self._logger.error("Could not get_peer_id for %s:%s", ip, port)
+        peer_id = self.peers.get_id(ip, port)
+        if peer_id is None:
+            self._logger.error("Could not get_peer_id for %s:%s", ip, port)
+        return peer_id
 
     def get_peer_ip_port_by_id(self, peer_id):
-        if str(peer_id) in self.all_vars:
-            return self.all_vars[str(peer_id)]['host'], self.all_vars[str(peer_id)]['port']
+        return self.peers.get_address(peer_id)
 
     def get_peers(self):
-        return self.all_vars.keys()
+        return self.peers.ids()
 
     #
     # Protocol state handlers
     #
 
+    def setId(self, id):
+        self.my_id = id
+        self._logger.debug('Got id: "%s" assigned', id)
+        if self.expect_scenario:
+            return "scenario"
+
+        d = deferToThread(self.onIdReceived)
+        d.addCallback(lambda _: self.sendReady())
+        return "all_vars"
+
+    def setScenario(self, actions):
+        self.scenario_actions = actions
+        self._logger.debug('Got %d scenario actions', len(self.scenario_actions))
+        self.onScenarioReceived()
+
+        d = deferToThread(self.onIdReceived)
+        d.addCallback(lambda _: self.sendReady())
+        return "all_vars"
+
+    def setGo(self, start_time):
+        self._logger.debug("Got GO signal")
+        start_delay = max(0, start_time - time())
+        self._logger.info("Starting the experiment in %f secs.", start_delay)
+        reactor.callLater(start_delay, self.startExperiment)
+        self.factory.stopTrying()
+        if not (self.keep_connected and self.supportsBarriers()):
+            self.transport.loseConnection()
+
+    def proto_protocol(self, line):
+        # We should get a line such as:
+        # protocol:framed:VERSION or protocol:text
+        if line.strip() == "protocol:framed:%d" % self.protocol_version:
+            self._logger.debug("Using the framed protocol")
+            self.startFraming()
+            self.sendVars()
+            return "framed"
+
+        self._logger.debug("The server doesn't speak the framed protocol, using the text protocol")
+        return self.sendVars()
+
+    def setSession(self, token):
+        self.session = token
+
     def proto_id(self, line):
         # We should get a line such as:
-        # id:SOMETHING
+        # id:SOMETHING, optionally preceded by session:TOKEN
         maybe_id, id = line.strip().split(':', 1)
-        if maybe_id == "id":
-            self.my_id = id
-            self._logger.debug('Got id: "%s" assigned', id)
-            d = deferToThread(self.onIdReceived)
-            d.addCallback(lambda _: self.sendLine("ready"))
-            return "all_vars"
+        if maybe_id == "session":
+            self.setSession(id)
+            return "id"
+        elif maybe_id == "id":
+            return self.setId(id)
+        else:
+            self._logger.error("Received an unexpected string from the server, closing connection")
+            return "done"
+
+    def proto_scenario(self, line):
+        # We should get a line such as:
+        # scenario:[[TIMESTAMP, LINENO, CALLABLE, ARGS, REPEAT], ...]
+        maybe_scenario, actions = line.strip().split(':', 1)
+        if maybe_scenario == "scenario":
+            return self.setScenario(json.loads(actions))
         else:
             self._logger.error("Received an unexpected string from the server, closing connection")
             return "done"
 
     def proto_all_vars(self, line):
-        self._logger.debug("Got experiment variables")
+        if line.startswith("all_vars:zlib:"):
+            # The compressed document follows as raw data
+            self._raw_length = int(line.strip().split(':')[2])
+            self._raw_buffer = []
+            self.setRawMode()
+            return "all_vars"
+
+        return self.setAllVars(json.loads(line))
 
-        self.all_vars = json.loads(line)
-        self.time_offset = self.all_vars[self.my_id]["time_offset"]
+    def setAllVars(self, all_vars):
+        self._logger.debug("Got experiment variables for %d peers", len(all_vars))
+
+        # Only the index is kept, so the document can be freed
+        self.peers = PeerDirectory(all_vars)
+        self.time_offset = self.peers.get(self.my_id)["time_offset"]
         self.onAllVarsReceived()
 
-        self.sendLine("vars_received")
+        self.sendMessage(MSG_VARS_RECEIVED)
         return "go"
 
     def proto_go(self, line):
-        self._logger.debug("Got GO signal")
         if line.strip().startswith("go:"):
-            start_delay = max(0, float(line.strip().split(":")[1]) - time())
-            self._logger.info("Starting the experiment in %f secs.", start_delay)
-            reactor.callLater(start_delay, self.startExperiment)
-            self.factory.stopTrying()
-            self.transport.loseConnection()
+            self.setGo(float(line.strip().split(":")[1]))
+
+    #
+    # Framed protocol message handlers
+    #
+
+    def frame_session(self, payload):
+        self.setSession(payload)
+
+    def frame_id(self, payload):
+        self.setId(payload)
+
+    def frame_scenario(self, payload):
+        self.setScenario(json.loads(payload))
+
+    def frame_all_vars(self, payload):
+        self.setAllVars(json.loads(zlib.decompress(payload)))
+
+    def frame_go(self, payload):
+        self.setGo(float(payload))
+
+    def frame_continue(self, payload):
+        name, continue_time = payload.split('\0')
+        self.setContinue(name, float(continue_time))
 
+    frame_handlers = {MSG_PONG: ClockSyncClient.frame_pong,
+                      MSG_SESSION: frame_session,
+                      MSG_ID: frame_id,
+                      MSG_SCENARIO: frame_scenario,
+                      MSG_ALL_VARS: frame_all_vars,
+                      MSG_GO: frame_go,
+                      MSG_CONTINUE: frame_continue}
 
-class ExperimentClientFactory(ReconnectingClientFactory):
+
+class ExperimentSyncClientFactory(ReconnectingClientFactory):
+
+    """
+    Reconnects to the sync server when the connection is lost, right when the server said to if it turned us away
+    because it was busy.
+    """
     maxDelay = 10
+    retry_after = None
+
+    def retryAfter(self, delay):
+        self._logger.debug("The experiment server is busy, connecting again in %.3f secs.", delay)
+        self.retry_after = delay
+
+    def clientConnectionLost(self, connector, reason):
+        if self.retry_after is None or not self.continueTrying:
+            ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+            return
+
+        delay, self.retry_after = self.retry_after, None
+        self.connector = connector
+
+        def reconnector():
+            self._callID = None
+            connector.connect()
+        self._callID = reactor.callLater(delay, reconnector)
+
+
+class ExperimentClientFactory(ExperimentSyncClientFactory):
 
     def __init__(self, vars, protocol=ExperimentClient):
         self._logger = logging.getLogger(self.__class__.__name__)
 
         self.vars = vars
         self.protocol = protocol
+        self.client = None
 
     def buildProtocol(self, address):
-        self._logger.debug("Attempting to connect to the experiment server.")
-        p = self.protocol(self.vars)
-        p.factory = self
-        return p
+        self.resetDelay()
+        if self.client is None:
+            self._logger.debug("Attempting to connect to the experiment server.")
+            self.client = self.protocol(self.vars)
+            self.client.factory = self
+        else:
+            # Keep the same client, so it can resume its session with the server
+            self._logger.debug("Reconnecting to the experiment server.")
+        return self.client
 
     def clientConnectionFailed(self, connector, reason):
         self._logger.error("Failed to connect to experiment server (will retry in a while), error was: %s",
                            reason.getErrorMessage())
+        ExperimentSyncClientFactory.clientConnectionFailed(self, connector, reason)
 
     def clientConnectionLost(self, connector, reason):
-        self._logger.info("The connection with the experiment server was lost with reason: %s",
-                          reason.getErrorMessage())
+        if self.retry_after is None:
+            self._logger.info("The connection with the experiment server was lost with reason: %s",
+                              reason.getErrorMessage())
+        ExperimentSyncClientFactory.clientConnectionLost(self, connector, reason)
+
+#
+# Relay
+#
+
+
+class ExperimentRelayFactory(ExperimentServiceFactory):
+
+    """
+    Sync server for the subscribers of a single node, that relays them to the real sync server through a single
+    connection (see ExperimentRelayClient).
+    """
+
+    def __init__(self, expected_subscribers, upstream_host, upstream_port):
+        ExperimentServiceFactory.__init__(self, expected_subscribers, 0)
+
+        self.upstream = None
+        self.upstream_ids = None
+        self.upstream_ready = False
+        # The scenario actions of our subscribers by id, if the server distributes the scenario
+        self.upstream_scenario = None
+        self._upstream_factory = ExperimentRelayClientFactory(self)
+
+        reactor.connectTCP(upstream_host, upstream_port, self._upstream_factory)
+
+    def setUpstream(self, upstream):
+        self.upstream = upstream
+
+    def hasScenario(self):
+        return self.upstream_scenario is not None
+
+    def getScenarioActions(self, id):
+        return self.upstream_scenario[id]
+
+    def setUpstreamScenario(self, actions):
+        self.upstream_scenario = dict((int(id), id_actions) for id, id_actions in actions.iteritems())
+
+    def setUpstreamIds(self, ids):
+        self.upstream_ids = ids
+        if self.subscribers_made >= self.expected_subscribers:
+            self.pushIdToSubscribers()
+
+    def setConnectionMade(self, proto):
+        if self.ids_pushed and not proto.resumed:
+            # A subscriber reconnected, it takes over the id of the connection that was lost
+            free_ids = set(self.upstream_ids).difference(self.connections_made)
+            if not free_ids:
+                self._logger.error("Got a connection from an unexpected subscriber, closing it.")
+                proto.transport.loseConnection()
+                return
+            proto.id = free_ids.pop()
+        ExperimentServiceFactory.setConnectionMade(self, proto)
+
+    def pushIdToSubscribers(self):
+        # We can only hand out the ids the server assigned to our subscribers
+        if self.upstream_ids is None:
+            return
+
+        protos = self.connections_made.values()
+        self.connections_made = {}
+        for proto, id in zip(protos, self.upstream_ids):
+            proto.id = id
+            self.connections_made[id] = proto
+        ExperimentServiceFactory.pushIdToSubscribers(self)
+
+    def pushInfoToSubscribers(self):
+        # All our subscribers are ready, the server will send us the vars of everybody
+        if self.upstream_ready:
+            # Somebody resumed its session, its vars got there already
+            return
+        self.upstream_ready = True
+        self._logger.info("All subscribers are ready, sending their vars upstream.")
+        relayed_vars = json.dumps(dict((proto.id, proto.vars) for proto in self.getReadySubscribers()))
+        d = self.upstream.whenClockSynced()
+        d.addCallback(lambda _: self.upstream.sendMessage(MSG_RELAY_READY, relayed_vars))
+
+    def updateKeepConnected(self, proto, amount):
+        ExperimentServiceFactory.updateKeepConnected(self, proto, amount)
+        if self.upstream:
+            self.upstream.sendMessage(MSG_KEEP_CONNECTED, str(amount))
+
+    def reachBarrier(self, proto, name, quorum):
+        barrier = self.barriers.get(name)
+        if barrier is None or barrier.continue_time is None:
+            self.upstream.sendMessage(MSG_BARRIER, name, quorum)
+        ExperimentServiceFactory.reachBarrier(self, proto, name, quorum)
+
+    def leaveBarrier(self, proto, barrier, amount):
+        ExperimentServiceFactory.leaveBarrier(self, proto, barrier, amount)
+        if self.upstream:
+            for _ in xrange(amount):
+                self.upstream.sendMessage(MSG_BARRIER_LEFT, barrier.name)
+
+    def checkBarrier(self, barrier):
+        # The server decides when the barriers are released
+        pass
+
+    def continueBarrier(self, name, continue_time):
+        barrier = self.barriers.get(name)
+        if barrier is None:
+            barrier = self.barriers[name] = Barrier(name, None)
+        self.releaseBarrier(barrier, continue_time)
+
+    def startExperiment(self, start_time=None):
+        if start_time is None:
+            # All our subscribers got the vars, the server will tell us when to start
+            self.upstream.sendMessage(MSG_VARS_RECEIVED)
+        else:
+            ExperimentServiceFactory.startExperiment(self, start_time)
+
+    def onExperimentSetupTimeout(self):
+        if self.subscribers_made >= self.expected_subscribers:
+            # All our subscribers are here, keep waiting for the server as long as we are connected to it
+            self._logger.info("Still waiting for the sync server.")
+            self._timeout_delayed_call = reactor.callLater(EXPERIMENT_SYNC_TIMEOUT, self.onExperimentSetupTimeout)
+        else:
+            ExperimentServiceFactory.onExperimentSetupTimeout(self)
+
+    def onUpstreamLost(self):
+        self._logger.error("Lost the connection with the sync server before starting, exiting.")
+        reactor.exitCode = 1
+        reactor.callLater(0, stopReactor)
+
+
+class ExperimentRelayClient(ClockSyncClient):
+
+    """
+    Connection of a relay to the sync server, speaking on behalf of all the subscribers of the relay.
+    """
+
+    def __init__(self, relay):
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self.relay = relay
+        self.state = "protocol"
+        self.started = False
+
+    def connectionMade(self):
+        self._logger.debug("Connected to the experiment server")
+        self.sendLine("protocol:framed:%d" % FRAMED_PROTOCOL_VERSION)
+
+    def lineReceived(self, line):
+        # The protocol negotiation is the only line we expect, unless the server is busy
+        if line.startswith("retry:"):
+            self.factory.retryAfter(float(line.strip().split(':')[1]))
+        elif line.strip() == "protocol:framed:%d" % FRAMED_PROTOCOL_VERSION:
+            self.startFraming()
+            self.relay.setUpstream(self)
+            self.sendMessage(MSG_RELAY, str(self.relay.expected_subscribers))
+            self.sendMessage(MSG_TIME, "%f" % time())
+            self.startClockSync()
+        else:
+            self._logger.error("The server doesn't speak the framed protocol, relays need it.")
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason=connectionDone):
+        if not self.started and self.factory.retry_after is None:
+            self.relay.onUpstreamLost()
+        ClockSyncClient.connectionLost(self, reason)
+
+    def frame_scenario(self, payload):
+        self.relay.setUpstreamScenario(json.loads(payload))
+
+    def frame_relay_ids(self, payload):
+        self.relay.setUpstreamIds([int(id) for id in payload.split(',')])
+
+    def frame_all_vars(self, payload):
+        self.relay.pushAllVars(compressed_vars=payload)
+
+    def frame_go(self, payload):
+        self.started = True
+        self.relay.startExperiment(float(payload))
+        self.factory.stopTrying()
+        if not self.relay.barrier_subscribers:
+            self.transport.loseConnection()
+
+    def frame_continue(self, payload):
+        name, continue_time = payload.split('\0')
+        self.relay.continueBarrier(name, float(continue_time))
+
+    frame_handlers = {MSG_PONG: ClockSyncClient.frame_pong,
+                      MSG_SCENARIO: frame_scenario,
+                      MSG_RELAY_IDS: frame_relay_ids,
+                      MSG_ALL_VARS: frame_all_vars,
+                      MSG_GO: frame_go,
+                      MSG_CONTINUE: frame_continue}
+
+
+class ExperimentRelayClientFactory(ExperimentSyncClientFactory):
+
+    def __init__(self, relay):
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self.relay = relay
+
+    def buildProtocol(self, address):
+        p = ExperimentRelayClient(self.relay)
+        p.factory = self
+        return p
+
+    def clientConnectionFailed(self, connector, reason):
+        self._logger.error("Failed to connect to experiment server (will retry in a while), error was: %s",
+                           reason.getErrorMessage())
+        ExperimentSyncClientFactory.clientConnectionFailed(self, connector, reason)
 
 #
 # Aux stuff
@@ -0,0 +1,84 @@
+# test_dispersyclient.py ---
+#
+# Filename: test_dispersyclient.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Tue Oct 20 10:41:52 2026 (+0200)
+
+# Commentary:
+#
+# Tests for the parts of the Dispersy experiment client that don't need Dispersy.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from StringIO import StringIO
+from os import environ, makedirs, path
+
+from twisted.trial.unittest import TestCase
+
+from gumby.experiments.dispersyclient import DispersyExperimentScriptClient, dry_run
+
+
+class DryRunTestClient(DispersyExperimentScriptClient):
+    scenario_file = "dry_run.scenario"
+
+
+class TestDryRun(TestCase):
+
+    # It takes about a second, one timer per action made it take minutes
+    timeout = 60
+
+    def setUp(self):
+        experiment_dir = self.mktemp()
+        makedirs(experiment_dir)
+        self.patch(environ, 'data', dict(environ, EXPERIMENT_DIR=experiment_dir))
+        self.scenario_file = path.join(experiment_dir, DryRunTestClient.scenario_file)
+
+    def test_many_actions(self):
+        with open(self.scenario_file, 'w') as f:
+            f.write("@0:0 start_dispersy\n")
+            f.write("@0:1 online {1}\n")
+            for i in xrange(2, 10002):
+                f.write("@%d:%d:%d echo %d\n" % (i / 3600, i / 60 % 60, i % 60, i))
+            f.write("@3:0:0 stop\n")
+            f.write("@3:0:1 echo late {2}\n")
+
+        output = StringIO()
+        dry_run(DryRunTestClient, 2, bucket_size=3600, outputfile=output)
+
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith("# Dry run of %s for 2 peers" % self.scenario_file))
+        self.assertIn("to run 10801 virtual seconds", lines[0])
+        peers = lines[lines.index("# peer actions buffered ignored_after_stop") + 1:lines.index("# time action count")]
+        # The echo after stop is ignored
+        self.assertEqual(peers, ["1 10003 0 0", "2 10002 0 1"])
+        totals = lines[lines.index("# time action count") + 1:]
+        self.assertEqual(totals, ["0 echo 7196", "0 online 1", "0 start_dispersy 2", "3600 echo 7200", "7200 echo 5604",
+                                  "10800 stop 2"])
+
+#
+# test_dispersyclient.py ends here
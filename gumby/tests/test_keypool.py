@@ -0,0 +1,108 @@
+# test_keypool.py ---
+#
+# Filename: test_keypool.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Mon Oct 19 13:02:25 2026 (+0200)
+
+# Commentary:
+#
+# Tests for the member key pools, with a fake crypto class so Dispersy isn't needed.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from os import path, urandom
+
+from twisted.trial.unittest import TestCase
+
+from gumby.experiments.keypool import KeyPool, generate_key_pool, write_key_pool
+
+FAKE_CRYPTO = "gumby.tests.test_keypool.FakeCrypto"
+
+
+class FakeCrypto(object):
+
+    def generate_key(self, curve):
+        return urandom(20)
+
+    def key_to_bin(self, key):
+        return key
+
+
+class FakeNoCrypto(FakeCrypto):
+    pass
+
+
+class TestKeyPool(TestCase):
+
+    def test_read_keys(self):
+        filename = self.mktemp()
+        keys = ["key %d" % i * i for i in range(1, 11)]
+        write_key_pool(filename, FAKE_CRYPTO, u"NID_secp160k1", keys)
+
+        pool = KeyPool(filename)
+        self.assertEqual(len(pool), 10)
+        self.assertEqual(pool.get_key_bin(1), keys[0])
+        self.assertEqual(pool.get_key_bin("10"), keys[9])
+        self.assertEqual(pool.get_key_bins(), keys)
+        self.assertRaises(IndexError, pool.get_key_bin, 11)
+        self.assertRaises(IndexError, pool.get_key_bin, 0)
+
+    def test_check_keys(self):
+        filename = self.mktemp()
+        write_key_pool(filename, FAKE_CRYPTO, u"NID_secp160k1", ["key"])
+
+        pool = KeyPool(filename)
+        pool.check_keys(FakeCrypto(), u"NID_secp160k1")
+        pool.check_keys(FakeNoCrypto(), u"NID_secp160k1")
+        pool.check_keys("Tribler." + FAKE_CRYPTO, u"NID_secp160k1")
+        self.assertRaises(ValueError, pool.check_keys, FakeCrypto(), u"NID_sect233k1")
+        self.assertRaises(ValueError, pool.check_keys, object(), u"NID_secp160k1")
+
+    def test_not_a_pool(self):
+        filename = self.mktemp()
+        with open(filename, 'wb') as f:
+            f.write("GSCN" + "\0" * 20)
+        self.assertRaises(ValueError, KeyPool, filename)
+
+    def test_generate_and_extend(self):
+        filename = self.mktemp()
+        generate_key_pool(5, FAKE_CRYPTO, u"NID_secp160k1", filename, processes=1)
+        keys = KeyPool(filename).get_key_bins()
+        self.assertEqual(len(keys), 5)
+
+        # Existing keys are kept when the pool is extended
+        generate_key_pool(12, FAKE_CRYPTO, u"NID_secp160k1", filename, processes=1)
+        pool = KeyPool(filename)
+        self.assertEqual(len(pool), 12)
+        self.assertEqual(pool.get_key_bins()[:5], keys)
+
+        self.assertRaises(ValueError, generate_key_pool, 12, FAKE_CRYPTO, u"NID_sect233k1", filename, 1)
+        self.assertTrue(path.exists(filename))
+
+#
+# test_keypool.py ends here
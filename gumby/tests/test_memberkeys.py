@@ -0,0 +1,86 @@
+# test_memberkeys.py ---
+#
+# Filename: test_memberkeys.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Mon Oct 19 11:36:08 2026 (+0200)
+
+# Commentary:
+#
+# Tests for the seed derived member keys. The expected keys were checked with "openssl ec -inform DER -check".
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from twisted.trial.unittest import SkipTest, TestCase
+
+from gumby.experiments.keypool import DEFAULT_CRYPTO, load_crypto
+from gumby.experiments.memberkeys import CURVES, _point_mul, derive_member_key, derive_private_number
+
+EXPECTED_KEYS = {
+    u"NID_secp160k1": "30510201010415000a8ba663b08586edb7bc6653a734f23af1496dffa00706052b81040009a12c032a00044d8892"
+                      "e1e30c6fc10c01413537c42b93006415e266f8944fd883d51fac7e2fc3837b47d68bbcfc48",
+    u"NID_secp256k1": "30740201010420c6127db91a427a00fde013f3526337f9211866aac62830bbc8fa65c54a73fce3a00706052b8104"
+                      "000aa1440342000496152e436ea30cb6a6e2a98167b75b5ed7ae8c1f211520f87a45935a9877b4a4f1c03f4f1f21"
+                      "0318e4b5fb321ecee90b87f8c8a89eb44f7c6afc333bd878e9cc",
+}
+
+
+class TestMemberKeys(TestCase):
+
+    def test_known_keys(self):
+        for curve_name, expected in EXPECTED_KEYS.iteritems():
+            self.assertEqual(derive_member_key("gumby", 1, curve_name).encode("HEX"), expected)
+
+    def test_peers_get_different_keys(self):
+        keys = set(derive_member_key("gumby", peer_id) for peer_id in range(1, 51))
+        self.assertEqual(len(keys), 50)
+        self.assertNotEqual(derive_member_key("gumby", 1), derive_member_key("other seed", 1))
+
+    def test_points_on_curve(self):
+        for curve_name, curve in CURVES.iteritems():
+            _, p, a, b, _, _, order = curve
+            x, y = _point_mul(curve, derive_private_number("gumby", 7, curve_name))
+            self.assertEqual(y * y % p, (x * x * x + a * x + b) % p)
+            # The generator has the order of the curve
+            self.assertIsNone(_point_mul(curve, order))
+
+    def test_unsupported_curve(self):
+        error = self.assertRaises(ValueError, derive_member_key, "gumby", 1, u"NID_sect233k1")
+        self.assertIn("NID_secp160k1", str(error))
+
+    def test_load_with_crypto(self):
+        try:
+            crypto = load_crypto(DEFAULT_CRYPTO)
+        except ImportError:
+            raise SkipTest("%s is not available" % DEFAULT_CRYPTO)
+
+        key = derive_member_key("gumby", 1)
+        ec = crypto.key_from_private_bin(key)
+        self.assertEqual(crypto.key_to_bin(ec), key)
+
+#
+# test_memberkeys.py ends here
@@ -0,0 +1,352 @@
+# test_scenario.py ---
+#
+# Filename: test_scenario.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Mon Oct 19 15:12:40 2026 (+0200)
+
+# Commentary:
+#
+# Tests for the peer specifications and the compiled scenarios, which have to give every peer the same actions as
+# parsing the text scenario does.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from StringIO import StringIO
+from os import environ
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from gumby.scenario import PeerSpec, ScenarioCompiler, ScenarioRunner, get_compiled_scenario_path, parse_peerspec
+
+SCENARIO = """@0:0 start
+@0:1 online {1-3, 5}
+@0:2 churn 0.5 "two words" {!2,4}
+# a comment
+@0:3-0:30/5 ping $GUMBY_TEST_TARGET {6}
+@0:4 offline {4-5,3}
+@0:5 set_name peer%{peer} {!1-6}
+@1:0 stop
+"""
+
+
+class TestPeerSpec(TestCase):
+
+    def test_intervals(self):
+        spec = PeerSpec("7, 1-3, 2-4,10")
+        self.assertEqual(list(spec), [1, 2, 3, 4, 7, 10])
+        self.assertEqual(len(spec), 6)
+        self.assertEqual(spec.max_peer, 10)
+        self.assertIn(4, spec)
+        self.assertNotIn(5, spec)
+        self.assertNotIn(11, spec)
+        self.assertTrue(spec.matches(7))
+        self.assertFalse(spec.matches(8))
+
+    def test_adjacent_intervals_merge(self):
+        spec = PeerSpec("1-3,4-6,8")
+        self.assertEqual(spec._lows, [1, 8])
+        self.assertEqual(spec._highs, [6, 8])
+
+    def test_negated(self):
+        spec = PeerSpec("!2,4-5")
+        self.assertTrue(spec.negated)
+        self.assertIn(2, spec)
+        self.assertFalse(spec.matches(2))
+        self.assertTrue(spec.matches(3))
+        self.assertEqual(list(spec.peers(7)), [1, 3, 6, 7])
+        self.assertEqual(list(spec.peers(3)), [1, 3])
+
+    def test_empty(self):
+        spec = PeerSpec("")
+        self.assertFalse(spec)
+        self.assertEqual(spec.max_peer, 0)
+        self.assertTrue(spec.matches(42))
+        self.assertEqual(list(spec.peers(3)), [1, 2, 3])
+
+    def test_peers(self):
+        self.assertEqual(list(PeerSpec("2-4,9").peers(5)), [2, 3, 4])
+
+    def test_cached(self):
+        self.assertIs(parse_peerspec("1,3-5"), parse_peerspec("1,3-5"))
+        self.assertIsNot(parse_peerspec("1,3-5"), parse_peerspec("1, 3-5"))
+
+
+class TestCompiledScenario(TestCase):
+
+    def setUp(self):
+        self.setEnviron("GUMBY_TEST_TARGET", "peer1")
+        self.filename = self.mktemp()
+        with open(self.filename, 'w') as f:
+            f.write(SCENARIO)
+
+    def setEnviron(self, name, value):
+        old_value = environ.get(name)
+        environ[name] = value
+        if old_value is None:
+            self.addCleanup(environ.pop, name, None)
+        else:
+            self.addCleanup(environ.__setitem__, name, old_value)
+
+    def makeRunner(self, peernumber):
+        runner = ScenarioRunner(self.filename)
+        runner.set_peernumber(peernumber)
+        return runner
+
+    def test_round_trip(self):
+        compiler = ScenarioCompiler(self.filename, peer_count=7)
+        self.assertEqual(compiler.compile(), get_compiled_scenario_path(self.filename))
+
+        for peer in range(1, 8):
+            runner = self.makeRunner(peer)
+            self.assertTrue(runner.has_compiled_scenario())
+            expected = list(runner._parse_scenario(self.filename))
+            self.assertEqual(runner._load_compiled_scenario(), expected)
+            self.assertEqual(compiler.get_actions(peer), expected)
+
+    def test_actions(self):
+        compiler = ScenarioCompiler(self.filename, peer_count=7)
+        self.assertEqual([action[2] for action in compiler.get_actions(4)], ["start", "offline", "stop"])
+        self.assertEqual([action[2] for action in compiler.get_actions(7)],
+                         ["start", "churn", "set_name", "stop"])
+        self.assertEqual(compiler.get_actions(1)[2], (2, 3, "churn", ["0.5", "two words"], None))
+        self.assertEqual(compiler.get_actions(6)[2], (3, 5, "ping", ["peer1"], (5, 30)))
+
+    def test_peer_count_from_scenario(self):
+        compiler = ScenarioCompiler(self.filename)
+        compiler.parse()
+        self.assertEqual(compiler.peer_count, 6)
+
+    def test_stale(self):
+        ScenarioCompiler(self.filename, peer_count=7).compile()
+        with open(self.filename, 'a') as f:
+            f.write("@1:1 online\n")
+
+        runner = self.makeRunner(1)
+        self.assertFalse(runner.has_compiled_scenario())
+        self.assertIsNone(runner._load_compiled_scenario())
+
+    def test_substitution_changed(self):
+        ScenarioCompiler(self.filename, peer_count=7).compile()
+        self.setEnviron("GUMBY_TEST_TARGET", "peer2")
+
+        runner = self.makeRunner(6)
+        self.assertIsNone(runner._load_compiled_scenario())
+        runner.register(lambda target: None, "ping")
+        runner.parse_file()
+        self.assertEqual(runner._my_actions, [(3, "ping", ["peer2"], (5, 6))])
+
+    def test_unknown_peer(self):
+        ScenarioCompiler(self.filename, peer_count=7).compile()
+        self.assertIsNone(self.makeRunner(8)._load_compiled_scenario())
+
+    def test_not_compiled(self):
+        with open(get_compiled_scenario_path(self.filename), 'w') as f:
+            f.write("@0:0 start\n")
+        self.assertFalse(self.makeRunner(1).has_compiled_scenario())
+
+
+class ScenarioRunnerTestCase(TestCase):
+
+    """
+    Runs scenarios on a fake clock, with every action recording when it ran.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.ran = []
+
+    def makeRunner(self, scenario, single_timer=False, callables=("start", "ping", "stop"), peernumber=1):
+        filename = self.mktemp()
+        with open(filename, 'w') as f:
+            f.write(scenario)
+
+        runner = ScenarioRunner(filename, expstartstamp=self.clock.seconds(), single_timer=single_timer,
+                                clock=self.clock)
+        runner.set_peernumber(peernumber)
+        for name in callables:
+            runner.register(self.recorder(name), name)
+        return runner
+
+    def recorder(self, name):
+        def record(*args):
+            self.ran.append((self.clock.seconds(), name, list(args)))
+        return record
+
+    def runAll(self, runner):
+        runner.run()
+        while self.clock.getDelayedCalls():
+            self.clock.advance(min(call.getTime() for call in self.clock.getDelayedCalls()) - self.clock.seconds())
+
+
+class TestSingleTimer(ScenarioRunnerTestCase):
+
+    SCENARIO = """@0:5 ping b
+@0:1 start
+@0:5 ping a
+@0:0 ping first
+@0:5 ping c
+@1:0 stop
+"""
+
+    def test_same_order(self):
+        for single_timer in (False, True):
+            self.setUp()
+            self.runAll(self.makeRunner(self.SCENARIO, single_timer))
+            self.assertEqual(self.ran, [(0, "ping", ["first"]), (1, "start", []), (5, "ping", ["b"]),
+                                        (5, "ping", ["a"]), (5, "ping", ["c"]), (60, "stop", [])])
+
+    def test_one_timer(self):
+        runner = self.makeRunner(self.SCENARIO, single_timer=True)
+        runner.run()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.assertEqual(runner.get_pending_actions_count(), 6)
+
+        # The three actions at 0:05 run in one go
+        self.clock.advance(5)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.assertEqual(runner.get_pending_actions_count(), 1)
+
+        self.clock.advance(55)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(runner.get_pending_actions_count(), 0)
+
+    def test_failing_action(self):
+        runner = self.makeRunner(self.SCENARIO, single_timer=True, callables=("start", "stop"))
+
+        def fail(name):
+            self.ran.append((self.clock.seconds(), "fail", [name]))
+            raise RuntimeError(name)
+        runner.register(fail, "ping")
+        self.runAll(runner)
+
+        # The rest of the batch still runs
+        self.assertEqual(self.ran, [(0, "fail", ["first"]), (1, "start", []), (5, "fail", ["b"]), (5, "fail", ["a"]),
+                                    (5, "fail", ["c"]), (60, "stop", [])])
+
+
+class TestRepeatedActions(ScenarioRunnerTestCase):
+
+    def test_repeat(self):
+        for single_timer in (False, True):
+            self.setUp()
+            runner = self.makeRunner("@0:10-0:40/10 ping\n@0:15 start\n", single_timer)
+            runner.run()
+            self.clock.advance(10)
+            # A single looping call runs all the repetitions
+            self.assertEqual(runner.get_pending_actions_count(), 2)
+            self.clock.pump([1] * 60)
+
+            self.assertEqual(self.ran, [(10, "ping", []), (15, "start", []), (20, "ping", []), (30, "ping", []),
+                                        (40, "ping", [])])
+            self.assertEqual(runner.get_pending_actions_count(), 0)
+
+    def test_templates(self):
+        runner = self.makeRunner("@0:0-0:2/1 ping \"%{peer * 10 + repetition}\" at%{time} plain\n"
+                                 "@0:5 start %{max(peer,5)} {3}\n", peernumber=3)
+        self.runAll(runner)
+        self.assertEqual(self.ran, [(0, "ping", ["30", "at0", "plain"]), (1, "ping", ["31", "at1", "plain"]),
+                                    (2, "ping", ["32", "at2", "plain"]), (5, "start", ["5"])])
+
+    def test_invalid_template(self):
+        runner = self.makeRunner("@0:0 ping %{__import__('os')}\n@0:1 start\n", single_timer=True)
+        self.runAll(runner)
+        # The action fails when it runs, the rest of the scenario doesn't
+        self.assertEqual(self.ran, [(1, "start", [])])
+
+    def test_invalid_repeat(self):
+        runner = self.makeRunner("@0:10-0:5/1 ping\n@0:0-0:5/0 ping\n@0:1 start\n")
+        runner.parse_file()
+        self.assertEqual(runner._my_actions, [(1, "start", [], None)])
+
+
+class TestActionLog(ScenarioRunnerTestCase):
+
+    def test_records(self):
+        runner = self.makeRunner("@0:0 start\n@0:2 work\n@0:4 fetch\n@0:5 hang\n", callables=("start",))
+        hanging = Deferred()
+
+        def work():
+            self.clock.rightNow += 0.5
+
+        def fetch():
+            d = Deferred()
+            self.clock.callLater(2, d.callback, None)
+            return d
+        runner.register(work)
+        runner.register(fetch)
+        runner.register(lambda: hanging, "hang")
+
+        log = StringIO()
+        runner.set_action_log(log)
+        runner.run()
+        self.clock.advance(0)
+        # Started a second late, it runs for half a second
+        self.clock.advance(3)
+        for _ in range(3):
+            self.clock.advance(int(self.clock.seconds()) + 1 - self.clock.seconds())
+        runner.flush_action_log()
+
+        self.assertEqual(log.getvalue().splitlines(), ["# scheduled drift duration deferred callable",
+                                                       "0 0.000000 0.000000 - start",
+                                                       "2 1.000000 0.500000 - work",
+                                                       "4 0.000000 0.000000 2.000000 fetch",
+                                                       "5 0.000000 0.000000 ? hang"])
+
+        # Only the actions that never fired are flushed
+        hanging.callback(None)
+        runner.flush_action_log()
+        self.assertEqual(len(log.getvalue().splitlines()), 5)
+
+    def test_repeat_across_barrier(self):
+        runner = self.makeRunner("@0:0-0:8/2 ping\n@0:4 sync\n@0:6 start\n", callables=("start", "ping"))
+
+        def sync():
+            # Passed half a second later, continuing a second later than scheduled
+            d = Deferred()
+            self.clock.callLater(0.5, d.callback, self.clock.seconds() + 1)
+            return d
+        runner.register_barrier(sync)
+
+        log = StringIO()
+        runner.set_action_log(log)
+        self.runAll(runner)
+        runner.flush_action_log()
+
+        self.assertEqual([(when, name) for when, name, _ in self.ran],
+                         [(0, "ping"), (2, "ping"), (4, "ping"), (6, "ping"), (7, "start"), (8, "ping")])
+        # The repetitions run on the schedule they started with, the actions after the barrier on the new one
+        lines = log.getvalue().splitlines()
+        self.assertEqual([line for line in lines if line.endswith("ping")],
+                         ["%d 0.000000 0.000000 - ping" % tstmp for tstmp in range(0, 10, 2)])
+        self.assertIn("4 0.000000 0.000000 0.500000 sync", lines)
+        self.assertIn("6 0.000000 0.000000 - start", lines)
+
+#
+# test_scenario.py ends here
@@ -0,0 +1,133 @@
+# test_stages.py ---
+#
+# Filename: test_stages.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Wed Oct 21 11:02:37 2026 (+0200)
+
+# Commentary:
+#
+# Tests for the stage scheduler, which has to start every stage as soon as the ones it depends on are done and stop at
+# the first failing one.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from twisted.internet.defer import Deferred
+from twisted.trial.unittest import TestCase
+
+from gumby import stages
+from gumby.stages import LineProbe, StageScheduler
+
+
+class TestStageScheduler(TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.patch(stages, 'time', lambda: self.now)
+        self.scheduler = StageScheduler()
+        self.started = []
+        self.stages = {}
+
+    def addStage(self, name, after=()):
+        def start():
+            self.started.append(name)
+            d = self.stages[name] = Deferred()
+            return d
+        self.scheduler.addStage(name, start, after)
+
+    def finish(self, name, at):
+        self.now = at
+        self.stages[name].callback(None)
+
+    def test_order(self):
+        self.addStage("tracker")
+        self.addStage("server")
+        self.addStage("peers", after=("tracker", "server"))
+        self.addStage("collect", after=("peers",))
+        done = []
+        self.scheduler.run().addCallback(done.append)
+
+        # The stages without dependencies start right away, the rest once all of theirs are done
+        self.assertEqual(self.started, ["tracker", "server"])
+        self.finish("server", 1)
+        self.assertEqual(self.started, ["tracker", "server"])
+        self.finish("tracker", 3)
+        self.assertEqual(self.started, ["tracker", "server", "peers"])
+        self.assertEqual(self.scheduler.start_times["peers"], 3)
+        self.finish("peers", 10)
+        self.assertEqual(done, [])
+        self.finish("collect", 12)
+
+        self.assertEqual(done, [None])
+        self.assertEqual(self.scheduler.getCriticalPath(), ["tracker", "peers", "collect"])
+
+    def test_synchronous_stages(self):
+        ran = []
+        self.scheduler.addStage("build", lambda: ran.append("build"))
+        self.scheduler.addStage("deploy", lambda: ran.append("deploy"), after=("build",))
+        done = []
+        self.scheduler.run().addCallback(done.append)
+
+        self.assertEqual(ran, ["build", "deploy"])
+        self.assertEqual(done, [None])
+
+    def test_failure(self):
+        self.addStage("tracker")
+        self.addStage("server")
+        self.addStage("peers", after=("tracker", "server"))
+        failures = []
+        self.scheduler.run().addErrback(failures.append)
+
+        self.stages["tracker"].errback(RuntimeError("tracker died"))
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(failures[0].check(RuntimeError))
+
+        # The stages still running can end, but nothing else starts or fails the run again
+        self.stages["server"].callback(None)
+        self.assertEqual(self.started, ["tracker", "server"])
+        self.assertEqual(len(failures), 1)
+        self.assertNotIn("peers", self.scheduler.start_times)
+
+    def test_unknown_dependency(self):
+        self.assertRaises(ValueError, self.scheduler.addStage, "peers", lambda: None, ("tracker",))
+
+
+class TestLineProbe(TestCase):
+
+    def test_ready(self):
+        probe = LineProbe("Listening on")
+        ready = []
+        probe.ready.addCallback(ready.append)
+
+        probe("Starting up")
+        self.assertEqual(ready, [])
+        probe("INFO Listening on port 7788")
+        probe("Listening on port 7789")
+        self.assertEqual(ready, [None])
+
+#
+# test_stages.py ends here
@@ -0,0 +1,877 @@
+# test_sync.py ---
+#
+# Filename: test_sync.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Mon Oct 19 10:14:52 2026 (+0200)
+
+# Commentary:
+#
+# Tests for the experiment sync server, its clients and relays. The protocols are connected to each other through
+# in-memory transports and all the timers run on a fake clock. Run them with: python -m twisted.trial gumby.tests
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import json
+import zlib
+
+from twisted.internet import reactor, task
+from twisted.internet.address import IPv4Address
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import MemoryReactorClock, StringTransport
+from twisted.trial.unittest import TestCase
+
+from gumby import sync
+from gumby.stages import waitForPort
+from gumby.sync import (ConnectionBudget, ExperimentClientFactory, ExperimentRelayFactory, ExperimentRetryProto,
+                        ExperimentServiceFactory, PeerDirectory)
+
+
+class FakeReactor(MemoryReactorClock):
+
+    exitCode = None
+
+    def runUntilCurrent(self):
+        pass
+
+
+class FakeTask(object):
+
+    """
+    Stands in for twisted.internet.task in gumby.sync, so the looping calls run on the fake clock and the cooperative
+    tasks run right away.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def LoopingCall(self, f, *args, **kwargs):
+        call = task.LoopingCall(f, *args, **kwargs)
+        call.clock = self.clock
+        return call
+
+    def cooperate(self, iterator):
+        for _ in iterator:
+            pass
+
+    def deferLater(self, clock, delay, f, *args, **kwargs):
+        return task.deferLater(clock, delay, f, *args, **kwargs)
+
+
+class Link(object):
+
+    """
+    Connects two protocols with in-memory transports, pump() passes the data written by each of them to the other one.
+    """
+
+    def __init__(self, server, client, host="127.0.0.1", port=40000):
+        self.server = server
+        self.client = client
+        self.closed = False
+        server.makeConnection(StringTransport(peerAddress=IPv4Address('TCP', host, port)))
+        client.makeConnection(StringTransport(peerAddress=IPv4Address('TCP', "127.0.0.1", 7788)))
+
+    def pump(self):
+        """
+        Passes data around until neither side has anything left to say, returns True if there was any.
+        """
+        pumped = False
+        while not self.closed:
+            moved = False
+            for source, destination in ((self.client, self.server), (self.server, self.client)):
+                data = source.transport.value()
+                if data:
+                    source.transport.clear()
+                    destination.dataReceived(data)
+                    moved = pumped = True
+            if not moved:
+                if self.server.transport.disconnecting or self.client.transport.disconnecting:
+                    self.drop()
+                break
+        return pumped
+
+    def drop(self):
+        if not self.closed:
+            self.closed = True
+            self.server.connectionLost(Failure(ConnectionDone()))
+            self.client.connectionLost(Failure(ConnectionDone()))
+
+
+class Connector(object):
+
+    """
+    Counts the connection attempts of a client factory.
+    """
+
+    connects = 0
+
+    def connect(self):
+        self.connects += 1
+
+    def stopConnecting(self):
+        pass
+
+
+class SyncTestCase(TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.patch(sync, 'reactor', self.reactor)
+        self.patch(sync, 'task', FakeTask(self.reactor))
+        self.patch(sync, 'deferToThread', maybeDeferred)
+        self.links = []
+
+    def connect(self, factory, client=None, port=None):
+        """
+        Opens a connection to factory, from client if given. Returns the protocol of the server side.
+        """
+        port = port or 40000 + len(self.links)
+        server = factory.buildProtocol(IPv4Address('TCP', "127.0.0.1", port))
+        if client is None:
+            server.makeConnection(StringTransport(peerAddress=IPv4Address('TCP', "127.0.0.1", port)))
+        else:
+            self.links.append(Link(server, client, port=port))
+        return server
+
+    def disconnect(self, server):
+        server.connectionLost(Failure(ConnectionDone()))
+
+    def makeClient(self, protocol_version=sync.FRAMED_PROTOCOL_VERSION, capabilities=('zlib', 'resume'), **vars):
+        client = ExperimentClientFactory(vars).buildProtocol(None)
+        client.protocol_version = protocol_version
+        client.capabilities = capabilities
+        return client
+
+    def makeClients(self, amount, **kwargs):
+        return [self.makeClient(name="peer%d" % i, **kwargs) for i in range(amount)]
+
+    def pump(self):
+        # What one subscriber says can give the others something to receive (the all vars document, for instance)
+        while any([link.pump() for link in self.links]):
+            pass
+
+    def finishHandshake(self):
+        """
+        Lets the server give the go signal once everybody is ready and disconnect the subscribers.
+        """
+        self.pump()
+        self.reactor.advance(0)
+        self.pump()
+        self.reactor.advance(5)
+        self.pump()
+
+    def runHandshake(self, factory, clients):
+        """
+        Connects the clients to factory and runs the handshake until they got the go signal. Returns the list of
+        clients that started the experiment.
+        """
+        started = []
+        for client in clients:
+            client.startExperiment = lambda client=client: started.append(client)
+            self.connect(factory, client)
+        self.pump()
+        # Everybody is in before the go signal
+        self.assertEqual(factory.subscribers_received, len(clients))
+        self.finishHandshake()
+        self.reactor.advance(factory.experiment_start_delay + 1)
+        return started
+
+    def assertAllVars(self, clients):
+        """
+        Checks that the clients got the ids 1..N and the vars of each other.
+        """
+        ids = sorted(str(id) for id in range(1, len(clients) + 1))
+        self.assertEqual(sorted(client.my_id for client in clients), ids)
+        for client in clients:
+            self.assertEqual(sorted(client.peers.ids()), ids)
+            for other in clients:
+                peer = client.peers.get(other.my_id)
+                self.assertEqual(peer['port'], int(other.my_id) + 12000)
+                self.assertEqual(peer['host'], "127.0.0.1")
+                self.assertEqual(peer['name'], other.vars['name'])
+
+
+class TestHandshake(SyncTestCase):
+
+    def test_text(self):
+        factory = ExperimentServiceFactory(3, 2)
+        clients = self.makeClients(3, protocol_version=None, capabilities=())
+        started = self.runHandshake(factory, clients)
+
+        self.assertAllVars(clients)
+        self.assertEqual(len(started), 3)
+        self.assertFalse(any(client.framed for client in clients))
+        self.assertTrue(all(link.closed for link in self.links))
+
+    def test_framed(self):
+        factory = ExperimentServiceFactory(3, 0)
+        clients = self.makeClients(3)
+        started = self.runHandshake(factory, clients)
+
+        self.assertAllVars(clients)
+        self.assertEqual(len(started), 3)
+        for link in self.links:
+            self.assertTrue(link.client.framed)
+            self.assertTrue(link.server.framed)
+        self.assertTrue(all(link.closed for link in self.links))
+
+    def test_split_frames(self):
+        factory = ExperimentServiceFactory(1, 0)
+        server = self.connect(factory)
+        server.dataReceived("protocol:framed:%d\r\n" % sync.FRAMED_PROTOCOL_VERSION)
+        data = sync.encodeFrame(sync.MSG_TIME, "%f" % self.reactor.seconds()) + sync.encodeFrame(sync.MSG_SET, "a", "b:c")
+        # Frames can arrive a byte at a time, or several at once
+        for i in range(len(data)):
+            server.dataReceived(data[i])
+        self.assertEqual(server.vars["a"], "b:c")
+        self.assertEqual(server.id, 1)
+
+    def test_unknown_frame(self):
+        factory = ExperimentServiceFactory(1, 0)
+        server = self.connect(factory)
+        server.dataReceived("protocol:framed:%d\r\n" % sync.FRAMED_PROTOCOL_VERSION)
+        server.dataReceived(sync.encodeFrame(sync.MSG_GO, "0"))
+        self.assertTrue(server.transport.disconnecting)
+
+    def test_mixed_protocols(self):
+        factory = ExperimentServiceFactory(4, 0)
+        clients = (self.makeClients(1, protocol_version=None, capabilities=()) +
+                   self.makeClients(1, protocol_version=None) +
+                   self.makeClients(1, protocol_version=1) +
+                   self.makeClients(1))
+        started = self.runHandshake(factory, clients)
+
+        self.assertAllVars(clients)
+        self.assertEqual(len(started), 4)
+
+
+class TestScenarioDistribution(SyncTestCase):
+
+    def test_scenario(self):
+        scenario_file = self.mktemp()
+        with open(scenario_file, 'w') as f:
+            f.write("@0:1 start\n@0:2 online {1-2}\n@0:3 offline {!1}\n")
+
+        factory = ExperimentServiceFactory(3, 0, scenario_file)
+        clients = self.makeClients(2) + self.makeClients(1, protocol_version=None)
+        received = []
+        for client in clients:
+            client.expect_scenario = True
+            client.onScenarioReceived = lambda client=client: received.append(client)
+        started = self.runHandshake(factory, clients)
+
+        self.assertAllVars(clients)
+        self.assertEqual(len(started), 3)
+        self.assertEqual(len(received), 3)
+        for client in clients:
+            expected = json.loads(json.dumps(factory.scenario.get_actions(int(client.my_id))))
+            self.assertEqual(client.scenario_actions, expected)
+        self.assertEqual([[action[2] for action in client.scenario_actions] for client in
+                          sorted(clients, key=lambda client: client.my_id)],
+                         [["start", "online"], ["start", "online", "offline"], ["start", "offline"]])
+
+
+class TestCompressedVars(SyncTestCase):
+
+    def test_text_zlib(self):
+        factory = ExperimentServiceFactory(3, 0)
+        clients = self.makeClients(3, protocol_version=None, capabilities=('zlib',))
+        started = self.runHandshake(factory, clients)
+
+        self.assertAllVars(clients)
+        self.assertEqual(len(started), 3)
+        self.assertIsNotNone(factory._compressed_vars)
+
+    def test_mixed(self):
+        factory = ExperimentServiceFactory(3, 0)
+        clients = (self.makeClients(1, protocol_version=None, capabilities=()) +
+                   self.makeClients(1, protocol_version=None, capabilities=('zlib',)) +
+                   self.makeClients(1))
+
+        compressed = []
+
+        def compress(data):
+            compressed.append(data)
+            return real_compress(data)
+        real_compress = zlib.compress
+        self.patch(zlib, 'compress', compress)
+        started = self.runHandshake(factory, clients)
+
+        self.assertAllVars(clients)
+        self.assertEqual(len(started), 3)
+        # Encoded once for everybody
+        self.assertEqual(len(compressed), 1)
+        self.assertEqual(zlib.decompress(factory._compressed_vars), factory._json_vars)
+
+
+class TestIdAllocation(SyncTestCase):
+
+    def test_unregistered_connections_get_no_id(self):
+        factory = ExperimentServiceFactory(2, 0)
+        # Connections that are closed before saying anything, such as port probes
+        for _ in range(3):
+            self.disconnect(self.connect(factory))
+
+        first = self.connect(factory)
+        second = self.connect(factory)
+        first.dataReceived("time:%f\r\n" % self.reactor.seconds())
+        second.dataReceived("time:%f\r\n" % self.reactor.seconds())
+
+        self.assertEqual((first.id, second.id), (1, 2))
+        self.assertTrue(factory.ids_pushed)
+
+    def test_relay_ids(self):
+        factory = ExperimentServiceFactory(4, 0)
+        subscriber = self.connect(factory)
+        subscriber.dataReceived("time:%f\r\n" % self.reactor.seconds())
+
+        relay = self.connect(factory)
+        relay.dataReceived("protocol:framed:4\r\n")
+        relay.dataReceived(sync.encodeFrame(sync.MSG_RELAY, "3"))
+
+        self.assertEqual(subscriber.id, 1)
+        self.assertEqual(relay.relayed_ids, [2, 3, 4])
+
+    def test_lost_connection_id_is_reused(self):
+        factory = ExperimentServiceFactory(3, 0)
+        clients = [self.makeClient(protocol_version=None, capabilities=()) for _ in range(3)]
+        self.connect(factory, clients[0])
+        self.pump()
+        # It registers and drops before the ids are sent, then comes back without a session
+        self.links[0].drop()
+        for client in clients:
+            self.connect(factory, client)
+        self.finishHandshake()
+
+        self.assertEqual(sorted(client.my_id for client in clients), ["1", "2", "3"])
+        for client in clients:
+            self.assertEqual(sorted(client.peers.ids()), ["1", "2", "3"])
+            self.assertIsNotNone(client.time_offset)
+
+    def test_lost_connection_id_is_reused_after_push(self):
+        factory = ExperimentServiceFactory(2, 0)
+        clients = [self.makeClient(protocol_version=None, capabilities=()) for _ in range(2)]
+        for client in clients:
+            self.connect(factory, client)
+        self.links[1].pump()
+        self.links[0].pump()
+        # It drops after getting its id, without a session to resume
+        lost_id = clients[0].my_id
+        self.links[0].drop()
+
+        self.assertEqual(factory.free_ids, [int(lost_id)])
+        self.connect(factory, clients[0])
+        self.finishHandshake()
+
+        self.assertEqual(clients[0].my_id, lost_id)
+        self.assertEqual(sorted(client.my_id for client in clients), ["1", "2"])
+
+    def test_resumed_session_keeps_its_id(self):
+        factory = ExperimentServiceFactory(2, 0)
+        clients = [self.makeClient() for _ in range(2)]
+        for client in clients:
+            self.connect(factory, client)
+        self.links[1].pump()
+        self.links[0].pump()
+        lost_id = clients[0].my_id
+        self.links[0].drop()
+
+        # A newcomer doesn't take the id of a subscriber that can still resume its session
+        self.assertNotIn(int(lost_id), factory.free_ids)
+        self.connect(factory, clients[0])
+        self.finishHandshake()
+
+        self.assertEqual(clients[0].my_id, lost_id)
+        self.assertEqual(sorted(client.my_id for client in clients), ["1", "2"])
+
+
+class TestSessions(SyncTestCase):
+
+    def test_resume(self):
+        for kwargs in ({}, {'protocol_version': None, 'capabilities': ('zlib', 'resume')}):
+            self.links = []
+            factory = ExperimentServiceFactory(3, 0)
+            clients = self.makeClients(3, **kwargs)
+            all_vars_received = []
+            for client in clients:
+                client.onAllVarsReceived = lambda client=client: all_vars_received.append(client)
+                self.connect(factory, client)
+
+            # Everybody got the vars, but the go signal hasn't been sent yet
+            self.pump()
+            self.assertEqual(len(all_vars_received), 3)
+            lost_id = clients[0].my_id
+            self.links[0].drop()
+            self.assertEqual(factory.subscribers_received, 2)
+
+            self.connect(factory, clients[0])
+            self.pump()
+            self.assertEqual(factory.subscribers_received, 3)
+            self.assertEqual(factory.lost_sessions, {})
+            self.finishHandshake()
+
+            self.assertEqual(clients[0].my_id, lost_id)
+            self.assertAllVars(clients)
+            # It only got what it missed
+            self.assertEqual(len(all_vars_received), 3)
+            self.assertIsNotNone(factory.start_time)
+
+    def test_resume_unknown_session(self):
+        factory = ExperimentServiceFactory(2, 0)
+        server = self.connect(factory)
+        server.dataReceived("resume:1:0123456789abcdef:\r\n")
+        self.assertTrue(server.transport.disconnecting)
+        self.assertEqual(factory.connections_made, {})
+
+    def loseSession(self, factory):
+        clients = self.makeClients(2)
+        for client in clients:
+            self.connect(factory, client)
+        self.pump()
+        lost_id = int(clients[0].my_id)
+        self.links[0].drop()
+        self.assertIn(lost_id, factory.lost_sessions)
+        return clients, lost_id
+
+    def test_session_expires(self):
+        factory = ExperimentServiceFactory(2, 0)
+        _, lost_id = self.loseSession(factory)
+
+        self.reactor.advance(sync.SESSION_RESUME_TIMEOUT)
+        self.assertEqual(factory.free_ids, [lost_id])
+        self.assertNotIn(lost_id, factory.sessions)
+        self.assertEqual(factory.lost_sessions, {})
+
+    def test_restarted_from_scratch(self):
+        factory = ExperimentServiceFactory(2, 0)
+        clients, lost_id = self.loseSession(factory)
+
+        # It comes back from the same host without its session
+        restarted = self.makeClient()
+        self.connect(factory, restarted)
+        self.finishHandshake()
+
+        self.assertEqual(restarted.my_id, str(lost_id))
+        self.assertEqual(sorted(client.my_id for client in (restarted, clients[1])), ["1", "2"])
+        self.assertEqual(factory.lost_sessions, {})
+
+
+class TestClockSync(SyncTestCase):
+
+    def test_lowest_round_trip(self):
+        now = [100.0]
+        self.patch(sync, 'time', lambda: now[0])
+        client = self.makeClient()
+        client.makeConnection(StringTransport())
+        client.startFraming()
+        client.transport.clear()
+        synced = []
+        client.whenClockSynced().addCallback(synced.append)
+
+        client.startClockSync()
+        # The client clock is 2 secs ahead, the longer the round trip the further off the estimate
+        for rtt in (0.5, 0.3, 0.02, 0.4, 0.1, 0.6, 0.05, 0.2):
+            sent = now[0]
+            now[0] += rtt
+            client.setPong(sent, sent + rtt / 2 - 2 + rtt)
+        self.assertEqual(synced, [None])
+
+        self.assertAlmostEqual(client.clock_offset, 2 - 0.02)
+        self.assertAlmostEqual(client.clock_rtt, 0.02)
+        self.assertAlmostEqual(client.clock_uncertainty, 0.01)
+        frames = client.transport.value()
+        self.assertEqual(frames.count(sync.encodeFrame(sync.MSG_PING, "100.000000")), 1)
+        self.assertTrue(frames.endswith(sync.encodeFrame(sync.MSG_CLOCK, "%f" % (2 - 0.02), "0.010000")))
+
+    def test_ready_after_clock(self):
+        factory = ExperimentServiceFactory(2, 0)
+        uncertainties = []
+        set_connection_ready = factory.setConnectionReady
+
+        def setConnectionReady(proto):
+            uncertainties.append(proto.clock_uncertainty)
+            set_connection_ready(proto)
+        factory.setConnectionReady = setConnectionReady
+
+        clients = self.makeClients(2)
+        for client in clients:
+            self.connect(factory, client)
+        self.pump()
+        self.links[0].drop()
+
+        # It has to measure its clock offset again before being ready
+        clients[0].clock_offset = None
+        self.connect(factory, clients[0])
+        self.finishHandshake()
+
+        self.assertEqual(len(uncertainties), 3)
+        self.assertNotIn(None, uncertainties)
+        self.assertAllVars(clients)
+
+
+class TestBarriers(SyncTestCase):
+
+    def setupBarriers(self, factory, amount):
+        clients = self.makeClients(amount)
+        for client in clients:
+            client.keep_connected = True
+        self.runHandshake(factory, clients)
+        # The connections are kept open after the go signal
+        self.assertFalse(any(link.closed for link in self.links))
+        self.assertEqual(factory.barrier_subscribers, amount)
+        return clients
+
+    def test_barrier(self):
+        factory = ExperimentServiceFactory(3, 0)
+        clients = self.setupBarriers(factory, 3)
+
+        passed = []
+        for client in clients:
+            client.waitForBarrier("phase 2").addCallback(passed.append)
+            self.pump()
+            if client is not clients[-1]:
+                self.assertEqual(passed, [])
+        self.assertEqual(len(passed), 3)
+        self.assertTrue(all(continue_time is not None for continue_time in passed))
+
+        # Once released, a barrier can be passed right away
+        late = []
+        clients[0].waitForBarrier("phase 2").addCallback(late.append)
+        self.pump()
+        self.assertEqual(len(late), 1)
+
+        # The server is done once everybody has disconnected
+        self.reactor.running = True
+        for link in self.links[:2]:
+            link.client.transport.loseConnection()
+        self.pump()
+        self.reactor.advance(0)
+        self.assertTrue(self.reactor.running)
+        self.links[2].client.transport.loseConnection()
+        self.pump()
+        self.reactor.advance(0)
+        self.assertFalse(self.reactor.running)
+
+    def test_barrier_quorum(self):
+        factory = ExperimentServiceFactory(4, 0)
+        clients = self.setupBarriers(factory, 4)
+
+        passed = []
+        for client in clients[:2]:
+            client.waitForBarrier("half", 0.5).addCallback(passed.append)
+        self.pump()
+        self.assertEqual(len(passed), 2)
+
+    def test_barrier_subscriber_leaves(self):
+        factory = ExperimentServiceFactory(3, 0)
+        clients = self.setupBarriers(factory, 3)
+
+        passed = []
+        for client in clients[:2]:
+            client.waitForBarrier("b").addCallback(passed.append)
+        self.pump()
+        self.assertEqual(passed, [])
+
+        # The barrier can't wait for a subscriber that's gone
+        self.links[2].drop()
+        self.pump()
+        self.assertEqual(len(passed), 2)
+
+    def test_barrier_relay(self):
+        factory = ExperimentServiceFactory(3, 0)
+        relay = ExperimentRelayFactory(2, "127.0.0.1", 7788)
+        self.connect(factory, relay._upstream_factory.buildProtocol(None))
+        clients = self.makeClients(3)
+        for client in clients:
+            client.keep_connected = True
+        for client in clients[:2]:
+            self.connect(relay, client)
+        self.connect(factory, clients[2])
+        self.finishHandshake()
+        self.assertEqual(factory.barrier_subscribers, 3)
+
+        passed = []
+        for client in clients:
+            client.waitForBarrier("b").addCallback(passed.append)
+            self.pump()
+            if client is not clients[-1]:
+                self.assertEqual(passed, [])
+        self.assertEqual(len(passed), 3)
+
+
+    def test_waiting_subscriber_leaves(self):
+        factory = ExperimentServiceFactory(3, 0)
+        clients = self.setupBarriers(factory, 3)
+
+        passed = []
+        clients[0].waitForBarrier("b")
+        clients[1].waitForBarrier("b").addCallback(passed.append)
+        self.pump()
+        left = self.links[0].server
+
+        # Nobody continues because somebody that was waiting left
+        self.links[0].drop()
+        self.pump()
+        self.assertEqual(passed, [])
+        barrier = factory.barriers["b"]
+        self.assertEqual(barrier.reached, 1)
+        self.assertNotIn(left.id, barrier.waiting)
+
+        left.transport.clear()
+        clients[2].waitForBarrier("b").addCallback(passed.append)
+        self.pump()
+        self.assertEqual(len(passed), 2)
+        self.assertNotIn(None, passed)
+        self.assertEqual(left.transport.value(), "")
+
+    def test_waiting_relayed_subscriber_leaves(self):
+        factory = ExperimentServiceFactory(3, 0)
+        relay = ExperimentRelayFactory(2, "127.0.0.1", 7788)
+        self.connect(factory, relay._upstream_factory.buildProtocol(None))
+        clients = self.makeClients(3)
+        for client in clients:
+            client.keep_connected = True
+        for client in clients[:2]:
+            self.connect(relay, client)
+        self.connect(factory, clients[2])
+        self.finishHandshake()
+
+        passed = []
+        clients[0].waitForBarrier("b")
+        clients[2].waitForBarrier("b").addCallback(passed.append)
+        self.pump()
+        self.links[1].drop()
+        self.pump()
+        self.assertEqual(passed, [])
+        self.assertEqual(factory.barriers["b"].reached, 1)
+
+        clients[1].waitForBarrier("b").addCallback(passed.append)
+        self.pump()
+        self.assertEqual(len(passed), 2)
+        self.assertNotIn(None, passed)
+
+
+class TestAdmission(SyncTestCase):
+
+    def test_budget(self):
+        clock = task.Clock()
+        budget = ConnectionBudget(2, 3, clock)
+        self.assertEqual([budget.admit() for _ in range(5)], [0, 0, 0, 0.5, 1.0])
+
+        # The connections told to retry find a token when they come back
+        clock.advance(0.5)
+        self.assertEqual(budget.admit(), 0)
+        clock.advance(0.5)
+        self.assertEqual(budget.admit(), 0)
+        self.assertEqual(budget.admit(), 0.5)
+
+        # It fills up to the burst
+        clock.advance(10)
+        self.assertEqual([budget.admit() for _ in range(4)], [0, 0, 0, 0.5])
+
+    def test_retry(self):
+        factory = ExperimentServiceFactory(2, 0, connect_rate=1, connect_burst=1)
+        clients = self.makeClients(2)
+        self.connect(factory, clients[0])
+        self.connect(factory, clients[1])
+        self.assertIsInstance(self.links[1].server, ExperimentRetryProto)
+        self.assertEqual(factory.connections_retried, 1)
+
+        self.pump()
+        self.assertTrue(self.links[1].closed)
+        client_factory = clients[1].factory
+        self.assertEqual(client_factory.retry_after, 1.0)
+
+        # It reconnects when told to, not with the usual back off
+        connector = Connector()
+        client_factory.clientConnectionLost(connector, Failure(ConnectionDone()))
+        self.assertIsNone(client_factory.retry_after)
+        self.reactor.advance(0.999)
+        self.assertEqual(connector.connects, 0)
+        self.reactor.advance(0.001)
+        self.assertEqual(connector.connects, 1)
+
+        self.connect(factory, clients[1])
+        self.finishHandshake()
+        self.assertAllVars(clients)
+
+
+class TestPeerDirectory(TestCase):
+
+    def setUp(self):
+        self.all_vars = {"1": {"host": "10.0.0.1", "port": 12001, "key": "a2V5MQ=="},
+                         "2": {"host": "10.0.0.2", "port": "12002", "key": "a2V5Mg=="}}
+        self.peers = PeerDirectory(self.all_vars)
+
+    def test_lookups(self):
+        self.assertEqual(len(self.peers), 2)
+        self.assertIn(1, self.peers)
+        self.assertNotIn(3, self.peers)
+        self.assertEqual(self.peers.get_id("10.0.0.2", 12002), "2")
+        self.assertIsNone(self.peers.get_id("10.0.0.2", 12001))
+        self.assertEqual(self.peers.get_address(1), ("10.0.0.1", 12001))
+        self.assertIsNone(self.peers.get_address(3))
+
+    def test_decoded_once(self):
+        decoded = []
+
+        def decode(value):
+            decoded.append(value)
+            return value.decode('base64')
+        self.assertEqual(self.peers.get_decoded(1, "key", decode), "key1")
+        self.assertEqual(self.peers.get_decoded("1", "key", decode), "key1")
+        self.assertEqual(decoded, ["a2V5MQ=="])
+        self.assertIsNone(self.peers.get_decoded(3, "key", decode))
+
+        # The records are shared, they keep the encoded value
+        self.assertEqual(self.peers.get("1")["key"], "a2V5MQ==")
+        self.assertEqual(self.all_vars["1"]["key"], "a2V5MQ==")
+
+
+class TestPortProbe(SyncTestCase):
+
+    def test_probe_before_peers(self):
+        """
+        The readiness probe of the runner connects to the server and disconnects before any peer does.
+        """
+        factory = ExperimentServiceFactory(3, 0)
+        port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+
+        def connectPeers(_):
+            clients = self.makeClients(3, protocol_version=None, capabilities=())
+            for client in clients:
+                self.connect(factory, client)
+            self.finishHandshake()
+
+            self.assertEqual(sorted(client.my_id for client in clients), ["1", "2", "3"])
+
+        d = waitForPort("127.0.0.1", port.getHost().port, 5)
+        return d.addCallback(connectPeers)
+
+
+class TestRelay(SyncTestCase):
+
+    def connectRelay(self, factory, expected_subscribers):
+        relay = ExperimentRelayFactory(expected_subscribers, "127.0.0.1", 7788)
+        self.assertEqual(self.reactor.tcpClients[-1][:2], ("127.0.0.1", 7788))
+        self.connect(factory, relay._upstream_factory.buildProtocol(None))
+        return relay
+
+    def test_relay(self):
+        factory = ExperimentServiceFactory(4, 0)
+        relay = self.connectRelay(factory, 3)
+
+        started = []
+        clients = self.makeClients(4)
+        for client in clients:
+            client.startExperiment = lambda client=client: started.append(client)
+        for client in clients[:3]:
+            self.connect(relay, client)
+        self.connect(factory, clients[3])
+        self.pump()
+        # The server only sees two connections
+        self.assertEqual(len(factory.connections_made), 2)
+        # The relay tells the server its subscribers got the vars once they all did
+        self.reactor.advance(0)
+        self.pump()
+        self.assertEqual(factory.subscribers_received, 4)
+        self.finishHandshake()
+        self.reactor.advance(1)
+
+        self.assertAllVars(clients)
+        self.assertEqual(len(started), 4)
+        self.assertTrue(all(link.closed for link in self.links))
+
+    def test_text_subscribers(self):
+        factory = ExperimentServiceFactory(2, 0)
+        relay = self.connectRelay(factory, 2)
+        clients = self.makeClients(2, protocol_version=None, capabilities=())
+        for client in clients:
+            self.connect(relay, client)
+        self.finishHandshake()
+
+        self.assertAllVars(clients)
+
+    def test_scenario(self):
+        scenario_file = self.mktemp()
+        with open(scenario_file, 'w') as f:
+            f.write("@0:1 start\n@0:2 online {1}\n@0:3 offline {!1}\n")
+
+        factory = ExperimentServiceFactory(3, 0, scenario_file)
+        relay = self.connectRelay(factory, 2)
+        clients = self.makeClients(3)
+        for client in clients:
+            client.expect_scenario = True
+        for client in clients[:2]:
+            self.connect(relay, client)
+        self.connect(factory, clients[2])
+        self.pump()
+        self.reactor.advance(0)
+        self.pump()
+        self.finishHandshake()
+
+        self.assertAllVars(clients)
+        # The relay got the actions of its subscribers from the server, it has no scenario of its own
+        self.assertIsNone(relay.scenario)
+        self.assertEqual(sorted(relay.upstream_scenario), sorted(int(client.my_id) for client in clients[:2]))
+        for client in clients:
+            expected = json.loads(json.dumps(factory.scenario.get_actions(int(client.my_id))))
+            self.assertEqual(client.scenario_actions, expected)
+
+    def test_upstream_lost(self):
+        factory = ExperimentServiceFactory(2, 0)
+        self.connectRelay(factory, 2)
+        self.reactor.running = True
+        self.links[0].drop()
+        self.reactor.advance(0)
+
+        self.assertEqual(self.reactor.exitCode, 1)
+        self.assertFalse(self.reactor.running)
+
+
+class TestSubscriberVars(SyncTestCase):
+
+    def test_relay_offset_applied_once(self):
+        factory = ExperimentServiceFactory(2, 0)
+        relay = self.connect(factory, port=41000)
+        relay.dataReceived("protocol:framed:4\r\n")
+        relay.dataReceived(sync.encodeFrame(sync.MSG_RELAY, "2"))
+        relay.setClock(2.0, 0.001)
+        relay.relayed_vars = {"1": {"time_offset": 0.5, "port": 12001}, "2": {"time_offset": -1.0}}
+
+        expected = {1: {"time_offset": 2.5, "port": 12001, "host": "127.0.0.1"},
+                    2: {"time_offset": 1.0, "port": 12002, "host": "127.0.0.1"}}
+        self.assertEqual(relay.getSubscriberVars(), expected)
+        # Sending them again (after a session was resumed) gives the same vars
+        self.assertEqual(relay.getSubscriberVars(), expected)
+        self.assertEqual(relay.relayed_vars["1"]["time_offset"], 0.5)
+
+#
+# test_sync.py ends here
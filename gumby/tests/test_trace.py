@@ -0,0 +1,130 @@
+# test_trace.py ---
+#
+# Filename: test_trace.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Wed Oct 21 12:20:05 2026 (+0200)
+
+# Commentary:
+#
+# Tests for the trace files, which have to load in the Chrome trace viewer once the ones of every process are merged.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import json
+from os import path
+
+from twisted.internet.defer import Deferred
+from twisted.trial.unittest import TestCase
+
+from gumby import trace
+from gumby.trace import TRACE_SUFFIX, Tracer
+
+
+class TestTracer(TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.patch(trace, 'time', lambda: self.now)
+
+    def makeTracer(self, name="runner"):
+        tracer = Tracer()
+        # Not enabled through enable(), the trace is saved by the tests themselves and not at reactor shutdown
+        tracer.filename = path.join(self.mktemp(), name + TRACE_SUFFIX)
+        return tracer
+
+    def load(self, tracer):
+        tracer.save()
+        with open(tracer.filename) as f:
+            document = json.load(f)
+        self.assertEqual(document['displayTimeUnit'], 'ms')
+        return document['traceEvents']
+
+    def spans(self, events):
+        hosts = dict((event['pid'], event['args']['name']) for event in events if event['name'] == 'process_name')
+        tracks = dict(((event['pid'], event['tid']), event['args']['name']) for event in events
+                      if event['name'] == 'thread_name')
+        return sorted((hosts[event['pid']], tracks[event['pid'], event['tid']], event['name'], event['ts'],
+                       event['dur'], event['args']) for event in events if event['ph'] == 'X')
+
+    def test_disabled(self):
+        tracer = Tracer()
+        self.assertFalse(tracer.enabled)
+        tracer.complete("node1", "peers", "start", 1, 2)
+        d = Deferred()
+        self.assertIs(tracer.traceDeferred(d, "node1", "stages", "deploy"), d)
+        d.callback(None)
+        tracer.save()
+        self.assertEqual(tracer._events, [])
+
+    def test_spans(self):
+        tracer = self.makeTracer()
+        tracer.complete("node1", "peers", "start", 1.5, 2.25, {"peer": 3})
+        span = tracer.span("node1", "sync server", "connect", phase=1)
+        self.now = 101.5
+        span.end(subscribers=10)
+        # A span that never ends isn't recorded
+        tracer.span("node2", "peers", "hang")
+
+        succeeded, failed = Deferred(), Deferred()
+        tracer.traceDeferred(succeeded, "node2", "stages", "deploy")
+        tracer.traceDeferred(failed, "node2", "stages", "collect").addErrback(lambda _: None)
+        self.now = 103
+        succeeded.callback(None)
+        failed.errback(RuntimeError("collect failed"))
+
+        events = self.load(tracer)
+        self.assertEqual(self.spans(events),
+                         [("node1", "peers", "start", 1500000, 750000, {"peer": 3}),
+                          ("node1", "sync server", "connect", 100000000, 1500000, {"phase": 1, "subscribers": 10}),
+                          ("node2", "stages", "collect", 101500000, 1500000, {"failed": True}),
+                          ("node2", "stages", "deploy", 101500000, 1500000, {"failed": False})])
+        # Every host is a process and every track of it a thread
+        self.assertEqual(len([event for event in events if event['name'] == 'process_name']), 2)
+        self.assertEqual(len([event for event in events if event['name'] == 'thread_name']), 3)
+        self.assertFalse(path.exists(tracer.filename + '.tmp'))
+
+    def test_merge(self):
+        runner = self.makeTracer()
+        runner.complete("runner", "stages", "deploy", 1, 2)
+        peer = self.makeTracer("peer")
+        peer.complete("node1", "peers", "start", 3, 4)
+        peer.complete("node1", "dispersy", "start", 3, 5)
+        peer.save()
+
+        runner.merge(peer.filename)
+        events = self.load(runner)
+        self.assertEqual(self.spans(events),
+                         [("node1", "dispersy", "start", 3000000, 2000000, {}),
+                          ("node1", "peers", "start", 3000000, 1000000, {}),
+                          ("runner", "stages", "deploy", 1000000, 1000000, {})])
+        # The merged process doesn't take over the ids of ours
+        pids = set(event['pid'] for event in events if event['name'] == 'process_name')
+        self.assertEqual(len(pids), 2)
+
+#
+# test_trace.py ends here
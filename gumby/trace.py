@@ -0,0 +1,168 @@
+# trace.py ---
+#
+# Filename: trace.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 17:12:36 2026 (+0200)
+
+# Commentary:
+#
+# Timeline of an experiment run in the Chrome trace event format (load it in chrome://tracing or Perfetto).
+#
+# Every host is a process in the timeline and every command (or phase) running on it a thread, so each of them
+# gets its own track. Spans are recorded as complete ("X") events with wall clock timestamps, so the traces
+# written by different processes (the runner, the experiment server) can be merged into a single timeline.
+#
+# Nothing is recorded unless a trace file has been set with tracer.enable(). Each process has its own
+# module level tracer, which writes its file when the reactor shuts down.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import json
+import logging
+from os import makedirs, path, rename
+from socket import gethostname
+from time import time
+
+from twisted.internet import reactor
+from twisted.python.failure import Failure
+
+# Suffix of the trace files written by the experiment processes, the runner merges them all into its own
+TRACE_SUFFIX = '.trace.json'
+
+LOCAL_HOST = gethostname()
+
+
+class Span(object):
+
+    def __init__(self, tracer, host, track, name, args):
+        self.tracer = tracer
+        self.host = host
+        self.track = track
+        self.name = name
+        self.args = args
+        self.start = time()
+
+    def end(self, **args):
+        self.args.update(args)
+        self.tracer.complete(self.host, self.track, self.name, self.start, time(), self.args)
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self.filename = None
+        self._events = []
+        # host -> pid, (host, track) -> tid
+        self._pids = {}
+        self._tids = {}
+
+    @property
+    def enabled(self):
+        return self.filename is not None
+
+    def enable(self, filename):
+        if not self.enabled:
+            reactor.addSystemEventTrigger('after', 'shutdown', self.save)
+        self.filename = filename
+
+    def _getIds(self, host, track):
+        if host not in self._pids:
+            self._pids[host] = pid = len(self._pids) + 1
+            self._events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': host}})
+        pid = self._pids[host]
+
+        if (host, track) not in self._tids:
+            self._tids[host, track] = tid = len(self._tids) + 1
+            self._events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': track}})
+        return pid, self._tids[host, track]
+
+    def complete(self, host, track, name, start, end, args=None):
+        """
+        Records a span that ran on host from start to end (timestamps in seconds since the epoch).
+        """
+        if not self.enabled:
+            return
+        pid, tid = self._getIds(host, track)
+        self._events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                             'ts': int(start * 1e6), 'dur': int((end - start) * 1e6), 'args': args or {}})
+
+    def span(self, host, track, name, **args):
+        """
+        Starts a span, call end() on the returned object when it's over. Spans that never end are not recorded.
+        """
+        return Span(self, host, track, name, args)
+
+    def traceDeferred(self, d, host, track, name, **args):
+        """
+        Records a span from now until d fires, marking it as failed if it fails. Returns d.
+        """
+        if not self.enabled:
+            return d
+        span = self.span(host, track, name, **args)
+
+        def onFired(result):
+            span.end(failed=isinstance(result, Failure))
+            return result
+        return d.addBoth(onFired)
+
+    def merge(self, filename):
+        """
+        Adds the events of another trace file to this one, keeping its hosts and tracks apart from ours.
+        """
+        with open(filename) as f:
+            events = json.load(f)['traceEvents']
+
+        hosts = dict((event['pid'], event['args']['name']) for event in events
+                     if event['ph'] == 'M' and event['name'] == 'process_name')
+        tracks = dict(((event['pid'], event['tid']), event['args']['name']) for event in events
+                      if event['ph'] == 'M' and event['name'] == 'thread_name')
+        for event in events:
+            if event['ph'] == 'M':
+                continue
+            host = hosts.get(event['pid'], filename)
+            pid, tid = self._getIds(host, tracks.get((event['pid'], event['tid']), str(event['tid'])))
+            event = dict(event, pid=pid, tid=tid)
+            self._events.append(event)
+
+    def save(self):
+        if not self.enabled:
+            return
+        if not path.isdir(path.dirname(self.filename)):
+            makedirs(path.dirname(self.filename))
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump({'traceEvents': self._events, 'displayTimeUnit': 'ms'}, f)
+        rename(tmp_filename, self.filename)
+        self._logger.info("Wrote %d trace events to %s", len(self._events), self.filename)
+
+tracer = Tracer()
+
+#
+# trace.py ends here
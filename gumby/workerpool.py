@@ -0,0 +1,75 @@
+# workerpool.py ---
+#
+# Filename: workerpool.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Mon Oct 19 12:31:17 2026 (+0200)
+
+# Commentary:
+#
+# Spreads CPU bound work (churn expansion in the scenario preprocessor, key pool generation) over worker processes,
+# keeping the results in order.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from itertools import imap
+from multiprocessing import Pool, cpu_count
+
+
+class WorkerPool(object):
+
+    """
+    Runs jobs over processes worker processes (by default one per CPU), or in this process if there is only one.
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes or cpu_count()
+        self._pool = Pool(self.processes) if self.processes > 1 else None
+
+    def imap(self, func, jobs):
+        """
+        Returns the results of func for every job in order, as soon as they are available.
+        """
+        if self._pool:
+            return self._pool.imap(func, jobs)
+        return imap(func, jobs)
+
+    def chunks(self, items):
+        """
+        Splits items (a sequence) in about 4 chunks per process, so the work is spread evenly even if some chunks
+        take longer than others.
+        """
+        chunk_size = max(1, len(items) / (self.processes * 4))
+        return (items[i:i + chunk_size] for i in xrange(0, len(items), chunk_size))
+
+    def close(self):
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+
+#
+# workerpool.py ends here
@@ -0,0 +1,75 @@
+#!/usr/bin/env python2
+# compile_scenario.py ---
+#
+# Filename: compile_scenario.py
+# Description:
+# Author:
+# Maintainer:
+# Created:
+
+# Commentary:
+#
+# %*% Compiles a scenario file into a binary file with a per-peer index so every
+# %*% peer only has to load its own actions when the experiment starts.
+#
+# The compiled file is written next to the scenario file and picked up
+# automatically by ScenarioRunner. $VARIABLES are substituted with the values
+# of the environment this script runs in, so run it trough run_in_env.py (for
+# instance from the local setup script).
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import logging
+import sys
+from os import environ, path
+from time import time
+
+from gumby.scenario import ScenarioCompiler
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) < 2:
+        print >> sys.stderr, "Usage: %s <scenario-file> [<peer-count>]" % sys.argv[0]
+        exit(1)
+
+    scenario_file = sys.argv[1]
+    if not path.isabs(scenario_file) and 'EXPERIMENT_DIR' in environ:
+        scenario_file = path.join(environ['EXPERIMENT_DIR'], scenario_file)
+
+    if len(sys.argv) > 2:
+        peer_count = int(sys.argv[2])
+    elif 'DAS4_INSTANCES_TO_RUN' in environ:
+        peer_count = int(environ['DAS4_INSTANCES_TO_RUN'])
+    else:
+        peer_count = None
+
+    t1 = time()
+    ScenarioCompiler(scenario_file, peer_count).compile()
+    print >> sys.stderr, "Took %.2f to compile %s" % (time() - t1, scenario_file)
+
+#
+# compile_scenario.py ends here
@@ -53,18 +53,33 @@ fi
 
 export PROCESSES_IN_THIS_NODE
 
-echo "$(hostname) here, spawning $PROCESSES_IN_THIS_NODE instances of command: $DAS4_NODE_COMMAND"
+# @CONF_OPTION PEERS_PER_PROCESS: Amount of instances run by each spawned command, which has to support it (see dispersyclient.py). (default is 1)
+PEERS_PER_PROCESS=${PEERS_PER_PROCESS:-1}
+
+echo "$(hostname) here, spawning $PROCESSES_IN_THIS_NODE instances of command: $DAS4_NODE_COMMAND ($PEERS_PER_PROCESS per process)"
 
 OUTPUT_DIR=/local/$USER/Experiment_${EXPERIMENT_NAME}_output
 rm -fR "$OUTPUT_DIR"
 mkdir -p "$OUTPUT_DIR"
 cd "$OUTPUT_DIR"
 
+# @CONF_OPTION SYNC_RELAY: Run a sync relay (see sync_relay.py) on every node, so the sync server gets a single connection per node instead of one per instance. (default is FALSE)
+if [ "${SYNC_RELAY,,}" == "true" ]; then
+    export SYNC_RELAY_PORT=${SYNC_RELAY_PORT:-$SYNC_PORT}
+    sync_relay.py > sync_relay.log 2>&1 &
+    RELAY_PID=$!
+    # Make the instances of this node connect to the relay
+    export SYNC_HOST=127.0.0.1
+    export SYNC_PORT=$SYNC_RELAY_PORT
+fi
+
 CMDFILE=$(mktemp --tmpdir=/local/$USER/ process_guard_XXXXXXXXXXXXX_$USER)
 
 # @CONF_OPTION DAS4_NODE_COMMAND: The command that will be repeatedly launched in the worker nodes of the cluster. (required)
-for INSTANCE in $(seq 1 1 $PROCESSES_IN_THIS_NODE); do
-    echo "$DAS4_NODE_COMMAND" >> $CMDFILE
+for INSTANCE in $(seq 1 $PEERS_PER_PROCESS $PROCESSES_IN_THIS_NODE); do
+    # The last process gets the remaining instances
+    PEERS_IN_PROCESS=$(( PROCESSES_IN_THIS_NODE - INSTANCE + 1 < PEERS_PER_PROCESS ? PROCESSES_IN_THIS_NODE - INSTANCE + 1 : PEERS_PER_PROCESS ))
+    echo "PEERS_PER_PROCESS=$PEERS_IN_PROCESS $DAS4_NODE_COMMAND" >> $CMDFILE
 done
 
 # @CONF_OPTION DAS4_NODE_TIMEOUT: Time in seconds to wait for the sub-processes to run before killing them. (required)
@@ -72,6 +87,10 @@ done
 
 rm $CMDFILE
 
+if [ -n "$RELAY_PID" ]; then
+    kill $RELAY_PID 2>/dev/null ||:
+fi
+
 # Now, lets send the generated data back to the head node
 rsync -a --delete-before --exclude="sqlite/" "$OUTPUT_DIR/" "$OUTPUT_DIR_URI/$(hostname)/" 2>&1
 
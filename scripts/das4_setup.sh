@@ -58,6 +58,11 @@ find -iname *.py[oc] -delete
 
 pycompile.py .
 
+# @CONF_OPTION COMPILE_SCENARIO_FILE: Scenario file (relative to the experiment dir) to compile for DAS4_INSTANCES_TO_RUN peers so each peer only loads its own actions. (default is disabled)
+if [ ! -z "$COMPILE_SCENARIO_FILE" ]; then
+    compile_scenario.py "$COMPILE_SCENARIO_FILE"
+fi
+
 
 #
 # das4_setup.sh ends here
@@ -59,10 +59,11 @@
 
 # Code:
 
-from os import environ
+from os import environ, path
 
 from gumby.sync import ExperimentServiceFactory
 from gumby.log import setupLogging
+from gumby.trace import TRACE_SUFFIX, tracer
 
 from twisted.internet import reactor
 
@@ -70,6 +71,11 @@ from twisted.internet import reactor
 # @CONF_OPTION SYNC_EXPERIMENT_START_DELAY: Delay the synchronized start of the experiment by this amount of seconds when giving the start signal.
 # @CONF_OPTION SYNC_EXPERIMENT_START_DELAY: The default value should be OK for a few thousand instances. (float, default 5)
 # @CONF_OPTION SYNC_PORT: Port where we should listen on. (required)
+# @CONF_OPTION SYNC_SCENARIO_FILE: Scenario file (relative to the experiment dir) to parse once and send to every client (default is disabled)
+# @CONF_OPTION SYNC_BARRIER_RELEASE_DELAY: Seconds between the last client reaching a scenario barrier and all of them continuing. (float, default 1)
+# @CONF_OPTION SYNC_CONNECT_RATE: New connections per second the server accepts, the ones over budget are told when to come back. 0 to accept them all right away. (float, default 1000)
+# @CONF_OPTION SYNC_CONNECT_BURST: Connections the server accepts at once before limiting them to SYNC_CONNECT_RATE. (default is SYNC_CONNECT_RATE)
+# @CONF_OPTION TRACE_FILE: If set, the phases of the sync handshake are written to OUTPUT_DIR/experiment_server.trace.json, which the runner merges into its timeline. (default is disabled)
 
 if __name__ == '__main__':
     setupLogging()
@@ -79,10 +85,24 @@ if __name__ == '__main__':
         expected_subscribers = int(environ['DAS4_INSTANCES_TO_RUN'])
 
     experiment_start_delay = float(environ.get('SYNC_EXPERIMENT_START_DELAY', 5))
+    barrier_release_delay = float(environ.get('SYNC_BARRIER_RELEASE_DELAY', 1))
+    connect_rate = float(environ.get('SYNC_CONNECT_RATE', 1000))
+    connect_burst = int(environ.get('SYNC_CONNECT_BURST', max(1, int(connect_rate))))
     server_port = int(environ['SYNC_PORT'])
 
+    scenario_file = environ.get('SYNC_SCENARIO_FILE', None)
+    if scenario_file:
+        scenario_file = path.join(environ['EXPERIMENT_DIR'], scenario_file)
+
+    if environ.get('TRACE_FILE'):
+        tracer.enable(path.join(environ['OUTPUT_DIR'], 'experiment_server' + TRACE_SUFFIX))
+
     reactor.exitCode = 0
-    reactor.listenTCP(server_port, ExperimentServiceFactory(expected_subscribers, experiment_start_delay))
+    # The connections of a burst shouldn't be dropped by the kernel before we get to turn them away
+    reactor.listenTCP(server_port, ExperimentServiceFactory(expected_subscribers, experiment_start_delay,
+                                                            scenario_file, barrier_release_delay,
+                                                            connect_rate, connect_burst),
+                      backlog=max(50, connect_burst if connect_rate > 0 else expected_subscribers))
     reactor.run()
     exit(reactor.exitCode)
 
@@ -0,0 +1,84 @@
+#!/usr/bin/env python2
+# generate_key_pool.py ---
+#
+# Filename: generate_key_pool.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 12:51:40 2026 (+0200)
+
+# Commentary:
+#
+# %*% Pre-generates the member keys of an experiment's peers into a key pool file, so the clients take their key
+# %*% by peer id instead of generating one at startup (see MEMBER_KEY_POOL in dispersyclient.py).
+#
+# Without -o the pool is cached in KEY_POOL_DIR by crypto class and curve, and only extended if it has less keys
+# than needed. The name of the pool file is printed on stdout. Run it trough run_in_env.py (for instance from the
+# local setup script) to get the amount of peers from DAS4_INSTANCES_TO_RUN.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import logging
+import sys
+from optparse import OptionParser
+from os import environ
+from time import time
+
+from gumby.experiments.keypool import DEFAULT_CRYPTO, DEFAULT_CURVE, generate_key_pool
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = OptionParser(usage="%prog [options] [<peer-count>]")
+    parser.add_option("-c", "--crypto",
+                      default=DEFAULT_CRYPTO,
+                      help="Dotted name of the crypto class generating the keys (default: %default).")
+    parser.add_option("-e", "--curve",
+                      default=DEFAULT_CURVE,
+                      help="Curve of the keys (default: %default).")
+    parser.add_option("-p", "--processes",
+                      type="int",
+                      help="Amount of processes generating keys (default: one per CPU).")
+    parser.add_option("-o", "--output",
+                      metavar="FILE",
+                      help="Write the pool to FILE instead of to the cache.")
+    options, args = parser.parse_args()
+
+    if args:
+        peer_count = int(args[0])
+    elif 'DAS4_INSTANCES_TO_RUN' in environ:
+        peer_count = int(environ['DAS4_INSTANCES_TO_RUN'])
+    else:
+        parser.error("The amount of peers is needed")
+
+    t1 = time()
+    filename = generate_key_pool(peer_count, options.crypto, unicode(options.curve), options.output,
+                                 options.processes)
+    print >> sys.stderr, "Took %.2f to get a pool of %d keys" % (time() - t1, peer_count)
+    print filename
+
+#
+# generate_key_pool.py ends here
@@ -0,0 +1,153 @@
+#!/usr/bin/env python2
+# sync_handshake_benchmark.py ---
+#
+# Filename: sync_handshake_benchmark.py
+# Description:
+# Author:
+# Maintainer:
+# Created:
+
+# Commentary:
+#
+# %*% Measures the CPU time the experiment synchronization handshake costs per subscriber with each of the
+# %*% protocols gumby.sync speaks (plain text, text with a zlib compressed all vars document and framed).
+#
+# Every protocol is run in its own process running the sync server, with all the clients in another process
+# connecting to it over loopback TCP connections. Only the CPU time of the server is reported, from the first
+# connection until all the clients have received the all vars document. Each client sets a variable of the given
+# size, similar to the private key every DispersyExperimentScriptClient shares.
+#
+# Take into account that it needs two file descriptors per subscriber (see ulimit -n).
+#
+# Usage: sync_handshake_benchmark.py [<subscribers> [<var-size>]]
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import base64
+import sys
+from os import path, urandom
+from resource import RUSAGE_SELF, getrusage
+from subprocess import Popen, check_output
+from time import time
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from gumby.sync import ExperimentClient, ExperimentClientFactory, ExperimentServiceFactory
+
+PROTOCOLS = ('text', 'text+zlib', 'framed')
+
+
+class BenchmarkServiceFactory(ExperimentServiceFactory):
+
+    handshake_start = None
+    handshake_done = None
+
+    def setConnectionMade(self, proto):
+        if self.handshake_start is None:
+            self.handshake_start = (cpu_time(), time())
+        ExperimentServiceFactory.setConnectionMade(self, proto)
+
+    def setConnectionReceived(self, proto):
+        ExperimentServiceFactory.setConnectionReceived(self, proto)
+        if self.subscribers_received >= self.expected_subscribers:
+            self.handshake_done = (cpu_time(), time())
+            reactor.stop()
+
+    def startExperiment(self):
+        pass
+
+
+def get_client_class(protocol):
+    class BenchmarkClient(ExperimentClient):
+        protocol_version = ExperimentClient.protocol_version if protocol == 'framed' else None
+        capabilities = ('zlib',) if protocol == 'text+zlib' else ()
+    return BenchmarkClient
+
+
+def cpu_time():
+    usage = getrusage(RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_protocol(protocol, subscribers, var_size):
+    """
+    Runs the sync server, with the clients in a child process so their CPU time isn't counted.
+    """
+    factory = BenchmarkServiceFactory(subscribers, 0)
+    port = reactor.listenTCP(0, factory, backlog=max(50, subscribers), interface='127.0.0.1')
+    clients = Popen([sys.executable, path.abspath(__file__), '--clients', str(port.getHost().port), protocol,
+                     str(subscribers), str(var_size)])
+
+    def check_clients():
+        if clients.poll() is not None:
+            print >> sys.stderr, "The client process exited with code %d, aborting" % clients.returncode
+            reactor.stop()
+
+    LoopingCall(check_clients).start(1.0, now=False)
+    reactor.run()
+    if clients.poll() is None:
+        clients.kill()
+    clients.wait()
+    if factory.handshake_done is None:
+        exit(1)
+
+    start, end = factory.handshake_start, factory.handshake_done
+    print "%s %d %.3f %.3f" % (protocol, subscribers, end[0] - start[0], end[1] - start[1])
+
+
+def run_clients(port, protocol, subscribers, var_size):
+    """
+    Connects the clients to the server, runs until the server process kills this one.
+    """
+    client_class = get_client_class(protocol)
+    for _ in xrange(subscribers):
+        client_vars = {'private_keypair': base64.encodestring(urandom(var_size))}
+        reactor.connectTCP('127.0.0.1', port, ExperimentClientFactory(client_vars, client_class))
+    reactor.run()
+
+
+def main(subscribers=100, var_size=64):
+    print "# protocol subscribers server_cpu_seconds wall_seconds server_cpu_ms_per_subscriber"
+    for protocol in PROTOCOLS:
+        output = check_output([sys.executable, path.abspath(__file__), '--run', protocol, str(subscribers),
+                               str(var_size)])
+        protocol, subscribers, cpu_seconds, wall_seconds = output.split()
+        print protocol, subscribers, cpu_seconds, wall_seconds, "%.3f" % (float(cpu_seconds) * 1000 / int(subscribers))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == '--run':
+        run_protocol(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    elif len(sys.argv) == 6 and sys.argv[1] == '--clients':
+        run_clients(int(sys.argv[2]), sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
+    elif len(sys.argv) <= 3:
+        main(*[int(arg) for arg in sys.argv[1:]])
+    else:
+        print >> sys.stderr, "Usage: %s [<subscribers> [<var-size>]]" % sys.argv[0]
+        exit(1)
+
+#
+# sync_handshake_benchmark.py ends here
@@ -0,0 +1,70 @@
+#!/usr/bin/env python2
+# sync_relay.py ---
+#
+# Filename: sync_relay.py
+# Description:
+# Author:
+# Maintainer:
+# Created:
+
+# Commentary:
+#
+# %*% Experiment synchronization relay, meant to be run on every node running experiment instances.
+# %*% It acts as the sync server for the instances of its node and connects to the real sync server
+# %*% (see experiment_server.py) on their behalf with a single connection, so the server only has to
+# %*% deal with one connection per node instead of one per instance.
+#
+# The instances of the node need to connect to the relay instead of to SYNC_HOST:SYNC_PORT, das4_node_run_job.sh
+# takes care of it if SYNC_RELAY is enabled.
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from os import environ
+
+from gumby.sync import ExperimentRelayFactory
+from gumby.log import setupLogging
+
+from twisted.internet import reactor
+
+# @CONF_OPTION SYNC_RELAY_PORT: Port where the sync relay of every node should listen on. (default is SYNC_PORT)
+# @CONF_OPTION SYNC_RELAY_SUBSCRIBERS: Number of local sync clients the relay should wait for. (default is PROCESSES_IN_THIS_NODE)
+
+if __name__ == '__main__':
+    setupLogging()
+    if 'SYNC_RELAY_SUBSCRIBERS' in environ:
+        expected_subscribers = int(environ['SYNC_RELAY_SUBSCRIBERS'])
+    else:
+        expected_subscribers = int(environ['PROCESSES_IN_THIS_NODE'])
+
+    relay_port = int(environ.get('SYNC_RELAY_PORT', environ['SYNC_PORT']))
+
+    reactor.exitCode = 0
+    reactor.listenTCP(relay_port, ExperimentRelayFactory(expected_subscribers, environ['SYNC_HOST'],
+                                                         int(environ['SYNC_PORT'])))
+    reactor.run()
+    exit(reactor.exitCode)
+
+#
+# sync_relay.py ends here
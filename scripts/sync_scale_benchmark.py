@@ -0,0 +1,307 @@
+#!/usr/bin/env python2
+# sync_scale_benchmark.py ---
+#
+# Filename: sync_scale_benchmark.py
+# Description:
+# Author:
+# Maintainer:
+# Created:
+
+# Commentary:
+#
+# %*% Measures how long the experiment synchronization server takes to get a swarm of fake clients from their
+# %*% first connection to the go signal, and how much CPU time and memory it needs for it.
+#
+# The server runs in this process, the fake clients either in it too or spread over a pool of processes (-p),
+# all of them connecting over loopback. Every client records when it connected, was told to retry later (if the
+# server has a connect rate, see -r), got its id, sent ready, got the all vars document and got the go signal.
+# The server records when all the subscribers got to each of those phases. Everything is measured in seconds since the start of the benchmark and written as a JSON report.
+#
+# Take into account that it needs two file descriptors per subscriber (see ulimit -n).
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import base64
+import json
+import sys
+from collections import defaultdict
+from optparse import OptionParser
+from os import path, urandom
+from random import random
+from resource import RUSAGE_SELF, getrusage
+from subprocess import PIPE, Popen
+from time import time
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from gumby.sync import MSG_READY, ExperimentClient, ExperimentClientFactory, ExperimentServiceFactory
+
+CLIENT_PHASES = ('connect', 'retry', 'id', 'ready', 'vars', 'go')
+PROTOCOLS = ('text', 'text+zlib', 'framed')
+
+
+def cpu_time():
+    usage = getrusage(RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {'count': len(values),
+            'p50': values[len(values) / 2],
+            'p90': values[int(len(values) * 0.9)],
+            'p99': values[int(len(values) * 0.99)],
+            'max': values[-1]}
+
+
+class Swarm(object):
+
+    """
+    A bunch of fake clients connecting to the sync server, recording when each of them gets to every phase.
+    """
+
+    def __init__(self, host, port, subscribers, protocol, var_size, origin, connect_spread=0.0, on_done=None):
+        self.timestamps = defaultdict(list)
+        self.origin = origin
+        self.pending = subscribers
+        self.on_done = on_done
+
+        swarm = self
+
+        class SwarmClient(ExperimentClient):
+            protocol_version = ExperimentClient.protocol_version if protocol == 'framed' else None
+            capabilities = ('zlib',) if protocol == 'text+zlib' else ()
+
+            def connectionMade(self):
+                swarm.record('connect')
+                ExperimentClient.connectionMade(self)
+
+            def lineReceived(self, line):
+                if line.startswith("retry:"):
+                    swarm.record('retry')
+                ExperimentClient.lineReceived(self, line)
+
+            def setId(self, id):
+                swarm.record('id')
+                return ExperimentClient.setId(self, id)
+
+            def sendMessage(self, msg_type, *fields):
+                if msg_type == MSG_READY:
+                    swarm.record('ready')
+                ExperimentClient.sendMessage(self, msg_type, *fields)
+
+            def setAllVars(self, all_vars):
+                swarm.record('vars')
+                state = ExperimentClient.setAllVars(self, all_vars)
+                # Don't keep thousands of copies of the directory around, the benchmark doesn't use them
+                self.peers = None
+                return state
+
+            def setGo(self, start_time):
+                swarm.record('go')
+                self.factory.stopTrying()
+                self.transport.loseConnection()
+                swarm.clientDone()
+
+        for _ in xrange(subscribers):
+            client_vars = {'private_keypair': base64.encodestring(urandom(var_size)).replace('\n', '')}
+            reactor.callLater(random() * connect_spread, reactor.connectTCP, host, port,
+                              ExperimentClientFactory(client_vars, SwarmClient))
+
+    def record(self, phase):
+        self.timestamps[phase].append(time() - self.origin)
+
+    def clientDone(self):
+        self.pending -= 1
+        if self.pending == 0 and self.on_done:
+            self.on_done()
+
+
+class BenchmarkServiceFactory(ExperimentServiceFactory):
+
+    """
+    Sync server recording when all the subscribers got to each phase and the CPU time it used.
+    """
+
+    def __init__(self, expected_subscribers, origin, connect_rate=0, connect_burst=None):
+        ExperimentServiceFactory.__init__(self, expected_subscribers, 0, connect_rate=connect_rate,
+                                          connect_burst=connect_burst)
+        self.origin = origin
+        self.phases = {}
+        self.cpu_start = None
+        self.cpu_seconds = None
+
+    def record(self, phase):
+        self.phases[phase] = time() - self.origin
+
+    def setConnectionMade(self, proto):
+        if self.cpu_start is None:
+            self.cpu_start = cpu_time()
+            self.record('first_connect')
+        ExperimentServiceFactory.setConnectionMade(self, proto)
+
+    def pushIdToSubscribers(self):
+        self.record('all_connected')
+        ExperimentServiceFactory.pushIdToSubscribers(self)
+
+    def pushInfoToSubscribers(self):
+        self.record('all_ready')
+        ExperimentServiceFactory.pushInfoToSubscribers(self)
+
+    def startExperiment(self, start_time=None):
+        self.record('all_vars_received')
+        ExperimentServiceFactory.startExperiment(self, start_time)
+        self.record('go_sent')
+        self.cpu_seconds = cpu_time() - self.cpu_start
+
+    def onExperimentStarted(self, _):
+        reactor.callLater(0, reactor.stop)
+
+    def onExperimentSetupTimeout(self):
+        print >> sys.stderr, "The sync server timed out waiting for the subscribers"
+        ExperimentServiceFactory.onExperimentSetupTimeout(self)
+
+
+def run_swarm(host, port, subscribers, protocol, var_size, origin, connect_spread):
+    """
+    Runs a swarm of clients in a child process and prints the timestamps of every client phase as JSON.
+    """
+    swarm = Swarm(host, port, subscribers, protocol, var_size, origin, connect_spread, reactor.stop)
+    reactor.run()
+    print json.dumps(swarm.timestamps)
+
+
+def main(options):
+    origin = time()
+    factory = BenchmarkServiceFactory(options.subscribers, origin, options.connect_rate, options.connect_burst)
+    port = reactor.listenTCP(0, factory, backlog=max(50, options.subscribers), interface='127.0.0.1')
+    port_number = port.getHost().port
+
+    swarms = []
+    children = []
+    if options.processes:
+        for i in xrange(options.processes):
+            subscribers = options.subscribers / options.processes + (i < options.subscribers % options.processes)
+            children.append(Popen([sys.executable, path.abspath(__file__), '--swarm', '127.0.0.1', str(port_number),
+                                   str(subscribers), options.protocol, str(options.var_size), repr(origin),
+                                   str(options.connect_spread)], stdout=PIPE))
+    else:
+        swarms.append(Swarm('127.0.0.1', port_number, options.subscribers, options.protocol, options.var_size,
+                            origin, options.connect_spread))
+
+    def check_children():
+        for child in children:
+            if child.poll():
+                print >> sys.stderr, "A client process exited with code %d, aborting" % child.returncode
+                reactor.exitCode = 1
+                reactor.stop()
+                return
+
+    reactor.exitCode = 0
+    if children:
+        LoopingCall(check_children).start(1.0, now=False)
+    reactor.run()
+    if reactor.exitCode:
+        for child in children:
+            if child.poll() is None:
+                child.kill()
+        exit(reactor.exitCode)
+    wall_seconds = time() - origin
+
+    timestamps = defaultdict(list)
+    for swarm in swarms:
+        for phase, values in swarm.timestamps.iteritems():
+            timestamps[phase].extend(values)
+    for child in children:
+        output, _ = child.communicate()
+        for phase, values in json.loads(output).iteritems():
+            timestamps[phase].extend(values)
+
+    report = {'subscribers': options.subscribers,
+              'processes': options.processes,
+              'protocol': options.protocol,
+              'var_size': options.var_size,
+              'connect_spread': options.connect_spread,
+              'connect_rate': options.connect_rate,
+              'connect_burst': options.connect_burst,
+              'wall_seconds': wall_seconds,
+              'server': {'phases': factory.phases,
+                         'cpu_seconds': factory.cpu_seconds,
+                         'cpu_includes_clients': not options.processes,
+                         'max_rss_kb': getrusage(RUSAGE_SELF).ru_maxrss},
+              'clients': dict((phase, percentiles(timestamps[phase])) for phase in CLIENT_PHASES)}
+
+    report = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
+
+if __name__ == '__main__':
+    if len(sys.argv) == 9 and sys.argv[1] == '--swarm':
+        run_swarm(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), sys.argv[5], int(sys.argv[6]),
+                  float(sys.argv[7]), float(sys.argv[8]))
+        exit(0)
+
+    parser = OptionParser()
+    parser.add_option("-n", "--subscribers",
+                      type="int",
+                      default=1000,
+                      help="Amount of fake clients to connect to the server (default: %default).")
+    parser.add_option("-p", "--processes",
+                      type="int",
+                      default=0,
+                      help="Run the clients in this many processes instead of in the server's one (default: %default).")
+    parser.add_option("--protocol",
+                      choices=PROTOCOLS,
+                      default='framed',
+                      help="Protocol the clients speak, one of %s (default: %%default)." % ", ".join(PROTOCOLS))
+    parser.add_option("-s", "--var-size",
+                      type="int",
+                      default=160,
+                      help="Size in bytes of the (base64 encoded) variable every client sets (default: %default).")
+    parser.add_option("-c", "--connect-spread",
+                      type="float",
+                      default=0.0,
+                      help="Spread the client connections randomly over this many seconds (default: %default).")
+    parser.add_option("-r", "--connect-rate",
+                      type="float",
+                      default=0.0,
+                      help="New connections per second the server accepts, 0 for no limit (default: %default).")
+    parser.add_option("-b", "--connect-burst",
+                      type="int",
+                      help="Connections the server accepts at once before limiting them (default: the connect rate).")
+    parser.add_option("-o", "--output",
+                      metavar="FILE",
+                      help="Write the JSON report to FILE instead of to stdout.")
+    (options, args) = parser.parse_args()
+    main(options)
+
+#
+# sync_scale_benchmark.py ends here